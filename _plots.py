@@ -1,7 +1,5 @@
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
-from qiskit.quantum_info import entropy
-from qiskit.quantum_info import partial_trace, Statevector
 import numpy as np
 
 
@@ -28,20 +26,23 @@ def make_convergence_plots_per_param(
         fci_energy,
         labels = ['UCCSD', 'EfficientSU2'],
         markers = ['o', '^'],
-        filename = 'default_filename.pdf'):
+        filename = 'default_filename.pdf',
+        store = None):
     
     """
     Saves a figure with 1 x 2 or 2 x N_params / 2 convergence subplots for different values of a given parameter in a figs/ folder
         Args:
             - iters: list, contains the integers [0, 1, 2, ..., N_iters-1]
             - energies_per_type_per_param: list, of N_params sublists, of N_types subsublists, of len N_iters, contains the energies
-            at each value of the parameter, for each type of ansatz, and at each iteration
+            at each value of the parameter, for each type of ansatz, and at each iteration; with a store, the subsublists can be
+            replaced by run ids, whose energies are then read from the store
             - params: list, contains the different values of the parameter of interest
             - param_name: str, is the name of the parameter of interest
             - fci_energy: float, reference energy
             - labels: list, of N_types strings, where each string is the name of an ansatz
             - markers: list, of N_types strings, where each string is the marker associated to an ansatz
             - filename: str, name of the .pdf file to be saved
+            - store: results_store.ResultStore instance, from which the energies given as run ids are read
         Returns:
             Nothing
     """
@@ -69,6 +70,8 @@ def make_convergence_plots_per_param(
             ax.set_ylabel('Energy (Ha)')
 
         for j, energies in enumerate(energies_per_type_per_param[i]):
+            if isinstance(energies, str):
+                energies = store.energies(energies)  # only the energy column of the run is read
             ax.plot(
                 np.concatenate([iters, [len(iters),]])[::5], # plots every 5th iteration
                 energies[50::3*5], # assuming 3 circuit evaluations per optimization step (SPSA with blocking)
@@ -86,6 +89,7 @@ def make_convergence_plots_per_param(
     handles, labels = axs.flat[-1].get_legend_handles_labels() if len(params) > 1 else axs.flat[0].get_legend_handles_labels()
     fig.legend(handles, labels, loc='lower center', ncol=len(labels), bbox_to_anchor=(0.5, -0.15))
     plt.savefig(f'figs/{filename}.pdf', bbox_inches='tight')
+    plt.close(fig)
 
 def make_entropy_plot(
         distances,
@@ -98,15 +102,15 @@ def make_entropy_plot(
     different bond distances in a figs/ folder
         Args:
             - distances: list, of len N_dist, contains the bond lengths
-            - qcs: list, of len N_dist, contains the converged states at the different bond lengths
+            - qcs: list, of len N_dist, contains the converged states at the different bond lengths, as circuits with bound
+            parameters or statevectors
             - filename: str, name of the .pdf file to be saved
         Returns:
             Nothing
     """  
 
-    states = [Statevector(qc) for qc in qcs]
-    rhos_q0 = [partial_trace(state, [1,3]) for state in states]
-    entropies = [entropy(rho) for rho in rhos_q0]
+    statevectors = [_statevector(qc) for qc in qcs]
+    entropies = entanglement_entropies(statevectors, traced_qubits=[1, 3])
     fig, ax = plt.subplots()
     ax.plot(distances, entropies, marker='o', label=r'Adaptive QITE', alpha=0.7, markersize=8, markeredgewidth=1.5,linestyle='-.')
     ax.set_ylabel('Entanglement entropy')
@@ -133,7 +137,9 @@ def make_pes_plots_per_param(
         Args:
             - distances: list, of N_dist float, contains each bond length at which the PES is evaluated
             - energies_per_type_per_param: list, of N_params sublists, of N_types subsublists, contains the energies at 
-            each value of the parameter for each type of ansatz at each bond length
+            each value of the parameter for each type of ansatz at each bond length; a subsublist can also be a value of
+            the dict returned by run_vqe_simulation (e.g. results[(n_shots, n_iters, dep_error)]), whose final energies
+            are then used
             - params: list, of N_params numbers, contains the different values of the parameter of interest
             - param_name: str, is the name of the parameter of interest
             - fci_energies: list, of N_dist numbers, contains the reference energy at each bond length
@@ -157,6 +163,9 @@ def make_pes_plots_per_param(
             ax.set_ylabel('Energy [Ha]')
 
         for j, energies in enumerate(energies_per_type):
+            if isinstance(energies, dict):
+                final_energies = dict(zip(energies['bond_lengths'], energies['final_energies']))
+                energies = [final_energies[distance] for distance in distances]
             ax.plot(distances, energies, label=labels[j], marker=markers[j], alpha=0.7, markersize=8, markeredgewidth=1.5, linestyle=None, linewidth=0, color=colors[j])
         ax.plot(distances, fci_energies, label='Exact FCI', alpha=0.7, markersize=0, markeredgewidth=0, linestyle='--', color='k')
 
@@ -165,4 +174,44 @@ def make_pes_plots_per_param(
     fig.legend(handles, labels, loc='lower center', ncol=len(labels), bbox_to_anchor=(0.5, -0.15))
     plt.subplots_adjust(wspace=0)  # No horizontal space between subplots
     plt.tight_layout()
-    plt.savefig(f'figs/{filename}.pdf', bbox_inches='tight')
\ No newline at end of file
+    plt.savefig(f'figs/{filename}.pdf', bbox_inches='tight')
+    plt.close(fig)
+
+
+def entanglement_entropies(
+        statevectors,
+        traced_qubits
+    ):
+
+    """
+    Returns the von Neumann entropies (base 2, as qiskit.quantum_info.entropy) of the reduced density matrices of a
+    batch of pure states, computed for the whole batch at once: the states are reshaped to (N_states, d_kept, d_traced)
+    matrices psi, whose reduced density matrices psi psi^dagger are diagonalized together
+        Args:
+            - statevectors: np.ndarray, of shape (N_states, 2**N_qubits), or list of N_states statevectors
+            - traced_qubits: list, of the qubits traced out (qubit 0 is the least significant bit of the basis states)
+        Returns:
+            - entropies: np.ndarray, of shape (N_states,)
+    """
+
+    statevectors = np.asarray(statevectors, dtype=complex)
+    n_states, dim = statevectors.shape
+    n_qubits = int(np.log2(dim))
+    # Axis k of the tensor of a state is qubit n_qubits - 1 - k
+    traced_axes = [n_qubits - 1 - q for q in traced_qubits]
+    kept_axes = [axis for axis in range(n_qubits) if axis not in traced_axes]
+    tensors = statevectors.reshape((n_states,) + (2,) * n_qubits)
+    tensors = tensors.transpose([0] + [1 + axis for axis in kept_axes] + [1 + axis for axis in traced_axes])
+    psi = tensors.reshape(n_states, 2 ** len(kept_axes), 2 ** len(traced_axes))
+
+    rhos = psi @ psi.conj().transpose(0, 2, 1)
+    eigenvalues = np.clip(np.linalg.eigvalsh(rhos), 0, None)
+    logs = np.log2(eigenvalues, where=eigenvalues > 1e-15, out=np.zeros_like(eigenvalues))
+    return -np.sum(eigenvalues * logs, axis=1)
+
+
+def _statevector(state):
+    if isinstance(state, np.ndarray):
+        return state
+    from qiskit.quantum_info import Statevector
+    return Statevector(state).data
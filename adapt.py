@@ -0,0 +1,170 @@
+import numpy as np
+from qiskit import QuantumCircuit
+from qiskit.circuit import ParameterVector
+from qiskit.circuit.library import PauliEvolutionGate
+from qiskit.primitives import StatevectorEstimator
+from qiskit.quantum_info import SparsePauliOp, Statevector
+from qiskit_algorithms.optimizers import L_BFGS_B
+from scipy.sparse.linalg import expm_multiply
+from gradients import ParameterShiftGradient
+from profiling import timed
+
+
+# ADAPT ansatze already built in this process, keyed by the Hamiltonian and the options of the construction
+_adapt_ansatze = {}
+
+
+def get_excitation_pool(num_spatial_orbitals, num_particles, mapper, pool='fermionic'):
+
+    """
+    Returns the pool of Hermitian generators A of the ADAPT ansatz, whose gates are exp(-i theta A)
+        Args:
+            - num_spatial_orbitals: int, number of active orbitals
+            - num_particles: tuple, numbers of alpha and beta electrons
+            - mapper: qiskit_nature.second_q.mappers, fermion-to-qubit mapper
+            - pool: str, 'fermionic' for the single and double excitations of UCCSD, or 'qubit' for the distinct Pauli
+            strings of these excitations, each one a generator (shallower gates, but more operators)
+        Returns:
+            - pool: list, of qiskit.quantum_info.SparsePauliOp
+    """
+
+    from qiskit_nature.second_q.circuit.library import UCCSD
+
+    excitations = UCCSD(num_spatial_orbitals, num_particles, mapper).operators
+    if pool == 'fermionic':
+        return list(excitations)
+    if pool == 'qubit':
+        labels = dict.fromkeys(label for operator in excitations for label in operator.paulis.to_labels())
+        return [SparsePauliOp(label) for label in labels]
+    raise ValueError("Pool not supported; must be 'fermionic' or 'qubit'")
+
+
+def build_adapt_ansatz(
+        initial_state,
+        hamiltonian,
+        pool,
+        gradient_threshold=1e-3,
+        max_operators=None,
+        estimator=None
+    ):
+
+    """
+    Grows an ansatz one operator at a time (ADAPT-VQE): at each step, the energy gradients dE/dtheta = i <[A, H]> of
+    appending exp(-i theta A) are computed for all the operators A of the pool in a single estimator call (one PUB
+    with the commutators as an array of observables), the operator with the largest gradient is appended with a new
+    parameter, and all the parameters are optimized again with L-BFGS-B. The growth stops when the largest gradient is
+    below gradient_threshold. Without estimator, the construction is exact: the parameters are optimized on the
+    statevector, with the gradients of all the parameters from one backward pass (see _StatevectorEnergy); with an
+    estimator, with parameter-shift gradients (see gradients.py).
+        Args:
+            - initial_state: qiskit.circuit.QuantumCircuit, e.g. the HartreeFock state
+            - hamiltonian: qiskit.quantum_info.SparsePauliOp, the Hamiltonian of the system
+            - pool: list, of qiskit.quantum_info.SparsePauliOp, Hermitian generators (see get_excitation_pool)
+            - gradient_threshold: float, largest gradient (Hartree per radian) below which the growth stops
+            - max_operators: int, maximum number of operators; None for no limit other than the threshold
+            - estimator: EstimatorV2 instance used for the construction; None for the exact StatevectorEstimator
+        Returns:
+            - ansatz: qiskit.circuit.QuantumCircuit, with one parameter per operator; its metadata holds the selected
+            'adapt_operators' (indices in the pool), the 'adapt_params' optimized during the construction and the
+            'adapt_gradients' (largest gradient at each step)
+    """
+
+    exact = estimator is None
+    estimator = estimator or StatevectorEstimator()
+    commutators = [(1j * (operator @ hamiltonian - hamiltonian @ operator)).simplify() for operator in pool]
+    # Both operators are Hermitian, so the commutators are: only the real part of their coefficients is kept
+    commutators = [SparsePauliOp(c.paulis, np.real(c.coeffs)) for c in commutators]
+
+    selected = []
+    params = np.zeros(0)
+    max_gradients = []
+    ansatz = _make_ansatz(initial_state, pool, selected)
+    while max_operators is None or len(selected) < max_operators:
+        with timed('adapt_pool_gradients'):
+            pub = (ansatz, commutators, params) if ansatz.num_parameters else (ansatz, commutators)
+            gradients = np.asarray(estimator.run([pub]).result()[0].data.evs)
+        best = int(np.argmax(np.abs(gradients)))
+        max_gradients.append(float(abs(gradients[best])))
+        if abs(gradients[best]) < gradient_threshold:
+            break
+
+        selected.append(best)
+        ansatz = _make_ansatz(initial_state, pool, selected)
+        with timed('adapt_optimization'):
+            if exact:
+                gradient = _StatevectorEnergy(initial_state, hamiltonian, [pool[index] for index in selected])
+            else:
+                gradient = ParameterShiftGradient(estimator, ansatz, hamiltonian)
+            result = L_BFGS_B(maxiter=200, ftol=1e-10).minimize(fun=gradient.value, x0=np.append(params, 0.0),
+                                                                jac=gradient.gradient)
+        params = result.x
+
+    ansatz.metadata = {'adapt_operators': selected, 'adapt_params': [float(x) for x in params],
+                       'adapt_gradients': max_gradients}
+    return ansatz
+
+
+def get_adapt_ansatz(initial_state, hamiltonian, num_spatial_orbitals, num_particles, mapper, pool='fermionic',
+                     gradient_threshold=1e-3):
+
+    """
+    Returns the ADAPT ansatz of a system (see build_adapt_ansatz), built once per process for each Hamiltonian
+    """
+
+    key = (tuple(hamiltonian.paulis.to_labels()), hamiltonian.coeffs.tobytes(), initial_state.num_qubits,
+           type(mapper).__name__, pool, gradient_threshold)
+    if key not in _adapt_ansatze:
+        operators = get_excitation_pool(num_spatial_orbitals, num_particles, mapper, pool)
+        _adapt_ansatze[key] = build_adapt_ansatz(initial_state, hamiltonian, operators, gradient_threshold)
+    ansatz = _adapt_ansatze[key].copy()
+    ansatz.metadata = dict(_adapt_ansatze[key].metadata)
+    return ansatz
+
+
+def _make_ansatz(initial_state, pool, selected):
+    ansatz = QuantumCircuit(initial_state.num_qubits)
+    ansatz.compose(initial_state, inplace=True)
+    theta = ParameterVector('θ', len(selected))
+    for i, index in enumerate(selected):
+        ansatz.append(PauliEvolutionGate(pool[index], time=theta[i]), range(initial_state.num_qubits))
+    return ansatz
+
+
+class _StatevectorEnergy:
+
+    """
+    Exact energy E(theta) = <psi|H|psi> of |psi> = exp(-i theta_n A_n) ... exp(-i theta_1 A_1) |psi_0>, and its gradient,
+    from the states of a forward pass and the backward propagation of H |psi>:
+    dE/dtheta_k = 2 Re <lambda_k| -i A_k |psi_k>, with |lambda_k> = exp(i theta_{k+1} A_{k+1}) ... exp(i theta_n A_n) H |psi>.
+    The energy and gradient of the last point are memoized, as in ParameterShiftGradient.
+    """
+
+    def __init__(self, initial_state, hamiltonian, generators):
+        self.psi_0 = Statevector(initial_state).data
+        self.hamiltonian = hamiltonian.to_matrix(sparse=True)
+        self.generators = [generator.to_matrix(sparse=True) for generator in generators]
+        self._last = None   # (x, energy, gradient)
+
+    def _evaluate(self, x):
+        x = np.asarray(x, dtype=float)
+        if self._last is not None and np.array_equal(self._last[0], x):
+            return self._last
+
+        states = [self.psi_0]
+        for theta, generator in zip(x, self.generators):
+            states.append(expm_multiply(-1j * theta * generator, states[-1]))
+        lam = self.hamiltonian @ states[-1]
+        energy = float(np.real(np.vdot(states[-1], lam)))
+
+        gradient = np.zeros(len(x))
+        for k in reversed(range(len(x))):
+            gradient[k] = 2 * np.real(np.vdot(lam, -1j * (self.generators[k] @ states[k + 1])))
+            lam = expm_multiply(1j * x[k] * self.generators[k], lam)
+        self._last = (np.copy(x), energy, gradient)
+        return self._last
+
+    def value(self, x):
+        return self._evaluate(x)[1]
+
+    def gradient(self, x):
+        return self._evaluate(x)[2]
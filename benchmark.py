@@ -0,0 +1,270 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+### Benchmark of the VQE pipeline: energy evaluations per second, time to chemical accuracy, peak memory and
+### the SCF and transpilation overheads, for a fixed set of cases run offline on the CPU.
+### Each case runs in a fresh process, so that its caches are cold and its peak memory is its own.
+### Example:
+###     python benchmark.py --suite quick --output out/benchmarks/current.json --baseline out/benchmarks/baseline.json
+### exits with status 1 if a metric regressed by more than its threshold with respect to the baseline;
+### --update-baseline writes the results as the new baseline instead.
+### python benchmark.py --import-budget only checks the import times of the light modules against import_budgets.
+
+
+chemical_accuracy = 1.6e-3     # Hartree
+
+# name -> settings of the grid point run by the case
+cases = {
+    'H2_UCCSD_4q_noiseless': dict(atomic_symbol='H2', bond_length=0.741, state_type='UCCSD', active_orbitals=2, n_elec=2, dep_error=0, estimator_name='noiseless'),
+    'H2_UCCSD_4q_noisy': dict(atomic_symbol='H2', bond_length=0.741, state_type='UCCSD', active_orbitals=2, n_elec=2, dep_error=1, estimator_name='noisy'),
+    'H2_EfficientSU2_4q_noiseless': dict(atomic_symbol='H2', bond_length=0.741, state_type='EfficientSU2', active_orbitals=2, n_elec=2, dep_error=0, estimator_name='noiseless'),
+    'H2_EfficientSU2_4q_noisy': dict(atomic_symbol='H2', bond_length=0.741, state_type='EfficientSU2', active_orbitals=2, n_elec=2, dep_error=1, estimator_name='noisy'),
+    'LiH_UCCSD_4q_noiseless': dict(atomic_symbol='LiH', bond_length=1.595, state_type='UCCSD', active_orbitals=2, n_elec=2, dep_error=0, estimator_name='noiseless'),
+    'LiH_UCCSD_4q_noisy': dict(atomic_symbol='LiH', bond_length=1.595, state_type='UCCSD', active_orbitals=2, n_elec=2, dep_error=1, estimator_name='noisy'),
+    'LiH_EfficientSU2_4q_noisy': dict(atomic_symbol='LiH', bond_length=1.595, state_type='EfficientSU2', active_orbitals=2, n_elec=2, dep_error=1, estimator_name='noisy'),
+    'LiH_UCCSD_6q_noiseless': dict(atomic_symbol='LiH', bond_length=1.595, state_type='UCCSD', active_orbitals=3, n_elec=2, dep_error=0, estimator_name='noiseless'),
+    'LiH_UCCSD_6q_noisy': dict(atomic_symbol='LiH', bond_length=1.595, state_type='UCCSD', active_orbitals=3, n_elec=2, dep_error=1, estimator_name='noisy'),
+    'LiH_EfficientSU2_6q_noisy': dict(atomic_symbol='LiH', bond_length=1.595, state_type='EfficientSU2', active_orbitals=3, n_elec=2, dep_error=1, estimator_name='noisy'),
+    'LiH_UCCSD_8q_noiseless': dict(atomic_symbol='LiH', bond_length=1.595, state_type='UCCSD', active_orbitals=4, n_elec=2, dep_error=0, estimator_name='noiseless'),
+    # Symmetry-reduced cases, down to a single qubit for H2 (see get_state_and_hamiltonian)
+    'H2_UCCSD_1q_tapered_noisy': dict(atomic_symbol='H2', bond_length=0.741, state_type='UCCSD', active_orbitals=2, n_elec=2, dep_error=1, estimator_name='noisy', symmetry_reduction='tapered', n_qubits=1),
+    'H2_UCCSD_1q_tapered_native': dict(atomic_symbol='H2', bond_length=0.741, state_type='UCCSD', active_orbitals=2, n_elec=2, dep_error=1, estimator_name='native', symmetry_reduction='tapered', n_qubits=1),
+    'LiH_UCCSD_4q_tapered_noisy': dict(atomic_symbol='LiH', bond_length=1.595, state_type='UCCSD', active_orbitals=4, n_elec=2, dep_error=1, estimator_name='noisy', symmetry_reduction='tapered', n_qubits=4),
+}
+
+suites = {
+    'quick': ['H2_UCCSD_4q_noiseless', 'H2_UCCSD_4q_noisy', 'H2_EfficientSU2_4q_noisy', 'LiH_UCCSD_6q_noisy',
+              'H2_UCCSD_1q_tapered_noisy'],
+    'full': list(cases),
+}
+
+# metric -> (whether higher is better, relative change counted as a regression)
+metrics = {
+    'evals_per_s': (True, 0.2),
+    'time_to_accuracy_s': (False, 0.25),
+    'wall_time_s': (False, 0.2),
+    'scf_s': (False, 0.3),
+    'transpile_s': (False, 0.3),
+    'peak_rss_mb': (False, 0.15),
+}
+
+# module -> maximum import time (seconds) in a fresh interpreter; these modules must not load Qiskit or PySCF
+import_budgets = {
+    'profiling': 0.1,
+    'utils': 0.2,
+    'results_store': 0.4,
+    'checkpoint': 0.4,
+    'sweep': 0.5,
+    'run': 0.5,
+    'cli': 0.1,
+}
+
+
+def run_case(name, n_iters=100, optimizer_name='spsa', seed=0):
+
+    """
+    Runs the grid point of a benchmark case and returns its metrics.
+    Meant to be run in a fresh process (see run_suite): the caches of the Hamiltonians and transpiled
+    circuits are kept in memory only, so the SCF and transpilation are always measured.
+        Args:
+            - name: str, name of the case, key of cases
+            - n_iters: int, number of optimizer iterations
+            - optimizer_name: str, see get_optimizer in optimizer.py
+            - seed: int, seed of the sweep
+        Returns:
+            - result: dict, with keys 'n_qubits', 'n_evals', 'final_energy', 'fci_energy', 'error', 'wall_time_s',
+            'evals_per_s' (evaluations per second of optimizer time), 'time_to_accuracy_s' (None if the error never
+            gets below chemical_accuracy), 'scf_s', 'transpile_s', 'peak_rss_mb' and 'stages' (see profiling.summary)
+    """
+
+    import profiling
+    import vqe
+    from results_store import ResultStore
+    from state_and_hamiltonian import get_fci_energy, hamiltonian_cache
+    from sweep import make_sweep_tasks, run_sweep_task
+
+    hamiltonian_cache.cache_dir = None
+    vqe.transpile_cache.cache_dir = None
+    case = cases[name]
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        task, = make_sweep_tasks(
+            case['atomic_symbol'], case['state_type'], [case['bond_length']], [0], [n_iters], [case['dep_error']],
+            case['active_orbitals'], case['n_elec'], optimizer_name=optimizer_name, seed=seed,
+            estimator_name=case['estimator_name'], results_store=store_dir,
+            symmetry_reduction=case.get('symmetry_reduction')
+        )
+        profiling.enable()
+        start = time.time()
+        result = run_sweep_task(task)
+        wall_time = time.time() - start
+        profiling.disable()
+        data = ResultStore(store_dir).load(task.out_filename, ('energy', 'timestamp'))
+
+    stages = profiling.summary()
+    fci_energy = get_fci_energy(case['atomic_symbol'], active_orb=case['active_orbitals'], n_elec=case['n_elec'],
+                                bond_length=case['bond_length'])
+    accurate = abs(data['energy'] - fci_energy) <= chemical_accuracy
+    optimizer_time = stages['optimizer']['total']
+
+    return {
+        'n_qubits': case.get('n_qubits', 2 * case['active_orbitals']),
+        'n_evals': len(data['energy']),
+        'final_energy': result['final_energy'],
+        'fci_energy': fci_energy,
+        'error': result['final_energy'] - fci_energy,
+        'wall_time_s': wall_time,
+        'evals_per_s': len(data['energy']) / optimizer_time,
+        'time_to_accuracy_s': float(data['timestamp'][accurate.argmax()] - start) if accurate.any() else None,
+        'scf_s': sum(stages[stage]['total'] for stage in ('pyscf_driver', 'active_space_transform', 'pauli_mapping') if stage in stages),
+        'transpile_s': stages['transpile']['total'] if 'transpile' in stages else 0.0,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'stages': stages,
+    }
+
+
+def run_suite(names, n_iters=100, optimizer_name='spsa', seed=0):
+
+    """
+    Runs the benchmark cases one after the other, each in a new process
+        Returns:
+            - results: dict, with keys 'metadata' (versions, machine, commit) and 'cases' (name -> run_case result)
+    """
+
+    results = {'metadata': _metadata(n_iters, optimizer_name, seed), 'cases': {}}
+    for name in names:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results['cases'][name] = executor.submit(run_case, name, n_iters, optimizer_name, seed).result()
+        case = results['cases'][name]
+        print(f"{name:<32} {case['evals_per_s']:>10.1f} evals/s  error {case['error']:+.2e} Ha  "
+              f"wall {case['wall_time_s']:.2f} s  rss {case['peak_rss_mb']:.0f} MB")
+    return results
+
+
+def measure_import_times(modules, repeats=3):
+
+    """
+    Returns the import time of each module in a new interpreter, the best of several runs
+        Args:
+            - modules: list, of str, names of the modules
+            - repeats: int, number of runs per module
+        Returns:
+            - times: dict, module -> import time in seconds
+    """
+
+    code = "import time; start = time.perf_counter(); import {}; print(time.perf_counter() - start)"
+    times = {}
+    for module in modules:
+        runs = [subprocess.run([sys.executable, '-c', code.format(module)], capture_output=True, text=True, check=True)
+                for _ in range(repeats)]
+        times[module] = min(float(run.stdout) for run in runs)
+    return times
+
+
+def compare(results, baseline, thresholds=None):
+
+    """
+    Compares the metrics of the cases present in both the results and the baseline
+        Args:
+            - results, baseline: dict, returned by run_suite
+            - thresholds: dict, metric -> relative change counted as a regression, overriding those of metrics
+        Returns:
+            - regressions: list, of (case, metric, baseline value, value, relative change) of the metrics which
+            got worse by more than their threshold; a case reaching chemical accuracy in the baseline but not
+            any more is a regression of time_to_accuracy_s with an infinite change
+    """
+
+    thresholds = dict({metric: threshold for metric, (_, threshold) in metrics.items()}, **(thresholds or {}))
+    regressions = []
+    for name, case in results['cases'].items():
+        if name not in baseline['cases']:
+            continue
+        reference = baseline['cases'][name]
+        for metric, (higher_is_better, _) in metrics.items():
+            old, new = reference.get(metric), case.get(metric)
+            if old is None:
+                continue
+            if new is None:
+                regressions.append((name, metric, old, new, float('inf')))
+                continue
+            change = (new - old) / old if old else 0.0
+            if (-change if higher_is_better else change) > thresholds[metric]:
+                regressions.append((name, metric, old, new, change))
+    return regressions
+
+
+def _metadata(n_iters, optimizer_name, seed):
+    import numpy
+    import qiskit
+    import qiskit_aer
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'qiskit': qiskit.__version__,
+        'qiskit_aer': qiskit_aer.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'n_iters': n_iters,
+        'optimizer_name': optimizer_name,
+        'seed': seed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the VQE pipeline')
+    parser.add_argument('--suite', choices=list(suites), default='quick')
+    parser.add_argument('--cases', nargs='+', choices=list(cases), help='cases to run instead of the suite')
+    parser.add_argument('--n-iters', type=int, default=100)
+    parser.add_argument('--optimizer', default='spsa')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='out/benchmarks/latest.json')
+    parser.add_argument('--baseline', help='results of a previous run to compare with')
+    parser.add_argument('--update-baseline', action='store_true', help='write the results to --baseline instead of comparing')
+    parser.add_argument('--import-budget', action='store_true', help='only check the import times against import_budgets')
+    args = parser.parse_args()
+
+    if args.import_budget:
+        over_budget = False
+        for module, seconds in measure_import_times(list(import_budgets)).items():
+            over_budget |= seconds > import_budgets[module]
+            print(f"{module:<16} {seconds:>6.3f} s  (budget {import_budgets[module]:.3f} s)"
+                  + ('  OVER BUDGET' if seconds > import_budgets[module] else ''))
+        sys.exit(1 if over_budget else 0)
+
+    results = run_suite(args.cases or suites[args.suite], args.n_iters, args.optimizer, args.seed)
+    paths = [args.output] + ([args.baseline] if args.update_baseline and args.baseline else [])
+    for path in paths:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline and not args.update_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline)
+        for name, metric, old, new, change in regressions:
+            print(f"REGRESSION {name} {metric}: {old} -> {new} ({change:+.0%})")
+        if regressions:
+            sys.exit(1)
+        print("No regression with respect to the baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,378 @@
+import hashlib
+import json
+import os
+import numpy as np
+import qiskit
+from qiskit import qpy, transpile
+from qiskit.circuit.library import get_standard_gate_name_mapping
+from qiskit.quantum_info import PauliList, SparsePauliOp
+
+
+_standard_gates = set(get_standard_gate_name_mapping())
+
+
+def normalize_geometry(geometry):
+
+    """
+    Returns a canonical form of a PySCF geometry string, so that equivalent geometries
+    (different spacing, trailing ';', 1.5 vs 1.50) give the same cache key
+        Args:
+            - geometry: str, geometry string of the form 'Li 0 0 0; H 0 0 1.595'
+        Returns:
+            - normalized: str, canonical geometry string
+    """
+
+    atoms = []
+    for atom in geometry.split(';'):
+        tokens = atom.split()
+        if not tokens:
+            continue
+        coords = [repr(round(float(x), 10)) for x in tokens[1:]]
+        atoms.append(' '.join([tokens[0]] + coords))
+    return '; '.join(atoms)
+
+
+def mapper_key(mapper):
+
+    """
+    Returns a string identifying a fermion-to-qubit mapper, e.g. 'JordanWignerMapper' or
+    'ParityMapper(num_particles=(1, 1))' when the mapper applies the two-qubit reduction
+        Args:
+            - mapper: qiskit_nature.second_q.mappers instance
+        Returns:
+            - key: str, name of the mapper and of its settings affecting the mapping
+    """
+
+    num_particles = getattr(mapper, 'num_particles', None)
+    if num_particles is None:
+        return type(mapper).__name__
+    return f"{type(mapper).__name__}(num_particles={tuple(num_particles)})"
+
+
+class HamiltonianCache:
+
+    """
+    Content-addressed cache of the reduced (active-space) problems, stored as compressed .npz files
+    in cache_dir and memoized in the current process. Each entry holds the qubit Hamiltonian
+    (packed symplectic Pauli representation and coefficients), the constant energy offsets, the
+    Hartree-Fock occupations and, once computed, the FCI energy.
+    When the files in cache_dir exceed max_bytes, the least recently used entries are deleted.
+        Args:
+            - cache_dir: str, folder of the on-disk cache; None to only memoize in memory
+            - max_bytes: int, maximum total size of the .npz files in cache_dir
+    """
+
+    def __init__(self, cache_dir='out/cache/hamiltonians', max_bytes=100 * 1024**2):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._memo = {}
+
+    @staticmethod
+    def make_key(geometry, basis_set, charge, spin, active_orb, n_elec, mapper):
+
+        """
+        Returns the hash identifying a reduced problem
+            Args:
+                - geometry: str, geometry string of the molecule
+                - basis_set: str, name of the basis set
+                - charge: int, charge of the molecule
+                - spin: int, spin of the molecule (2S)
+                - active_orb: int, number of active orbitals
+                - n_elec: int, number of active electrons
+                - mapper: qiskit_nature.second_q.mappers instance
+            Returns:
+                - key: str, sha256 hex digest
+        """
+
+        content = json.dumps({
+            'geometry': normalize_geometry(geometry),
+            'basis_set': basis_set.lower(),
+            'charge': charge,
+            'spin': spin,
+            'active_orb': active_orb,
+            'n_elec': n_elec,
+            'mapper': mapper_key(mapper),
+        }, sort_keys=True)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def get(self, key):
+
+        """
+        Returns the record stored under key, or None if there is none
+            Args:
+                - key: str, key returned by make_key
+            Returns:
+                - record: dict or None, see put for the content
+        """
+
+        if key in self._memo:
+            self.hits += 1
+            return self._memo[key]
+
+        if self.cache_dir is not None and os.path.exists(self._path(key)):
+            try:
+                with np.load(self._path(key)) as data:
+                    record = _unpack_record(data)
+            except (OSError, ValueError, KeyError):
+                # Corrupted or incompatible file, recomputed by the caller
+                record = None
+            if record is not None:
+                os.utime(self._path(key))  # marks the entry as recently used for the eviction
+                self._memo[key] = record
+                self.hits += 1
+                return record
+
+        self.misses += 1
+        return None
+
+    def put(self, key, record):
+
+        """
+        Stores a record in memory and on disk
+            Args:
+                - key: str, key returned by make_key
+                - record: dict, with keys
+                    'hamiltonian': qiskit.quantum_info.SparsePauliOp, electronic qubit Hamiltonian
+                    'nuclear_repulsion': float, nuclear repulsion energy
+                    'core_energy': float, energy of the frozen core electrons
+                    'num_spatial_orbitals': int, number of active spatial orbitals
+                    'num_particles': tuple, number of active (alpha, beta) electrons
+                    'hf_occupation': np.ndarray of bool, Hartree-Fock occupation of the spin orbitals
+                    'fci_energy': float, FCI energy in the active space, np.nan if not computed
+        """
+
+        self._memo[key] = record
+        if self.cache_dir is None:
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self._path(key) + f'.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **_pack_record(record))
+        os.replace(tmp_path, self._path(key))  # atomic, so concurrent readers never see partial files
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:  # evicted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self):
+
+        """
+        Returns the hit/miss counters of the cache
+            Returns:
+                - stats: dict, with keys 'hits', 'misses', 'memoized'
+        """
+
+        return {'hits': self.hits, 'misses': self.misses, 'memoized': len(self._memo)}
+
+    def clear(self, disk=False):
+
+        """
+        Empties the in-process memo and, if disk is True, deletes the on-disk entries
+            Args:
+                - disk: bool, whether to also delete the .npz files in cache_dir
+        """
+
+        self._memo.clear()
+        if disk and self.cache_dir is not None and os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.npz'):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+
+def _pack_record(record):
+    hamiltonian = record['hamiltonian']
+    return {
+        'num_qubits': np.array(hamiltonian.num_qubits),
+        'z': np.packbits(hamiltonian.paulis.z, axis=1),
+        'x': np.packbits(hamiltonian.paulis.x, axis=1),
+        'phase': hamiltonian.paulis.phase,
+        'coeffs': hamiltonian.coeffs,
+        'nuclear_repulsion': np.array(record['nuclear_repulsion']),
+        'core_energy': np.array(record['core_energy']),
+        'num_spatial_orbitals': np.array(record['num_spatial_orbitals']),
+        'num_particles': np.array(record['num_particles']),
+        'hf_occupation': np.asarray(record['hf_occupation'], dtype=bool),
+        'fci_energy': np.array(record['fci_energy']),
+    }
+
+
+def _unpack_record(data):
+    num_qubits = int(data['num_qubits'])
+    z = np.unpackbits(data['z'], axis=1, count=num_qubits).astype(bool)
+    x = np.unpackbits(data['x'], axis=1, count=num_qubits).astype(bool)
+    paulis = PauliList.from_symplectic(z, x, data['phase'])
+    return {
+        'hamiltonian': SparsePauliOp(paulis, data['coeffs']),
+        'nuclear_repulsion': float(data['nuclear_repulsion']),
+        'core_energy': float(data['core_energy']),
+        'num_spatial_orbitals': int(data['num_spatial_orbitals']),
+        'num_particles': tuple(int(n) for n in data['num_particles']),
+        'hf_occupation': data['hf_occupation'],
+        'fci_energy': float(data['fci_energy']),
+    }
+
+
+def circuit_fingerprint(circuit):
+
+    """
+    Returns a hash of the structure of a (parametrized) circuit: the gates, the qubits they act on,
+    their parameter expressions (by parameter name), and the operators of the Pauli evolutions.
+    Two ansatz circuits built separately with the same structure (e.g. UCCSD of the same active space
+    at different bond lengths) have the same fingerprint.
+        Args:
+            - circuit: qiskit.circuit.QuantumCircuit
+        Returns:
+            - fingerprint: str, sha256 hex digest
+    """
+
+    digest = hashlib.sha256()
+    digest.update(repr((circuit.num_qubits, circuit.num_clbits)).encode())
+    _hash_circuit(digest, circuit)
+    return digest.hexdigest()
+
+
+def _hash_circuit(digest, circuit):
+    for instruction in circuit.data:
+        operation = instruction.operation
+        qubits = [circuit.find_bit(qubit).index for qubit in instruction.qubits]
+        clbits = [circuit.find_bit(clbit).index for clbit in instruction.clbits]
+        digest.update(repr((operation.name, qubits, clbits, [str(p) for p in operation.params])).encode())
+
+        operator = getattr(operation, 'operator', None)  # PauliEvolutionGate
+        if operator is not None:
+            for op in (operator if isinstance(operator, list) else [operator]):
+                digest.update(repr(op.paulis.to_labels()).encode())
+                digest.update(np.asarray(op.coeffs).tobytes())
+        elif operation.name not in _standard_gates and getattr(operation, 'definition', None) is not None:
+            _hash_circuit(digest, operation.definition)
+
+
+class TranspileCache:
+
+    """
+    Cache of transpiled (ISA) circuits, keyed on the structure of the parametrized circuit and on the
+    transpilation target and settings, so that the ansatz is transpiled once and reused for every bond
+    length and noise level. Circuits are memoized in the current process and, if cache_dir is set,
+    also stored as QPY files.
+        Args:
+            - cache_dir: str, folder of the on-disk cache; None to only memoize in memory
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._memo = {}
+
+    @staticmethod
+    def make_key(circuit, coupling_map, basis_gates, optimization_level, seed_transpiler):
+
+        """
+        Returns the hash identifying a transpilation
+            Args:
+                - circuit: qiskit.circuit.QuantumCircuit, the circuit to transpile
+                - coupling_map: qiskit.transpiler.CouplingMap or list of edges, or None
+                - basis_gates: list, of str, the target basis gates
+                - optimization_level: int, transpiler optimization level
+                - seed_transpiler: int, transpiler seed
+            Returns:
+                - key: str, sha256 hex digest
+        """
+
+        if coupling_map is not None:
+            edges = coupling_map.get_edges() if hasattr(coupling_map, 'get_edges') else coupling_map
+            coupling_map = sorted([int(a), int(b)] for a, b in edges)
+        content = json.dumps({
+            'circuit': circuit_fingerprint(circuit),
+            'coupling_map': coupling_map,
+            'basis_gates': sorted(basis_gates) if basis_gates is not None else None,
+            'optimization_level': optimization_level,
+            'seed_transpiler': seed_transpiler,
+            'qiskit': qiskit.__version__,
+        }, sort_keys=True)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.qpy')
+
+    def get_isa_circuit(
+            self,
+            circuit,
+            coupling_map,
+            basis_gates,
+            optimization_level=3,
+            seed_transpiler=0
+            ):
+
+        """
+        Returns the transpiled circuit, from the cache if available. The returned circuit is shared
+        between callers and must not be modified.
+            Args:
+                - see make_key
+            Returns:
+                - isa_circuit: qiskit.circuit.QuantumCircuit, the transpiled circuit
+        """
+
+        key = self.make_key(circuit, coupling_map, basis_gates, optimization_level, seed_transpiler)
+        if key in self._memo:
+            self.hits += 1
+            return self._memo[key]
+
+        if self.cache_dir is not None and os.path.exists(self._path(key)):
+            try:
+                with open(self._path(key), 'rb') as f:
+                    isa_circuit = qpy.load(f)[0]
+            except Exception:  # corrupted or incompatible file, transpiled again below
+                isa_circuit = None
+            if isa_circuit is not None:
+                self._memo[key] = isa_circuit
+                self.hits += 1
+                return isa_circuit
+
+        self.misses += 1
+        isa_circuit = transpile(circuit, coupling_map=coupling_map, basis_gates=basis_gates,
+                                optimization_level=optimization_level, seed_transpiler=seed_transpiler)
+        self._memo[key] = isa_circuit
+
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = self._path(key) + f'.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                qpy.dump(isa_circuit, f)
+            os.replace(tmp_path, self._path(key))
+
+        return isa_circuit
+
+    def stats(self):
+
+        """
+        Returns the hit/miss counters of the cache
+            Returns:
+                - stats: dict, with keys 'hits', 'misses', 'memoized'
+        """
+
+        return {'hits': self.hits, 'misses': self.misses, 'memoized': len(self._memo)}
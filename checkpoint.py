@@ -0,0 +1,226 @@
+import hashlib
+import json
+import os
+from itertools import islice
+import numpy as np
+from profiling import timed
+
+
+class OptimizerCheckpoint:
+
+    """
+    Periodic checkpoint of an SPSA optimization, from which an interrupted VQE run resumes on the
+    same trajectory. The checkpoint holds the iteration count, the current parameters, the calibrated
+    learning rates and perturbations of all the iterations, the state of the random generator of the
+    perturbations, the energy evaluations so far and, if given, the content of the SPSAHistory.
+        Args:
+            - path: str, path of the .npz checkpoint file
+            - every: int, number of iterations between two checkpoints
+            - history: optimizer.SPSAHistory instance filled by the callback of the optimizer, saved and restored
+            with the checkpoint
+    """
+
+    def __init__(self, path, every=10, history=None):
+        self.path = path
+        self.every = every
+        self.history = history
+
+    def load(self):
+
+        """
+        Returns the content of the checkpoint file, or None if there is none
+        """
+
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with np.load(self.path) as data:
+                state = {key: data[key] for key in data.files}
+        except (OSError, ValueError):
+            # Checkpoint written by an incompatible version, the run starts over
+            return None
+        state['k'] = int(state['k'])
+        state['rng_state'] = json.loads(str(state['rng_state']))
+        return state
+
+    def save(self, state):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + f'.{os.getpid()}.tmp'
+        with timed('checkpoint_io'):
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **dict(state, rng_state=json.dumps(state['rng_state'])))
+            os.replace(tmp_path, self.path)  # atomic, a crash while saving keeps the previous checkpoint
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def minimize(self, optimizer, fun, x0, energies, evaluated_params, log_energy):
+
+        """
+        Runs optimizer.minimize(fun, x0), resuming from the checkpoint if there is one, and saving a
+        checkpoint every self.every iterations. The calibration of the learning rate and perturbation is
+        done here (as SPSA would do it) so that the calibrated schedules can be saved.
+        A resumed run evaluates the energy at the current parameters once more before the next iteration
+        (as SPSA with blocking does at the start), otherwise it follows the same trajectory as the
+        uninterrupted run.
+            Args:
+                - optimizer: qiskit_algorithms.optimizers.SPSA instance, with blocking and a finite allowed_increase
+                - fun: callable, cost function
+                - x0: np.ndarray, initial parameters, ignored when resuming
+                - energies: list, energies evaluated so far by fun, saved with the checkpoint
+                - evaluated_params: list, parameters of these evaluations
+                - log_energy: callable, log_energy(energy, params) called for each evaluation restored from the
+                checkpoint, so that the caller gets the complete list of evaluations
+            Returns:
+                - result: qiskit_algorithms.optimizers.OptimizerResult, with nit counting the iterations of
+                the interrupted runs too
+        """
+
+        from qiskit_algorithms.optimizers.spsa import _validate_pert_and_learningrate
+        from qiskit_algorithms.utils import algorithm_globals
+
+        maxiter = optimizer.maxiter
+        state = self.load()
+        if state is None:
+            if optimizer.learning_rate is None and optimizer.perturbation is None:
+                get_eta, get_eps = optimizer.calibrate(fun, np.asarray(x0), max_evals_grouped=optimizer._max_evals_grouped)
+            else:
+                get_eta, get_eps = _validate_pert_and_learningrate(optimizer.perturbation, optimizer.learning_rate)
+            k = 0
+            x = np.asarray(x0, dtype=float)
+            learning_rates = np.array(list(islice(get_eta(), maxiter)), dtype=float)
+            perturbations = np.array(list(islice(get_eps(), maxiter)), dtype=float)
+        else:
+            k = state['k']
+            x = state['x']
+            learning_rates = state['learning_rates']
+            perturbations = state['perturbations']
+            algorithm_globals.random.bit_generator.state = state['rng_state']
+            for energy, params in zip(state['energies'], state['evaluated_params']):
+                log_energy(energy, params)
+            if self.history is not None:
+                self.history.restore(state['history_params'], state['history_values'])
+
+        def save():
+            history = self.history
+            self.save({
+                'k': k,
+                'x': x,
+                'learning_rates': learning_rates,
+                'perturbations': perturbations,
+                'rng_state': algorithm_globals.random.bit_generator.state,
+                'energies': np.array(energies, dtype=float),
+                'evaluated_params': np.array(evaluated_params, dtype=float),
+                'history_params': history.params if history else np.empty(0),
+                'history_values': history.values if history else np.empty(0),
+            })
+
+        user_callback = optimizer.callback
+
+        def callback(n_evals, params, fval, step_size, accepted):
+            nonlocal k, x
+            k += 1
+            if accepted:
+                x = np.copy(params)
+            if user_callback is not None:
+                user_callback(n_evals, params, fval, step_size, accepted)
+            if k % self.every == 0 or k == maxiter:
+                save()
+
+        if state is None:
+            save()  # the calibration is not redone on resume
+
+        saved_attributes = (optimizer.maxiter, optimizer.learning_rate, optimizer.perturbation, optimizer.callback)
+        optimizer.maxiter = maxiter - k
+        optimizer.learning_rate = learning_rates[k:]
+        optimizer.perturbation = perturbations[k:]
+        optimizer.callback = callback
+        try:
+            result = optimizer.minimize(fun=fun, x0=x)
+        finally:
+            optimizer.maxiter, optimizer.learning_rate, optimizer.perturbation, optimizer.callback = saved_attributes
+
+        result.nit = k
+        return result
+
+
+def task_key(task):
+
+    """
+    Returns the fields identifying a grid point of a sweep, independently of how it is run
+        Args:
+            - task: sweep.SweepTask instance
+        Returns:
+            - key: dict, JSON serializable
+    """
+
+    # Every field that changes the energies, e.g. the simulation method (density matrix or noise trajectories) and
+    # the memory budget from which it is planned, or the first step of the warm-started runs
+    fields = ('atomic_symbol', 'state_type', 'bond_length', 'n_shots', 'n_iters', 'dep_error', 'active_orbitals',
+              'n_elec', 'optimizer_name', 'regularization', 'seed', 'estimator_name', 'convergence_tol', 'convergence_window',
+              'topology', 'n_starts', 'symmetry_reduction', 'simulation_method', 'memory_budget', 'warm_start_magnitude')
+    return {field: getattr(task, field) for field in fields}
+
+
+def task_checkpoint_path(checkpoint_dir, task):
+
+    """
+    Returns the path of the optimizer checkpoint of a grid point
+    """
+
+    digest = hashlib.sha256(json.dumps(task_key(task), sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(checkpoint_dir, f'{digest}.npz')
+
+
+class SweepManifest:
+
+    """
+    Append-only JSON lines file recording the completed grid points of sweeps and their results, so that
+    a rerun of an interrupted sweep skips them. Each line is written and synced at once, so a crash
+    loses at most the grid point being recorded.
+        Args:
+            - path: str, path of the .jsonl manifest
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+
+        """
+        Returns the recorded results
+            Returns:
+                - completed: dict, with keys the JSON dumps of task_key and values the result dicts
+        """
+
+        completed = {}
+        if not os.path.exists(self.path):
+            return completed
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # line truncated by a crash
+                completed[json.dumps(entry['task'], sort_keys=True)] = entry['result']
+        return completed
+
+    def get(self, completed, task):
+        return completed.get(json.dumps(task_key(task), sort_keys=True))
+
+    def record(self, task, result):
+
+        """
+        Appends a completed grid point to the manifest
+            Args:
+                - task: sweep.SweepTask instance
+                - result: dict, returned by sweep.run_sweep_task
+        """
+
+        result = dict(result, energies=[float(energy) for energy in result['energies']])
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'task': task_key(task), 'result': result}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
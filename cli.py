@@ -0,0 +1,189 @@
+import argparse
+
+### Command line interface of the project. Only argparse is loaded at startup; the simulation, chemistry and
+### plotting modules are imported by the command that needs them, so that e.g. --help or listing the runs of
+### a results store do not pay the import of Qiskit and PySCF.
+### Examples:
+###     python cli.py run LiH UCCSD --bond-lengths 1.0 1.595 2.0 --dep-errors 0 1 --workers 4
+###     python cli.py fci LiH --bond-lengths 1.0 1.595 2.0
+###     python cli.py runs out/store/LiH_UCCSD
+###     python cli.py submit sweeps/queue.db LiH UCCSD --bond-lengths 1.0 1.595 2.0   (then: worker, reduce, status)
+
+
+def run(args):
+    from run import run_vqe_simulation
+
+    run_vqe_simulation(
+        atomic_symbol=args.atomic_symbol,
+        state_type=args.state_type,
+        bond_lengths=args.bond_lengths,
+        n_shots_list=args.shots,
+        n_iters_list=args.iters,
+        depolarizing_errors=args.dep_errors,
+        active_orbitals=args.active_orbitals,
+        n_elec=args.n_elec,
+        optimizer_name=args.optimizer,
+        filename=args.filename or f'{args.atomic_symbol}_{args.state_type}_results.txt',
+        n_workers=args.workers,
+        seed=args.seed,
+        estimator_name=args.estimator,
+        results_store=args.results_store,
+        checkpoint_dir=args.checkpoint_dir,
+        pes_scan=args.pes_scan,
+        topology=args.topology,
+        simulation_method=args.simulation_method,
+        memory_budget=_memory_budget(args),
+        symmetry_reduction=args.symmetry_reduction,
+        n_starts=args.starts,
+        coalesce=args.coalesce,
+        coalesce_batch_size=args.coalesce_batch_size,
+        profile_dir=args.profile_dir,
+    )
+
+
+def fci(args):
+    from state_and_hamiltonian import get_fci_energy
+
+    for bond_length in args.bond_lengths:
+        energy = get_fci_energy(args.atomic_symbol, active_orb=args.active_orbitals, n_elec=args.n_elec, bond_length=bond_length)
+        print(f"{bond_length:<12} {energy:.10f}")
+
+
+def runs(args):
+    from results_store import ResultStore
+
+    store = ResultStore(args.store_dir)
+    for run_id in store.runs():
+        energies = store.energies(run_id)
+        print(f"{run_id}  {len(energies)} evaluations, last energy {energies[-1]:.6f}")
+
+
+def submit(args):
+    from sweep import make_sweep_tasks
+    from work_queue import WorkQueue
+
+    tasks = make_sweep_tasks(
+        args.atomic_symbol, args.state_type, args.bond_lengths, args.shots, args.iters, args.dep_errors,
+        args.active_orbitals, args.n_elec, optimizer_name=args.optimizer, seed=args.seed,
+        estimator_name=args.estimator, results_store=args.results_store, checkpoint_dir=args.checkpoint_dir,
+        topology=args.topology, simulation_method=args.simulation_method, memory_budget=_memory_budget(args),
+        symmetry_reduction=args.symmetry_reduction, n_starts=args.starts
+    )
+    sweep = args.sweep or f'{args.atomic_symbol}_{args.state_type}_results'
+    n_added = WorkQueue(args.queue).submit(sweep, tasks)
+    print(f"{sweep}: {n_added} grid points added, {len(tasks) - n_added} already submitted")
+
+
+def worker(args):
+    from work_queue import run_worker
+
+    n_done = run_worker(args.queue, shard_dir=args.shard_dir, lease_seconds=args.lease,
+                        poll_interval=args.poll_interval, max_tasks=args.max_tasks)
+    print(f"{n_done} grid points done")
+
+
+def reduce(args):
+    from work_queue import reduce_sweep
+
+    results = reduce_sweep(args.queue, args.sweep, shard_dir=args.shard_dir, filename=args.filename,
+                           allow_partial=args.partial)
+    print(f"{sum(len(entry['bond_lengths']) for entry in results.values())} grid points written to "
+          f"out/results/{args.filename or args.sweep + '.txt'}")
+
+
+def status(args):
+    from work_queue import WorkQueue
+
+    queue = WorkQueue(args.queue)
+    for sweep in queue.sweeps():
+        counts = queue.counts(sweep)
+        print(f"{sweep}  " + ', '.join(f"{count} {state}" for state, count in counts.items()))
+
+
+def _add_grid_arguments(parser):
+    # Arguments defining the grid points of a sweep, shared by the run and submit commands
+    parser.add_argument('atomic_symbol', choices=['H2', 'LiH'])
+    parser.add_argument('state_type', choices=['UCCSD', 'EfficientSU2', 'ADAPT'])
+    parser.add_argument('--bond-lengths', type=float, nargs='+', required=True)
+    parser.add_argument('--shots', type=int, nargs='+', default=[0])
+    parser.add_argument('--iters', type=int, nargs='+', default=[100])
+    parser.add_argument('--dep-errors', type=float, nargs='+', default=[0, 1])
+    parser.add_argument('--active-orbitals', type=int, default=2)
+    parser.add_argument('--n-elec', type=int, default=2)
+    parser.add_argument('--optimizer', default='spsa')
+    parser.add_argument('--estimator', default='noisy')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--results-store')
+    parser.add_argument('--checkpoint-dir')
+    parser.add_argument('--topology', default='heavy_hex')
+    parser.add_argument('--symmetry-reduction', choices=['parity', 'tapered'],
+                        help='reduce the number of qubits with the parity mapping and the Z2 symmetries')
+    parser.add_argument('--starts', type=int, default=1, help='number of initial points per grid point')
+    parser.add_argument('--simulation-method', default='plan',
+                        help="Aer simulation method, or 'plan' to select it from its estimated memory and time")
+    parser.add_argument('--memory-budget', type=float,
+                        help='memory in GB available to the simulation of each grid point, for --simulation-method plan')
+
+
+def _memory_budget(args):
+    return None if args.memory_budget is None else args.memory_budget * 2 ** 30
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='VQE simulations of H2 and LiH with UCCSD and EfficientSU2')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run a VQE sweep, see run_vqe_simulation in run.py')
+    _add_grid_arguments(run_parser)
+    run_parser.add_argument('--filename', help='name of the results .txt file in out/results/')
+    run_parser.add_argument('--workers', type=int, default=1)
+    run_parser.add_argument('--pes-scan', action='store_true')
+    run_parser.add_argument('--coalesce', action='store_true',
+                            help='run the grid points of each worker together, with their estimator calls coalesced')
+    run_parser.add_argument('--coalesce-batch-size', type=int, default=64)
+    run_parser.add_argument('--profile-dir')
+    run_parser.set_defaults(function=run)
+
+    fci_parser = commands.add_parser('fci', help='print the FCI energies in the active space')
+    fci_parser.add_argument('atomic_symbol', choices=['H2', 'LiH'])
+    fci_parser.add_argument('--bond-lengths', type=float, nargs='+', required=True)
+    fci_parser.add_argument('--active-orbitals', type=int, default=2)
+    fci_parser.add_argument('--n-elec', type=int, default=2)
+    fci_parser.set_defaults(function=fci)
+
+    submit_parser = commands.add_parser('submit', help='add the grid points of a sweep to a work queue, see work_queue.py')
+    submit_parser.add_argument('queue', help='path of the SQLite work queue, on a folder shared by the workers')
+    _add_grid_arguments(submit_parser)
+    submit_parser.add_argument('--sweep', help='name of the sweep, by default {atomic_symbol}_{state_type}_results')
+    submit_parser.set_defaults(function=submit)
+
+    worker_parser = commands.add_parser('worker', help='run the grid points of a work queue until it is empty')
+    worker_parser.add_argument('queue')
+    worker_parser.add_argument('--shard-dir', help='folder of the result shards, by default shards/ next to the queue')
+    worker_parser.add_argument('--lease', type=float, default=600, help='lease duration in seconds')
+    worker_parser.add_argument('--poll-interval', type=float, default=10)
+    worker_parser.add_argument('--max-tasks', type=int)
+    worker_parser.set_defaults(function=worker)
+
+    reduce_parser = commands.add_parser('reduce', help='write the results file of a sweep from its result shards')
+    reduce_parser.add_argument('queue')
+    reduce_parser.add_argument('sweep')
+    reduce_parser.add_argument('--shard-dir')
+    reduce_parser.add_argument('--filename', help='name of the results .txt file in out/results/, by default {sweep}.txt')
+    reduce_parser.add_argument('--partial', action='store_true', help='only the grid points done so far')
+    reduce_parser.set_defaults(function=reduce)
+
+    status_parser = commands.add_parser('status', help='print the number of grid points per status of each sweep')
+    status_parser.add_argument('queue')
+    status_parser.set_defaults(function=status)
+
+    runs_parser = commands.add_parser('runs', help='list the runs of a results store')
+    runs_parser.add_argument('store_dir')
+    runs_parser.set_defaults(function=runs)
+
+    args = parser.parse_args(argv)
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
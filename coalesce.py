@@ -0,0 +1,261 @@
+import asyncio
+import contextvars
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from qiskit.primitives import PrimitiveResult, PubResult
+from qiskit.primitives.containers import DataBin
+from qiskit.primitives.containers.estimator_pub import EstimatorPub
+from qiskit_algorithms.utils import algorithm_globals
+
+
+# Runs whose estimator calls are coalesced: each run (e.g. one VQE optimization) is a coroutine of an
+# EvaluationCoalescer, executed in its own thread but one at a time, handing over to the next run whenever
+# it waits for an energy. A dispatcher gathers the PUBs of the waiting runs and sends them to the estimator
+# as one job per tick, the PUBs of the same circuit being merged into a single PUB (one Aer run over all
+# their parameter values, see _merge_pubs).
+# Example:
+#     coalescer = EvaluationCoalescer(max_batch_size=64)
+#     results = coalescer.run([partial(run_sweep_task, task) for task in tasks])
+# where run_sweep_task passes its estimator through coalesced().
+
+
+# (coalescer, run index) of the run of the current thread, None outside of EvaluationCoalescer.run
+_current_run = contextvars.ContextVar('current_run', default=None)
+
+
+def coalesced(estimator, key=None):
+
+    """
+    Returns the estimator through which the calls of the current run are coalesced with those of the other runs
+    of EvaluationCoalescer.run, or the estimator itself outside of such a run
+        Args:
+            - estimator: EstimatorV2 instance
+            - key: hashable, identifies the estimators whose PUBs are run in one job, e.g. their settings when each
+            run builds its own estimator; None for the estimator instance itself
+        Returns:
+            - estimator: CoalescedEstimator instance, or the given estimator
+    """
+
+    current = _current_run.get()
+    if current is None:
+        return estimator
+    coalescer, run = current
+    return CoalescedEstimator(coalescer, run, estimator, id(estimator) if key is None else key)
+
+
+class CoalescedEstimator:
+
+    """
+    EstimatorV2 interface of a run of an EvaluationCoalescer. The result of a job is obtained by queuing its PUBs
+    in the dispatcher and handing over to the other runs until the job is done.
+        Args:
+            - coalescer: EvaluationCoalescer instance
+            - run: int, index of the run
+            - target_estimator: EstimatorV2 instance running the PUBs (see estimator.get_transpile_target)
+            - key: hashable, see coalesced
+    """
+
+    def __init__(self, coalescer, run, target_estimator, key):
+        self.coalescer = coalescer
+        self.run_index = run
+        self.target_estimator = target_estimator
+        self.key = key
+
+    def run(self, pubs, *, precision=None):
+        return _CoalescedJob(self, [EstimatorPub.coerce(pub, precision) for pub in pubs])
+
+
+class _CoalescedJob:
+
+    def __init__(self, estimator, pubs):
+        self.estimator = estimator
+        self.pubs = pubs
+        self._result = None
+
+    def result(self):
+        if self._result is None:
+            coalescer = self.estimator.coalescer
+            future = asyncio.run_coroutine_threadsafe(coalescer._evaluate(self.estimator, self.pubs), coalescer._loop)
+            self._result = future.result()
+        return self._result
+
+
+class EvaluationCoalescer:
+
+    """
+    Runs functions (e.g. VQE optimizations) as coroutines whose estimator calls are coalesced: each function runs in
+    its own thread, but only one at a time, until it waits for the result of an estimator job (through an estimator
+    returned by coalesced); the next run then takes over. The PUBs of the waiting runs are sent in one job per
+    estimator when no run is left to take over, when they reach max_batch_size, or when the oldest one has waited
+    max_latency seconds. The runs take over in a fixed order and the random generator of qiskit_algorithms (SPSA
+    perturbations) is saved and restored at each handover, so that with exact estimators (no shot noise) each run
+    gives the same results as when run alone.
+        Args:
+            - max_batch_size: int, number of PUBs (parameter sets) from which the waiting PUBs are dispatched
+            - max_latency: float, time in seconds after which the waiting PUBs are dispatched, even if other runs
+            could still take over (e.g. runs spending time in the transpiler)
+    """
+
+    def __init__(self, max_batch_size=64, max_latency=0.005):
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.n_jobs = 0
+        self.n_requests = 0
+
+    def run(self, functions):
+
+        """
+        Runs the functions until they all return
+            Args:
+                - functions: list, of callables without arguments, e.g. functools.partial(run_sweep_task, task)
+            Returns:
+                - results: list, of the values returned by the functions, in order; if a function raises, the
+                others still run to the end and its exception is then raised
+        """
+
+        return asyncio.run(self._run_all(functions))
+
+    async def _run_all(self, functions):
+        self._loop = asyncio.get_running_loop()
+        self._ready = deque()       # (run, future) of the runs waiting to take over, in order
+        self._pending = []          # (estimator, pubs, future) of the runs waiting for an energy
+        self._pending_since = None
+        self._running = None        # run executing
+        self._rng_states = {}       # state of the qiskit_algorithms random generator of each run not executing
+        with ThreadPoolExecutor(max_workers=max(len(functions), 1)) as executor:
+            outcomes = await asyncio.gather(*[self._run_function(run, function, executor)
+                                              for run, function in enumerate(functions)], return_exceptions=True)
+        for outcome in outcomes:
+            if isinstance(outcome, BaseException):
+                raise outcome
+        return outcomes
+
+    async def _run_function(self, run, function, executor):
+        await self._take_over(run)
+        context = contextvars.copy_context()
+        context.run(_current_run.set, (self, run))
+        try:
+            return await self._loop.run_in_executor(executor, context.run, function)
+        finally:
+            self._hand_over(run, save_rng=False)
+
+    async def _evaluate(self, estimator, pubs):
+        future = self._loop.create_future()
+        self._pending.append((estimator, pubs, future))
+        self.n_requests += 1
+        if self._pending_since is None:
+            self._pending_since = time.perf_counter()
+        self._hand_over(estimator.run_index)
+        results = await future
+        await self._take_over(estimator.run_index)
+        return results
+
+    async def _take_over(self, run):
+        future = self._loop.create_future()
+        self._ready.append((run, future))
+        if self._running is None:
+            self._next()
+        await future
+
+    def _hand_over(self, run, save_rng=True):
+        if save_rng:
+            self._rng_states[run] = algorithm_globals.random.bit_generator.state
+        self._running = None
+        self._next()
+
+    def _next(self):
+        # Called when no run is executing: dispatches the waiting PUBs if needed, then lets the next run take over
+        n_pending = sum(pub.size for _, pubs, _ in self._pending for pub in pubs)
+        if self._pending and (not self._ready or n_pending >= self.max_batch_size
+                              or time.perf_counter() - self._pending_since >= self.max_latency):
+            self._dispatch()
+        if self._ready:
+            run, future = self._ready.popleft()
+            if run in self._rng_states:
+                algorithm_globals.random.bit_generator.state = self._rng_states.pop(run)
+            self._running = run
+            future.set_result(None)
+
+    def _dispatch(self):
+        pending, self._pending, self._pending_since = self._pending, [], None
+        jobs = {}
+        for request in pending:
+            estimator, pubs, _ = request
+            jobs.setdefault(estimator.key, (estimator.target_estimator, []))[1].append(request)
+
+        for target_estimator, requests in jobs.values():
+            try:
+                # PUBs of the same circuit and precision are merged; the other ones are run in the same job
+                groups = {}
+                for i, (_, pubs, _) in enumerate(requests):
+                    for j, pub in enumerate(pubs):
+                        groups.setdefault((id(pub.circuit), pub.precision), []).append((i, j, pub))
+                merged = [_merge_pubs([pub for _, _, pub in group]) for group in groups.values()]
+                job_results = target_estimator.run(merged).result()
+                self.n_jobs += 1
+
+                results = [[None] * len(pubs) for _, pubs, _ in requests]
+                for group, job_result in zip(groups.values(), job_results):
+                    for (i, j, _), pub_result in zip(group, _split_result(job_result, [pub for _, _, pub in group])):
+                        results[i][j] = pub_result
+                for (_, _, future), pub_results in zip(requests, results):
+                    future.set_result(PrimitiveResult(pub_results, metadata=job_results.metadata))
+            except Exception as error:
+                for _, _, future in requests:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def stats(self):
+
+        """
+        Returns the number of estimator calls of the runs and of jobs sent to the estimators
+            Returns:
+                - stats: dict, with keys 'requests', 'jobs' and 'requests_per_job'
+        """
+
+        return {'requests': self.n_requests, 'jobs': self.n_jobs,
+                'requests_per_job': self.n_requests / self.n_jobs if self.n_jobs else 0.0}
+
+
+def _merge_pubs(pubs):
+
+    """
+    Returns one PUB evaluating the PUBs of the same circuit: their observables and parameter values are broadcast
+    to the shape of each PUB, flattened and concatenated, so that the estimator evaluates them elementwise
+    """
+
+    if len(pubs) == 1:
+        return pubs[0]
+    observables, parameter_values = [], []
+    for pub in pubs:
+        indices = np.broadcast_to(np.arange(pub.observables.size).reshape(pub.observables.shape), pub.shape).ravel()
+        flat_observables = pub.observables.ravel().tolist()
+        observables.extend(flat_observables[i] for i in indices)
+        values = pub.parameter_values.as_array(pub.circuit.parameters)
+        parameter_values.append(np.broadcast_to(values, pub.shape + values.shape[-1:]).reshape(-1, values.shape[-1]))
+    parameter_values = np.concatenate(parameter_values)
+    if parameter_values.shape[1] == 0:
+        return EstimatorPub.coerce((pubs[0].circuit, observables), pubs[0].precision)
+    return EstimatorPub.coerce((pubs[0].circuit, observables, parameter_values), pubs[0].precision)
+
+
+def _split_result(pub_result, pubs):
+
+    """
+    Returns the results of the PUBs merged by _merge_pubs, from the result of the merged PUB
+    """
+
+    if len(pubs) == 1:
+        return [pub_result]
+    evs = np.ravel(pub_result.data.evs)
+    stds = np.ravel(pub_result.data.stds)
+    results = []
+    start = 0
+    for pub in pubs:
+        stop = start + pub.size
+        data = DataBin(evs=evs[start:stop].reshape(pub.shape), stds=stds[start:stop].reshape(pub.shape), shape=pub.shape)
+        results.append(PubResult(data, metadata=pub_result.metadata))
+        start = stop
+    return results
@@ -1,7 +1,138 @@
 from qiskit_aer import AerSimulator
+from qiskit.transpiler import CouplingMap
 from qiskit_aer.noise import NoiseModel, depolarizing_error
 from qiskit_aer.primitives import EstimatorV2
 from qiskit.primitives import StatevectorEstimator
+from native_estimator import NumpyEstimator
+from sampling_estimator import SamplingEstimator
+
+
+basis_gates = ['id', 'rz', 'sx', 'x', 'cx']
+noisy_gates_1q = ["u1", "u2", "u3", "rz", "sx", "x"]    # gates followed by a single-qubit depolarizing error
+noisy_gates_2q = ["cx"]                                 # gates followed by a two-qubit depolarizing error
+
+
+# Coupling maps of the 4- and 6-qubit systems used since the start of the project, kept as their
+# 'heavy_hex' maps so that earlier results can be reproduced
+_legacy_coupling_maps = {
+    6: [[0, 1], [1, 0], [1, 2], [2, 1], [2, 3], [3, 2], [3, 4], [4, 3], [4, 5], [5, 4], [5, 0], [0, 5]],
+    4: [[0, 1], [1, 0], [1, 2], [2, 1], [2, 3], [3, 2], [2, 0], [0, 2]],
+}
+
+# Simulator backends and Aer estimators shared by all the runs of the process (see get_backend)
+_backend_pool = {}
+_estimator_pool = {}
+
+
+def make_coupling_map(nqubits, topology='heavy_hex'):
+
+    """
+    Returns the qubit connectivity of a device of nqubits qubits
+        Args:
+            - nqubits: int, number of qubits
+            - topology: str, either 'heavy_hex' (the project maps for 4 and 6 qubits, otherwise the nqubits
+            qubits of a heavy-hex lattice closest to qubit 0), 'ring', 'linear' or 'all_to_all'
+        Returns:
+            - coupling_map: list, of [i, j] edges in both directions; None (no connectivity constraint) for
+            'all_to_all' and for a single qubit, whose empty edge list the transpiler would read as a 0-qubit device
+    """
+
+    if topology == 'all_to_all' or nqubits < 2:
+        return None
+    if topology == 'linear' or (topology == 'ring' and nqubits < 3):
+        edges = [(i, i + 1) for i in range(nqubits - 1)]
+    elif topology == 'ring':
+        edges = [(i, (i + 1) % nqubits) for i in range(nqubits)]
+    elif topology == 'heavy_hex':
+        if nqubits in _legacy_coupling_maps:
+            return [list(edge) for edge in _legacy_coupling_maps[nqubits]]
+        distance = 3
+        while (5 * distance ** 2 - 2 * distance - 1) // 2 < nqubits:
+            distance += 2
+        lattice = CouplingMap.from_heavy_hex(distance, bidirectional=False)
+        # Breadth-first search from qubit 0, so that the selected qubits are connected
+        order = [0]
+        for qubit in order:
+            for neighbor in sorted(lattice.neighbors(qubit)) + sorted(lattice.graph.predecessor_indices(qubit)):
+                if neighbor not in order and len(order) < nqubits:
+                    order.append(neighbor)
+        labels = {qubit: i for i, qubit in enumerate(order)}
+        edges = sorted({tuple(sorted((labels[a], labels[b]))) for a, b in lattice.get_edges() if a in labels and b in labels})
+    else:
+        raise ValueError("Topology not supported; must be 'heavy_hex', 'ring', 'linear' or 'all_to_all'")
+    return [list(edge) for a, b in edges for edge in ((a, b), (b, a))]
+
+
+def get_noisy_basis_gates():
+
+    """
+    Returns the basis gates of the noisy simulators: those of the noise model, which adds the u1, u2 and u3 gates
+    to basis_gates, so that the native estimator transpiles the circuits as the Aer backend does
+    """
+
+    return NoiseModel(basis_gates=basis_gates).basis_gates
+
+
+def get_backend(
+        nqubits: int = 6,
+        p_err_1q: float = 0.001,
+        p_err_2q: float = 0.02,
+        topology: str = 'heavy_hex',
+        method: str = 'automatic',
+        max_parallel_threads: int = 0,
+        fusion_enable: bool = True,
+        fusion_threshold: int = 14,
+        max_memory_mb: int = 0
+        ):
+
+    """
+    Returns the noisy AerSimulator of the given settings, built once per process and then taken from a pool
+        Args:
+            - nqubits: int, number of qubits of the system
+            - p_err_1q: float, single-qubit depolarizing error probability
+            - p_err_2q: float, two-qubit depolarizing error probability
+            - topology: str, qubit connectivity, see make_coupling_map
+            - method: str, Aer simulation method, e.g. 'automatic', 'statevector', 'density_matrix'
+            - max_parallel_threads: int, max number of threads used by the Aer simulator (0 for all the cores)
+            - fusion_enable: bool, whether Aer fuses consecutive gates
+            - fusion_threshold: int, number of qubits from which Aer fuses gates
+            - max_memory_mb: int, memory Aer may use, e.g. limiting its parallel trajectories; 0 for the system memory
+        Returns:
+            - backend: qiskit_aer.AerSimulator instance, shared between callers and not to be modified
+    """
+
+    key = (nqubits, p_err_1q, p_err_2q, topology, method, max_parallel_threads, fusion_enable, fusion_threshold, max_memory_mb)
+    if key not in _backend_pool:
+        # Define Noise Model
+        noise_model = NoiseModel(basis_gates=basis_gates)
+
+        # Add errors (Depolarizing noise on single and 2-qubit gates)
+        noise_model.add_all_qubit_quantum_error(depolarizing_error(p_err_1q, 1), noisy_gates_1q)
+        noise_model.add_all_qubit_quantum_error(depolarizing_error(p_err_2q, 2), noisy_gates_2q)
+
+        # Instantiate the simulator backend
+        # We pass the noise model directly to the backend class.
+        _backend_pool[key] = AerSimulator(
+            noise_model=noise_model,
+            coupling_map=make_coupling_map(nqubits, topology),
+            basis_gates=get_noisy_basis_gates(),
+            method=method,
+            max_parallel_threads=max_parallel_threads,
+            fusion_enable=fusion_enable,
+            fusion_threshold=fusion_threshold,
+            max_memory_mb=max_memory_mb
+        )
+    return _backend_pool[key]
+
+
+def clear_estimator_pool():
+
+    """
+    Empties the pools of backends and estimators, e.g. to release their memory
+    """
+
+    _backend_pool.clear()
+    _estimator_pool.clear()
 
 
 def get_estimator(
@@ -9,71 +140,121 @@ def get_estimator(
         estimator_name: str = 'noisy',
         n_shots: int = 0, # Not useful in this project, see note about it below
         p_err_1q: float = 0.001,
-        p_err_2q: float = 0.02
+        p_err_2q: float = 0.02,
+        max_parallel_threads: int = 0,
+        topology: str = 'heavy_hex',
+        method: str = 'automatic',
+        fusion_enable: bool = True,
+        fusion_threshold: int = 14,
+        trajectories: int = 0,
+        max_memory_mb: int = 0
         ):
 
     """
-    Returns a qiskit Estimator instance
+    Returns a qiskit Estimator instance. The Aer backends and estimators are pooled per process, so that
+    the grid points of a sweep sharing the same settings do not build them again.
         Args:
             - nqubits: int, number of qubits of the system
             - estimator_name: str, name of the type of qiskit Estimator; either "noiseless" for the exact 
-                StatevectorEstimator or "noisy" for the noisy AerEstimator
+                StatevectorEstimator, "noisy" for the noisy AerEstimator, "native" for the NumpyEstimator
+                (statevector if both error probabilities are 0, density matrix with the same depolarizing
+                noise as "noisy" otherwise), or "sampling" for the SamplingEstimator, which estimates the
+                energy from n_shots measurement samples (of the noisy Aer simulator if an error probability
+                is > 0, of the exact statevector otherwise)
+            - n_shots: int, number of shots; for "sampling", the total number of shots per energy evaluation,
+                shared between the groups of commuting Pauli terms
             - p_err_1q: float, single-qubit depolarizing error probability
             - p_err_2q: float, two-qubit depolarizing error probability
+            - max_parallel_threads: int, max number of threads used by the Aer simulator (0 for all the cores);
+                set it when several simulations run in parallel processes to avoid oversubscribing the cores
+            - topology: str, qubit connectivity of the noisy device, see make_coupling_map
+            - method: str, Aer simulation method, e.g. 'automatic', 'statevector', 'density_matrix'
+            - fusion_enable: bool, whether Aer fuses consecutive gates
+            - fusion_threshold: int, number of qubits from which Aer fuses gates
+            - trajectories: int, for "noisy", number of noise trajectories averaged per expectation value (statevector
+                or matrix_product_state methods, see simulation_plan.py), the Gaussian shot noise being then left out;
+                0 for exact expectation values
+            - max_memory_mb: int, memory the Aer simulator may use; 0 for the system memory
         Returns:
-            - estimator: qiskit.primitives.EstimatorV2 or qiskit_aer.primitives.StatevectorEstimator instance
+            - estimator: qiskit.primitives.EstimatorV2 or qiskit_aer.primitives.StatevectorEstimator or
+                native_estimator.NumpyEstimator or sampling_estimator.SamplingEstimator instance
     """
 
-    if estimator_name == 'noiseless':
-        estimator = StatevectorEstimator()
+    precision = 1 / (n_shots ** 0.5) if n_shots > 0 else 0
 
-    elif estimator_name == 'noisy':
+    if estimator_name == 'noiseless':
+        # Exact statevector simulation of the untranspiled circuit; shot noise is added the same way as for "noisy"
+        estimator = StatevectorEstimator(default_precision=precision, seed=0)
 
-        # Define Noise Model
-        noise_model = NoiseModel(basis_gates=['id', 'rz', 'sx', 'x', 'cx'])
+    elif estimator_name == 'sampling' and p_err_1q == 0 and p_err_2q == 0:
+        estimator = SamplingEstimator(shots=n_shots, seed=0)
 
-        # Add errors (Depolarizing noise on single and 2-qubit gates)
-        noise_model.add_all_qubit_quantum_error(depolarizing_error(p_err_1q, 1), ["u1", "u2", "u3", "rz", "sx", "x"])
-        noise_model.add_all_qubit_quantum_error(depolarizing_error(p_err_2q, 2), ["cx"])
-        
-        # Defines the qubit connectivity (here, Heavy-Hex) for 4 or 6 qubits
-        if nqubits == 6:
-            coupling_map = [
-                [0, 1], [1, 0],
-                [1, 2], [2, 1],
-                [2, 3], [3, 2],
-                [3, 4], [4, 3],
-                [4, 5], [5, 4],
-                [5, 0], [0, 5]
-            ]
-        elif nqubits ==4:
-            coupling_map = [
-                [0, 1], [1, 0],
-                [1, 2], [2, 1],
-                [2, 3], [3, 2],
-                [2, 0], [0, 2]
-            ]
-        else:
-            raise ValueError("Number of qubits not supported; must be either 4 or 6")
-       
-        # Instantiate the simulator backend
-        # We pass the noise model directly to the backend class.
-        backend = AerSimulator(
-            noise_model=noise_model,
-            coupling_map=coupling_map,
-            basis_gates=noise_model.basis_gates
+    elif estimator_name == 'native':
+        # Not pooled: its random generator would otherwise make the results depend on the previous runs
+        estimator = NumpyEstimator(
+            p_err_1q=p_err_1q,
+            p_err_2q=p_err_2q,
+            gates_1q=noisy_gates_1q,
+            gates_2q=noisy_gates_2q,
+            coupling_map=make_coupling_map(nqubits, topology),
+            basis_gates=get_noisy_basis_gates(),
+            default_precision=precision,
+            seed=0
         )
 
-        # Create Estimator from the Backend
-        # This automatically configures the estimator to use the noisy backend.
-        estimator = EstimatorV2.from_backend(backend)
-
-        # Set shot noise via default_precision setting
-        # Note : here, shot noise is essentially set to 0 because the AerEstimator instance adds it
-        # as posterior Gaussian noise, which is ansatz-independent.
-        if n_shots > 0:
-            estimator.options.default_precision = 1 / (n_shots ** 0.5)  # Standard deviation of the Gaussian noise
-        else:
-            estimator.options.default_precision =  0
-        estimator.options.seed_simulator = 0
-    return estimator
\ No newline at end of file
+    elif estimator_name in ('noisy', 'sampling'):
+        backend = get_backend(nqubits, p_err_1q, p_err_2q, topology, method, max_parallel_threads,
+                              fusion_enable, fusion_threshold, max_memory_mb)
+
+        if estimator_name == 'sampling':
+            return SamplingEstimator(
+                shots=n_shots,
+                backend=backend,
+                coupling_map=backend.coupling_map,
+                basis_gates=backend._basis_gates(),
+                seed=0
+            )
+
+        if trajectories:
+            # The average over the trajectories has its own statistical error
+            precision = 0
+        key = (id(backend), precision, trajectories)
+        if key not in _estimator_pool:
+            # Create Estimator from the Backend
+            # This automatically configures the estimator to use the noisy backend.
+            estimator = EstimatorV2.from_backend(backend)
+
+            # Set shot noise via default_precision setting
+            # Note : here, shot noise is essentially set to 0 because the AerEstimator instance adds it
+            # as posterior Gaussian noise, which is ansatz-independent.
+            estimator.options.default_precision = precision  # Standard deviation of the Gaussian noise
+            estimator.options.seed_simulator = 0
+            if trajectories:
+                estimator.options.run_options = {'shots': trajectories}
+            _estimator_pool[key] = estimator
+        estimator = _estimator_pool[key]
+    else:
+        raise ValueError("Estimator not supported; must be 'noiseless', 'noisy', 'native' or 'sampling'")
+    return estimator
+
+def get_transpile_target(estimator):
+
+    """
+    Returns the coupling map and basis gates to which the circuits must be transpiled before being
+    run by the given estimator
+        Args:
+            - estimator: estimator instance returned by get_estimator
+        Returns:
+            - coupling_map: qiskit.transpiler.CouplingMap or list of edges, None for all-to-all connectivity
+            - basis_gates: list, of str, the basis gates; None if the estimator runs the circuits as they are
+            (StatevectorEstimator), in which case they need not be transpiled at all
+    """
+
+    if hasattr(estimator, 'target_estimator'):
+        # Estimator running its PUBs with another one, e.g. coalesce.CoalescedEstimator
+        return get_transpile_target(estimator.target_estimator)
+    if isinstance(estimator, StatevectorEstimator):
+        return None, None
+    if isinstance(estimator, (NumpyEstimator, SamplingEstimator)):
+        return estimator.coupling_map, estimator.basis_gates
+    return estimator._backend.coupling_map, estimator._backend._basis_gates()
\ No newline at end of file
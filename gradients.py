@@ -0,0 +1,104 @@
+import numpy as np
+from qiskit import QuantumCircuit, transpile
+from qiskit.circuit import Parameter, ParameterExpression
+from profiling import timed
+
+
+# Gates whose angles have Pauli-rotation generators with eigenvalues +/- 1/2 (up to a global phase),
+# for which the parameter-shift rule with shifts of +/- pi/2 is exact, also with noise after the gate
+_shiftable_gates = {'rz', 'rx', 'ry', 'p', 'u1', 'u2', 'u3', 'u'}
+
+
+class ParameterShiftGradient:
+
+    """
+    Parameter-shift gradient of the energy of a parametrized circuit. Each occurrence of a circuit
+    parameter in a rotation angle gets its own angle phi_i = a_i . theta + b_i, so that the rule is exact
+    even when a parameter appears in several gates with different coefficients (as in the transpiled
+    UCCSD): dE/dtheta = sum_i a_i (E(phi_i + pi/2) - E(phi_i - pi/2)) / 2.
+    The unshifted point and the 2 M shifted points (M angles) are evaluated in a single estimator job.
+    The energy and gradient of the last point are memoized, so that an optimizer asking for the energy
+    and then the gradient of the same point (e.g. L-BFGS-B) only runs one job.
+        Args:
+            - estimator: EstimatorV2 instance
+            - circuit: qiskit.circuit.QuantumCircuit, the (ISA) ansatz
+            - observable: qiskit.quantum_info.SparsePauliOp, the Hamiltonian, with the layout of the circuit applied
+            - callback: function, callback(energy, params, gradient) called after the evaluation of each new point
+    """
+
+    def __init__(self, estimator, circuit, observable, callback=None):
+        self.estimator = estimator
+        self.observable = observable
+        self.callback = callback
+        self.circuit, self.jacobian, self.offsets = _expand_angles(circuit)
+        self.n_jobs = 0
+        self._last = None   # (x, energy, gradient)
+
+    def _evaluate(self, x):
+        x = np.asarray(x, dtype=float)
+        if self._last is not None and np.array_equal(self._last[0], x):
+            return self._last
+
+        angles = self.offsets + self.jacobian @ x
+        n_angles = len(angles)
+        shifts = np.pi / 2 * np.eye(n_angles)
+        points = np.vstack([angles, angles + shifts, angles - shifts])
+
+        with timed('estimator_run'):
+            job = self.estimator.run([(self.circuit, self.observable, points)])
+            evs = job.result()[0].data.evs
+        self.n_jobs += 1
+
+        energy = float(evs[0])
+        gradient = self.jacobian.T @ ((evs[1:n_angles + 1] - evs[n_angles + 1:]) / 2)
+        self._last = (np.copy(x), energy, gradient)
+        if self.callback is not None:
+            self.callback(energy, x, gradient)
+        return self._last
+
+    def value(self, x):
+        return self._evaluate(x)[1]
+
+    def gradient(self, x):
+        return self._evaluate(x)[2]
+
+
+def _expand_angles(circuit):
+
+    """
+    Returns a copy of the circuit in which every parametrized angle is a distinct parameter, with the
+    (M, P) jacobian and (M,) offsets of the affine map from the circuit parameters to these angles.
+    Circuits with other parametrized gates (e.g. the PauliEvolutionGates of the untranspiled UCCSD) are
+    first transpiled to rotations.
+    """
+
+    if any(inst.operation.is_parameterized() and inst.operation.name not in _shiftable_gates for inst in circuit.data):
+        circuit = transpile(circuit, basis_gates=['rz', 'sx', 'x', 'cx'], optimization_level=1)
+
+    param_index = {param: i for i, param in enumerate(circuit.parameters)}
+    expanded = QuantumCircuit(*circuit.qregs, *circuit.cregs, global_phase=0)
+    rows = []
+    offsets = []
+    for inst in circuit.data:
+        operation = inst.operation
+        if operation.is_parameterized():
+            params = []
+            for angle in operation.params:
+                if isinstance(angle, ParameterExpression) and angle.parameters:
+                    row = np.zeros(len(param_index))
+                    for param in angle.parameters:
+                        coeff = angle.gradient(param)
+                        if isinstance(coeff, ParameterExpression) and coeff.parameters:
+                            raise ValueError(f"The angle {angle} of gate {operation.name} is not linear in the parameters")
+                        row[param_index[param]] = float(coeff)
+                    offsets.append(float(angle.bind({param: 0 for param in angle.parameters})))
+                    rows.append(row)
+                    angle = Parameter(f'phi[{len(rows) - 1}]')
+                params.append(angle)
+            operation = operation.copy()
+            operation.params = params
+        expanded.append(operation, inst.qubits, inst.clbits)
+
+    # Keeps the order of the angles (Parameter objects are sorted by name in circuit.parameters)
+    order = [int(param.name[4:-1]) for param in expanded.parameters]
+    return expanded, np.array(rows)[order].reshape(-1, len(param_index)), np.array(offsets)[order]
@@ -1,11 +1,13 @@
 from state_and_hamiltonian import get_fci_energy
-from _plots import make_convergence_plots_per_param
+from plot_pipeline import FigureSpec, make_figures
 import numpy as np
 from run import run_vqe_simulation
 
 ### Main script to run the VQE simulations for H2 or LiH and generate the convergence plots
 ### for different error scalings and numbers of shots. 
 ### The results are saved in the out/results/ folder and the plots in the figs/ folder.
+### The completed grid points are recorded in out/checkpoints/main/, so running the script again (e.g. after
+### changing a plot) reads their results instead of simulating them, and only redraws the figures that changed.
 ### Example below : Plot the convergence curves of ground-state energy for LiH at 1.595 Å with UCCSD and EfficientSU2 ansatze,
 ### in the noiseless case and with a depolarizing error scaling of 1, with 100 iterations and no shot noise (nshots=0).
 
@@ -44,7 +46,8 @@ results_uccsd = run_vqe_simulation(
         active_orbitals=active_orb,
         n_elec=n_elec,
         optimizer_name=op_name,
-        filename = f'LiH_UCCSD_results_noiseless_vs_noisy.txt'
+        filename = f'LiH_UCCSD_results_noiseless_vs_noisy.txt',
+        checkpoint_dir = 'out/checkpoints/main'
 )
 results_hea = run_vqe_simulation(
         atomic_symbol=atomic_symbol,
@@ -56,7 +59,8 @@ results_hea = run_vqe_simulation(
         active_orbitals=active_orb,
         n_elec=n_elec,
         optimizer_name=op_name,
-        filename = f'LiH_HEA_results_noiseless_vs_noisy.txt'
+        filename = f'LiH_HEA_results_noiseless_vs_noisy.txt',
+        checkpoint_dir = 'out/checkpoints/main'
 )
 
 # create list to store the energies for each type of ansatz and each error scaling
@@ -78,11 +82,12 @@ for i, error_scaling in enumerate(error_scalings):
 
 # make sure to have a figs/ folder to save the plots and an out/results/ folder to save the
 # results .txt files before running this script
-make_convergence_plots_per_param(
-        np.arange(niters_list[0]),
-        energies_per_type_per_error,
-        params=error_scalings,
-        param_name='Depolarizing error scaling',
-        fci_energy=fci_energy,
-        filename=f'LiH_UCCSD_vs_HEA_noiseless_vs_noisy'
-        )
+make_figures([
+        FigureSpec('make_convergence_plots_per_param', 'LiH_UCCSD_vs_HEA_noiseless_vs_noisy', dict(
+                iters=np.arange(niters_list[0]),
+                energies_per_type_per_param=energies_per_type_per_error,
+                params=error_scalings,
+                param_name='Depolarizing error scaling',
+                fci_energy=fci_energy
+                ))
+        ], n_workers=1)   # rendered in this process, the script is not protected by if __name__ == '__main__'
@@ -0,0 +1,140 @@
+from itertools import islice
+import numpy as np
+from qiskit_algorithms.optimizers import SPSA
+from optimizer import GrowableArray
+from profiling import timed
+from results_store import TextSink
+from vqe import get_isa_circuit_and_observable
+
+
+def get_multistart_vqe_results(
+        state,
+        hamiltonian,
+        estimator,
+        n_starts=8,
+        maxiter=100,
+        min_iters=10,
+        reduction_factor=2,
+        filename='default_filename',
+        seed=None,
+        sink=None,
+        x0=None,
+        target_magnitude=None
+    ):
+
+    """
+    Runs SPSA from n_starts initial points in lockstep, with successive halving: after min_iters iterations,
+    only the 1 / reduction_factor best starts (lowest current energy) continue, then again after
+    min_iters * reduction_factor iterations, and so on until one start is left, which runs until maxiter.
+    The evaluations of an iteration of all the running starts are sent to the estimator as one PUB (one job for
+    the +/- perturbations, one for the blocking check of the updated parameters). The SPSA iterations are those
+    of get_optimizer('spsa') (first order, blocking with no allowed increase); the learning rate and perturbation
+    are calibrated once, at the best initial point, and shared by the starts.
+    With 8 starts, halving every 10, 20, 40 iterations and maxiter=100, the starts run 220 iterations in total,
+    against 800 for 8 independent runs.
+        Args:
+            - state: qiskit.circuit.QuantumCircuit, the ansatz circuit
+            - hamiltonian: qiskit.SparsePauliOp, the Hamiltonian of the system
+            - estimator: EstimatorV2 instance, see get_vqe_results_v2
+            - n_starts: int, number of initial points
+            - maxiter: int, number of iterations of the last remaining start
+            - min_iters: int, number of iterations before the first pruning
+            - reduction_factor: int, fraction of the starts dropped at each pruning is 1 - 1 / reduction_factor
+            - filename: str, run id of the evaluations in the sink, and name of the default .out file
+            - seed: int, seed of the initial points and perturbations
+            - sink: results_store.ResultSink instance receiving all the evaluations; None to write them to out/{filename}.out
+            - x0: np.ndarray, initial parameters of the first start (e.g. from a neighboring geometry), the others being
+            random; None for random initial parameters only
+            - target_magnitude: float, size of the first step set by the calibration; None for the SPSA default
+        Returns:
+            - results: dict, with keys 'energies' (all the evaluations, in order), 'x' (best parameters), 'final_energy'
+            (energy of the best start at its parameters), 'best_start', 'n_iters_run' (iterations of the best start),
+            'n_evals', 'starts' (per start: 'x0', 'final_energy', 'n_iters_run', 'pruned_at', None for the
+            survivor, and 'history', its accepted energy after each iteration) and 'statistics' (min, mean, median,
+            std of the final energies of the starts)
+    """
+
+    isa_ansatz, isa_hamiltonian = get_isa_circuit_and_observable(state, hamiltonian, estimator)
+    num_params = isa_ansatz.num_parameters
+    rng = np.random.default_rng(seed)
+    starts = rng.uniform(-np.pi, np.pi, (n_starts, num_params))
+    if x0 is not None:
+        starts[0] = x0
+
+    energies = GrowableArray(3 * (n_starts * min_iters + maxiter) + 64)
+    if sink is None:
+        sink = TextSink(f'out/{filename}.out')
+
+    def evaluate(points):
+        points = np.atleast_2d(points)
+        with timed('estimator_run'):
+            evs = np.atleast_1d(estimator.run([(isa_ansatz, isa_hamiltonian, points)]).result()[0].data.evs)
+        for energy, params in zip(evs, points):
+            sink.write(filename, len(energies), energy, params)
+            energies.append(energy)
+        return evs
+
+    with sink, timed('optimizer'):
+        x = starts.copy()
+        fx = evaluate(x)
+
+        best = int(np.argmin(fx))
+        get_eta, get_eps = SPSA.calibrate(lambda points: list(evaluate(points)), x[best], target_magnitude=target_magnitude,
+                                          max_evals_grouped=100)
+        learning_rates = np.array(list(islice(get_eta(), maxiter)))
+        perturbations = np.array(list(islice(get_eps(), maxiter)))
+
+        rungs = set()
+        rung = min_iters
+        while n_starts // reduction_factor ** (len(rungs) + 1) >= 1 and rung < maxiter:
+            rungs.add(rung)
+            rung *= reduction_factor
+
+        active = np.arange(n_starts)
+        histories = np.full((n_starts, maxiter), np.nan)
+        n_iters = np.zeros(n_starts, dtype=int)
+        pruned_at = [None] * n_starts
+        for k in range(maxiter):
+            if k in rungs and len(active) > 1:
+                n_keep = max(1, int(np.ceil(len(active) / reduction_factor)))
+                order = np.argsort(fx[active], kind='stable')
+                for start in active[order[n_keep:]]:
+                    pruned_at[start] = k
+                active = np.sort(active[order[:n_keep]])
+
+            # SPSA gradient estimates of the running starts, from the +/- perturbations in one job
+            deltas = 1 - 2 * rng.integers(0, 2, (len(active), num_params))
+            eps = perturbations[k]
+            values = evaluate(np.vstack([x[active] + eps * deltas, x[active] - eps * deltas]))
+            gradients = ((values[:len(active)] - values[len(active):]) / (2 * eps))[:, None] * deltas
+            x_next = x[active] - learning_rates[k] * gradients
+
+            # Blocking: the updated parameters are accepted only if they lower the energy
+            fx_next = evaluate(x_next)
+            accepted = fx_next < fx[active]
+            x[active[accepted]] = x_next[accepted]
+            fx[active[accepted]] = fx_next[accepted]
+            histories[active, k] = fx[active]
+            n_iters[active] += 1
+
+    best = int(active[np.argmin(fx[active])])
+    final_energies = fx.copy()
+    return {
+        'energies': energies.view(),
+        'x': x[best].copy(),
+        'final_energy': float(fx[best]),
+        'best_start': best,
+        'n_iters_run': int(n_iters[best]),
+        'n_evals': len(energies),
+        'starts': [
+            {'x0': starts[i], 'final_energy': float(final_energies[i]), 'n_iters_run': int(n_iters[i]),
+             'pruned_at': pruned_at[i], 'history': histories[i, :n_iters[i]]}
+            for i in range(n_starts)
+        ],
+        'statistics': {
+            'min': float(np.min(final_energies)),
+            'mean': float(np.mean(final_energies)),
+            'median': float(np.median(final_energies)),
+            'std': float(np.std(final_energies)),
+        },
+    }
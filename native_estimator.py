@@ -0,0 +1,335 @@
+import numpy as np
+from qiskit import transpile
+from qiskit.circuit import ParameterExpression
+from qiskit.primitives import BaseEstimatorV2
+from qiskit.primitives.containers import DataBin, PrimitiveResult, PubResult
+from qiskit.primitives.containers.estimator_pub import EstimatorPub
+from qiskit.primitives.primitive_job import PrimitiveJob
+from qiskit.quantum_info import SparsePauliOp
+
+
+def _u3_matrices(angles):
+    theta, phi, lam = angles[:, 0], angles[:, 1], angles[:, 2]
+    cos, sin = np.cos(theta / 2), np.sin(theta / 2)
+    return np.stack([
+        cos, -np.exp(1j * lam) * sin,
+        np.exp(1j * phi) * sin, np.exp(1j * (phi + lam)) * cos
+    ], axis=-1).reshape(-1, 2, 2)
+
+def _matrices(entries):
+    return np.stack(np.broadcast_arrays(*entries), axis=-1).reshape(-1, 2, 2).astype(complex)
+
+# Gates whose angles can be parameter expressions, with their 2x2 matrices as a function of a
+# (B, n_angles) batch of angles
+_rotation_gates = {
+    'rz': lambda a: _matrices([np.exp(-0.5j * a[:, 0]), 0, 0, np.exp(0.5j * a[:, 0])]),
+    'p': lambda a: _matrices([1, 0, 0, np.exp(1j * a[:, 0])]),
+    'u1': lambda a: _matrices([1, 0, 0, np.exp(1j * a[:, 0])]),
+    'rx': lambda a: _matrices([np.cos(a[:, 0] / 2), -1j * np.sin(a[:, 0] / 2), -1j * np.sin(a[:, 0] / 2), np.cos(a[:, 0] / 2)]),
+    'ry': lambda a: _matrices([np.cos(a[:, 0] / 2), -np.sin(a[:, 0] / 2), np.sin(a[:, 0] / 2), np.cos(a[:, 0] / 2)]),
+    'u2': lambda a: _u3_matrices(np.concatenate([np.full((len(a), 1), np.pi / 2), a], axis=1)),
+    'u3': _u3_matrices,
+    'u': _u3_matrices,
+}
+
+
+class NumpyEstimator(BaseEstimatorV2):
+
+    """
+    EstimatorV2 evaluating expectation values with vectorized NumPy, for the small active spaces of
+    this project (up to ~8 qubits for the noisy variant, ~14 for the noiseless one).
+    Circuits are compiled once into a list of gate matrices (the parametrized rotations being linear
+    functions of the circuit parameters) and applied to the whole batch of parameter sets of a PUB at
+    once; observables are converted once into sparse matrices.
+    Without noise the state is propagated as a statevector. With noise, a density matrix is propagated
+    through the same depolarizing channels as the Aer noise model of estimator.get_estimator, i.e. a
+    depolarizing error of probability p_err_1q (p_err_2q) after each gate of gates_1q (gates_2q).
+        Args:
+            - p_err_1q: float, single-qubit depolarizing error probability
+            - p_err_2q: float, two-qubit depolarizing error probability
+            - gates_1q: list, of str, single-qubit gates followed by a depolarizing error
+            - gates_2q: list, of str, two-qubit gates followed by a depolarizing error
+            - coupling_map: list, of [i, j] edges of the target the circuits are transpiled to; None for all-to-all
+            - basis_gates: list, of str, basis gates of the target the circuits are transpiled to
+            - default_precision: float, standard deviation of the Gaussian noise added to the expectation values
+            - seed: int, seed of the Gaussian noise
+    """
+
+    def __init__(
+            self,
+            p_err_1q=0.0,
+            p_err_2q=0.0,
+            gates_1q=('u1', 'u2', 'u3', 'rz', 'sx', 'x'),
+            gates_2q=('cx',),
+            coupling_map=None,
+            basis_gates=('id', 'rz', 'sx', 'x', 'cx'),
+            default_precision=0.0,
+            seed=None
+            ):
+        self.p_err_1q = p_err_1q
+        self.p_err_2q = p_err_2q
+        self.gates_1q = set(gates_1q)
+        self.gates_2q = set(gates_2q)
+        self.coupling_map = coupling_map
+        self.basis_gates = list(basis_gates)
+        self.default_precision = default_precision
+        self.density_matrix = p_err_1q > 0 or p_err_2q > 0
+        self._rng = np.random.default_rng(seed)
+        self._circuits = {}         # id(circuit) -> (circuit, compiled gates)
+        self._superoperators = {}   # (id(matrix), noise) -> (matrix, superoperator) of the fixed two-qubit gates
+        self._observables = {}      # observable items -> (rows, cols, data) of its sparse matrix
+
+    def run(self, pubs, *, precision=None):
+        if precision is None:
+            precision = self.default_precision
+        coerced_pubs = [EstimatorPub.coerce(pub, precision) for pub in pubs]
+
+        job = PrimitiveJob(self._run, coerced_pubs)
+        job._submit()
+        return job
+
+    def _run(self, pubs):
+        return PrimitiveResult([self._run_pub(pub) for pub in pubs], metadata={'version': 2})
+
+    def _run_pub(self, pub):
+        circuit = pub.circuit
+        parameter_values = pub.parameter_values
+
+        batch = int(np.prod(parameter_values.shape, dtype=int))
+        values = parameter_values.as_array(circuit.parameters).reshape(batch, circuit.num_parameters)
+        states = self._evolve(circuit, values)
+
+        param_indices = np.arange(values.shape[0]).reshape(parameter_values.shape)
+        bc_indices, bc_obs = np.broadcast_arrays(param_indices, pub.observables)
+        evs = np.zeros(bc_indices.shape, dtype=np.float64)
+
+        # Each distinct observable is evaluated on the whole batch of states at once
+        obs_indices = {}
+        for index in np.ndindex(*bc_indices.shape):
+            obs_indices.setdefault(tuple(bc_obs[index].items()), []).append(index)
+        for items, indices in obs_indices.items():
+            energies = self._expectation_values(states, items)
+            for index in indices:
+                evs[index] = energies[bc_indices[index]]
+
+        stds = np.zeros_like(evs)
+        if pub.precision > 0:
+            evs = self._rng.normal(evs, pub.precision)
+            stds = np.full_like(evs, pub.precision)
+
+        data = DataBin(evs=evs, stds=stds, shape=evs.shape)
+        return PubResult(
+            data, metadata={'target_precision': pub.precision, 'circuit_metadata': circuit.metadata}
+        )
+
+    def _compile(self, circuit):
+
+        """
+        Returns the list of gates of the circuit as (qubits, matrix, angles, noise) tuples: matrix is the
+        fixed matrix of the gate, or for parametrized rotations the function of the batch of angles
+        angles = offsets + values @ coeffs, with angles = (offsets, coeffs); noise is the probability of
+        the depolarizing error following the gate.
+        """
+
+        if id(circuit) in self._circuits:
+            return self._circuits[id(circuit)][1]
+
+        supported = all(
+            inst.operation.name in ('barrier', 'delay') or inst.operation.name in _rotation_gates
+            or (inst.operation.num_qubits <= 2 and not inst.operation.is_parameterized() and hasattr(inst.operation, 'to_matrix'))
+            for inst in circuit.data
+        )
+        if supported:
+            compiled_circuit = circuit
+        elif self.density_matrix:
+            # Transpiling here would change the gates, hence the noise, with respect to the Aer estimator
+            raise ValueError("The circuit must be transpiled to the basis gates of the estimator (see estimator.get_transpile_target)")
+        else:
+            compiled_circuit = transpile(circuit, basis_gates=self.basis_gates, optimization_level=1)
+
+        param_index = {param: i for i, param in enumerate(circuit.parameters)}
+        matrices = {}   # identical fixed gates share their matrix, so their superoperator is computed once
+        gates = []
+        for inst in compiled_circuit.data:
+            operation = inst.operation
+            if operation.name in ('barrier', 'delay'):
+                continue
+            qubits = [compiled_circuit.find_bit(qubit).index for qubit in inst.qubits]
+
+            if operation.name in self.gates_1q and len(qubits) == 1:
+                noise = self.p_err_1q
+            elif operation.name in self.gates_2q and len(qubits) == 2:
+                noise = self.p_err_2q
+            else:
+                noise = 0.0
+
+            if operation.is_parameterized():
+                if operation.name not in _rotation_gates:
+                    raise ValueError(f"Parametrized gate '{operation.name}' is not supported by the NumpyEstimator")
+                angles = _linear_form(operation.params, param_index)
+                gates.append((qubits, _rotation_gates[operation.name], angles, noise))
+            else:
+                key = (operation.name, tuple(float(param) for param in operation.params))
+                if key not in matrices:
+                    if operation.name in _rotation_gates:
+                        matrices[key] = _rotation_gates[operation.name](np.array([key[1]]))[0]
+                    else:
+                        matrices[key] = operation.to_matrix()
+                gates.append((qubits, matrices[key], None, noise))
+
+        self._circuits[id(circuit)] = (circuit, gates)
+        return gates
+
+    def _evolve(self, circuit, values):
+
+        """
+        Returns the states prepared by the circuit for a batch of parameter values, as an array of shape
+        (B, 2^n) (statevectors) or (B, 2^n, 2^n) (density matrices).
+        A density matrix is handled as a vector over 2n qubits (row qubits first), on which a noisy gate on
+        k qubits is a single 4^k x 4^k superoperator (the depolarizing channel times U (x) U*).
+        Consecutive single-qubit gates on a qubit are multiplied together and applied at once, with a single
+        depolarizing error of the combined probability: this is exact since the single-qubit depolarizing
+        channel commutes with the single-qubit unitaries.
+        """
+
+        n = circuit.num_qubits
+        batch = values.shape[0]
+        gates = self._compile(circuit)
+
+        size = 4**n if self.density_matrix else 2**n
+        state = np.zeros((batch, size), dtype=complex)
+        state[:, 0] = 1.0
+
+        pending = {}    # qubit -> (product of the single-qubit gates not applied yet, probability of no error)
+
+        def apply(state, qubits, matrix, noise):
+            if self.density_matrix:
+                # Flat index of the density matrix = row * 2^n + column, and superoperator index = row * d + column
+                virtual_qubits = list(qubits) + [n + q for q in qubits]
+                if matrix.ndim == 2 and len(qubits) == 2:
+                    key = (id(matrix), noise)
+                    if key not in self._superoperators:
+                        self._superoperators[key] = (matrix, _superoperator(matrix, noise))
+                    matrix = self._superoperators[key][1]
+                else:
+                    matrix = _superoperator(matrix, noise)
+            else:
+                virtual_qubits = qubits
+            return _apply_matrix(state, matrix, _block_indices(size, tuple(virtual_qubits)))
+
+        def flush(state, qubit):
+            matrix, survival = pending.pop(qubit)
+            return apply(state, [qubit], matrix, 1 - survival)
+
+        for qubits, matrix, angles, noise in gates:
+            if angles is not None:
+                offsets, coeffs = angles
+                matrix = matrix(offsets + values @ coeffs)
+
+            if len(qubits) == 1:
+                qubit = qubits[0]
+                if qubit in pending:
+                    previous, survival = pending[qubit]
+                    pending[qubit] = (matrix @ previous, survival * (1 - noise))
+                else:
+                    pending[qubit] = (matrix, 1 - noise)
+                continue
+
+            for qubit in qubits:
+                if qubit in pending:
+                    state = flush(state, qubit)
+            state = apply(state, qubits, matrix, noise)
+
+        for qubit in list(pending):
+            state = flush(state, qubit)
+
+        dim = 2**n
+        return state.reshape(batch, dim, dim) if self.density_matrix else state
+
+    def _expectation_values(self, states, items):
+        if items not in self._observables:
+            paulis, coeffs = zip(*items)
+            matrix = SparsePauliOp(paulis, coeffs).to_matrix(sparse=True).tocoo()
+            self._observables[items] = (matrix.row, matrix.col, matrix.data)
+        rows, cols, data = self._observables[items]
+
+        if self.density_matrix:
+            # Tr(rho H) = sum_ij rho_ji H_ij
+            return np.real(states[:, cols, rows] @ data)
+        # <psi|H|psi> = sum_ij conj(psi_i) H_ij psi_j
+        return np.real((np.conj(states[:, rows]) * states[:, cols]) @ data)
+
+
+def _linear_form(expressions, param_index):
+
+    """
+    Returns (offsets, coeffs) such that expressions = offsets + values @ coeffs, for gate angles linear in
+    the circuit parameters
+    """
+
+    offsets = np.zeros(len(expressions))
+    coeffs = np.zeros((len(param_index), len(expressions)))
+    for i, expression in enumerate(expressions):
+        if not isinstance(expression, ParameterExpression):
+            offsets[i] = float(expression)
+            continue
+
+        for param in expression.parameters:
+            gradient = expression.gradient(param)
+            if isinstance(gradient, ParameterExpression) and gradient.parameters:
+                raise ValueError(f"Gate angle {expression} is not linear in the circuit parameters")
+            coeffs[param_index[param], i] = float(gradient)
+        offsets[i] = float(expression.bind({param: 0.0 for param in expression.parameters}))
+    return offsets, coeffs
+
+
+_block_indices_cache = {}
+
+def _block_indices(size, qubits):
+
+    """
+    Returns the (size / 2^k, 2^k) array of the flat indices of a vector of the given size, grouped in blocks
+    on which a 2^k x 2^k matrix acting on the given (little-endian) qubits acts
+    """
+
+    key = (size, qubits)
+    if key not in _block_indices_cache:
+        mask = sum(1 << q for q in qubits)
+        indices = np.arange(size)
+        bases = indices[(indices & mask) == 0]
+        sub = np.arange(2**len(qubits))
+        offsets = sum(((sub >> j) & 1) << q for j, q in enumerate(qubits))
+        _block_indices_cache[key] = bases[:, None] + offsets[None, :]
+    return _block_indices_cache[key]
+
+
+def _superoperator(matrix, noise):
+
+    """
+    Returns the superoperator of the gate of the given (d, d) matrix, or (B, d, d) batch of matrices, followed
+    by a depolarizing error of the given probability, i.e. rho -> (1 - p) U rho U^dag + p Tr(rho) I / d
+    """
+
+    d = matrix.shape[-1]
+    superop = np.einsum('...ij,...kl->...ikjl', matrix, np.conj(matrix)).reshape(matrix.shape[:-2] + (d * d, d * d))
+    if noise > 0:
+        identity = np.eye(d).reshape(-1)
+        depolarizing = (1 - noise) * np.eye(d * d) + noise * np.outer(identity, identity) / d
+        superop = depolarizing @ superop
+    return superop
+
+
+def _apply_matrix(state, matrix, blocks):
+
+    """
+    Applies a (2^k, 2^k) matrix, or a batch (B, 2^k, 2^k) of matrices, to the blocks of the flat (B, size)
+    batch of states returned by _block_indices
+    """
+
+    sub = state[:, blocks]
+    if matrix.ndim == 2:
+        sub = sub @ matrix.T
+    else:
+        sub = sub @ np.swapaxes(matrix, -1, -2)
+    state[:, blocks] = sub
+    return state
@@ -1,4 +1,6 @@
-from qiskit_algorithms.optimizers.spsa import SPSA
+from qiskit_algorithms.optimizers import ADAM, GradientDescent, L_BFGS_B
+from qiskit_algorithms.optimizers.spsa import SPSA, _batch_evaluate
+from qiskit_algorithms.utils import algorithm_globals
 import qiskit_algorithms
 import numpy as np
 
@@ -9,16 +11,24 @@ def get_optimizer(
         optimizer : str = 'spsa',
         max_iter : int = 100,
         regularization : float = 1e-8,
-        callback = None
+        callback = None,
+        max_evals_grouped : int = 1,
+        target_magnitude : float = None,
+        convergence_tol : float = None,
+        convergence_window : int = 10,
+        learning_rate : float = None
 ):
         """
         Returns a qiskit_algorithms.optimizers.optimizer instance
             Args:
-                - optimizer : str, type of qiskit optimizer to be instantiated (only possible option is 'spsa')
+                - optimizer : str, type of qiskit optimizer to be instantiated: 'spsa', or the gradient-based 'lbfgsb',
+                'adam' or 'gradient_descent', which get exact parameter-shift gradients from get_vqe_results_v2
+                (see gradients.py)
                 - max_iter : int, max number of optimization iterations (note: not necessarily the number of
                 circuit evalutations; e.g. SPSA requires 2 circuit evaluations.)
                 - regularization : float, regularization coefficient to avoid numerical issues
-                - callback: function, of the form 
+                - callback: function, called after each iteration of SPSA, or after each evaluation of the energy and
+                gradient of the gradient-based optimizers (with the norm of the gradient as step_size), of the form 
                     callback(
                         self,
                         n_evals,
@@ -27,26 +37,186 @@ def get_optimizer(
                         step_size,
                         accepted
                         )
+                - max_evals_grouped : int, max number of parameter sets passed at once to the cost function;
+                if > 1, the cost function must accept a 2D array of parameters and return a list of energies
+                (see BatchedSPSA)
+                - target_magnitude : float, size of the first step set by the calibration of the learning rate;
+                None for the SPSA default (2 pi / 10). Use a smaller value when starting close to the optimum,
+                e.g. from the parameters of a neighboring geometry
+                - convergence_tol : float, stops the optimization when the energy improved by less than convergence_tol
+                over the last convergence_window iterations (see ConvergenceChecker); None to always run max_iter iterations
+                - convergence_window : int, number of iterations over which the convergence is checked
+                - learning_rate : float, learning rate of 'adam' (default 0.05) and 'gradient_descent' (default 0.1)
             Returns:
                 - optimizer : qiskit_algorithms.optimizers.optimizer instance, the optimizer to be used in the VQE simulation
         """
 
+        history_callback = callback
+        termination_checker = None
+        if convergence_tol is not None:
+                termination_checker = ConvergenceChecker(convergence_tol, convergence_window, callback)
+                callback = termination_checker.callback
+
         if optimizer == 'spsa':
-                optimizer = SPSA(
+                optimizer = BatchedSPSA(
                     maxiter=max_iter,
                     blocking=True,  # Evaluates the circuit a 3rd time to test the updated params;
                                     # accepts the new params only if the loss is improved by at least allowed_increase
                     regularization=regularization,
                     allowed_increase=0.0,       # Sets the increase in loss allowed by the "blocking" to 0.0
-                    callback=callback
+                    callback=callback,
+                    termination_checker=termination_checker
                     )
+                optimizer.set_max_evals_grouped(max_evals_grouped)
+                optimizer.target_magnitude = target_magnitude
                 return optimizer
 
+        # The gradient-based optimizers do not take a callback; get_vqe_results_v2 calls history_callback instead
+        if optimizer == 'lbfgsb':
+                optimizer = L_BFGS_B(maxiter=max_iter, ftol=convergence_tol if convergence_tol is not None else 1e-10)
+        elif optimizer == 'adam':
+                optimizer = ADAM(maxiter=max_iter, lr=learning_rate if learning_rate is not None else 0.05,
+                                 tol=convergence_tol if convergence_tol is not None else 1e-6)
+        elif optimizer == 'gradient_descent':
+                optimizer = GradientDescent(maxiter=max_iter, learning_rate=learning_rate if learning_rate is not None else 0.1,
+                                            tol=convergence_tol if convergence_tol is not None else 1e-7)
+        else:
+                raise ValueError("Optimizer not supported; must be 'spsa', 'lbfgsb', 'adam' or 'gradient_descent'")
+        optimizer.history_callback = history_callback
+        return optimizer
+
+
+class BatchedSPSA(SPSA):
+    """
+    SPSA which sends all the points of one gradient estimate (the +/- perturbations of every resampling,
+    and the second-order points if any) to the cost function in a single call, instead of one call per
+    resampling. The calibration points are already grouped by SPSA itself through max_evals_grouped.
+    The blocking check cannot be grouped with the perturbations since it is evaluated at the updated
+    parameters, which depend on the gradient estimate.
+    The points and their order are exactly the ones of SPSA, so the optimization trajectory is unchanged.
+    With max_evals_grouped == 1, it behaves exactly as SPSA.
+    If target_magnitude is set, the calibration of the learning rate uses it instead of the SPSA default.
+    """
+
+    target_magnitude = None
+
+    def calibrate(self, loss, initial_point, **kwargs):
+        # Shadows the SPSA static method, which SPSA.minimize calls as self.calibrate
+        if self.target_magnitude is not None:
+            kwargs.setdefault('target_magnitude', self.target_magnitude)
+        return SPSA.calibrate(loss, initial_point, **kwargs)
+
+    def _point_estimate(self, loss, x, eps, num_samples):
+        if self._max_evals_grouped is None or self._max_evals_grouped == 1:
+            return super()._point_estimate(loss, x, eps, num_samples)
+
+        # Dry run of the SPSA estimate to record the points it would evaluate, in order
+        rng_state = algorithm_globals.random.bit_generator.state
+        nfev = self._nfev
+        points = []
+
+        def record(batch):
+            batch = np.atleast_2d(batch)
+            points.extend(batch)
+            return [0.0] * len(batch)
+
+        super()._point_estimate(record, x, eps, num_samples)
+
+        # Evaluate all the points at once, then replay the estimate with the same perturbations
+        values = iter(_batch_evaluate(loss, points, self._max_evals_grouped))
+        algorithm_globals.random.bit_generator.state = rng_state
+        self._nfev = nfev
+
+        def replay(batch):
+            return [next(values) for _ in range(len(np.atleast_2d(batch)))]
+
+        return super()._point_estimate(replay, x, eps, num_samples)
+
+
+class GrowableArray:
+
+    """
+    Array of rows of fixed shape, appended one at a time to a preallocated buffer whose capacity
+    doubles when it is full, instead of a list of small arrays or floats. The shape of the rows is
+    taken from the first one if not given.
+        Args:
+            - capacity: int, initial number of rows, e.g. the expected number of iterations
+            - row_shape: tuple, shape of the rows; None to take it from the first row
+            - dtype: numpy dtype of the buffer, e.g. np.float32 to halve the memory of the parameters
+    """
+
+    __slots__ = ('_data', '_size', 'capacity', 'row_shape', 'dtype')
+
+    def __init__(self, capacity=1024, row_shape=None, dtype=np.float64):
+        self.capacity = max(int(capacity), 1)
+        self.row_shape = None if row_shape is None else tuple(row_shape)
+        self.dtype = dtype
+        self._data = None
+        self._size = 0
+
+    def append(self, row):
+        if self._data is None:
+            if self.row_shape is None:
+                self.row_shape = np.shape(row)
+            self._data = np.empty((self.capacity,) + self.row_shape, dtype=self.dtype)
+        elif self._size == len(self._data):
+            data = np.empty((2 * len(self._data),) + self.row_shape, dtype=self.dtype)
+            data[:self._size] = self._data
+            self._data = data
+        self._data[self._size] = row
+        self._size += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def clear(self):
+        self._size = 0
+
+    def view(self):
+
+        """
+        Returns the rows appended so far, as a read-only view of the buffer (no copy); the view is not
+        updated by the next appends
+        """
+
+        if self._data is None:
+            return np.empty((0,) + (self.row_shape or ()), dtype=self.dtype)
+        rows = self._data[:self._size]
+        rows.flags.writeable = False
+        return rows
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        return self.view()[index]
+
+    def __iter__(self):
+        return iter(self.view())
+
+    def __array__(self, dtype=None, copy=None):
+        rows = self.view()
+        return rows if dtype is None else rows.astype(dtype, copy=False)
+
 
 class SPSAHistory:
-    def __init__(self):
-        self.params = []
-        self.values = []
+
+    """
+    History of the iterations of an optimizer, filled by its callback: the energy of every iteration
+    and the parameters of every params_every iterations, in growable arrays (see GrowableArray)
+        Args:
+            - maxiter: int, expected number of iterations, used as the initial capacity
+            - params_dtype: numpy dtype of the stored parameters, e.g. np.float32
+            - params_every: int, stores the parameters of the iterations 0, params_every, 2 params_every, ...
+    """
+
+    __slots__ = ('_params', '_values', 'params_every')
+
+    def __init__(self, maxiter=100, params_dtype=np.float64, params_every=1):
+        self.params_every = params_every
+        self._params = GrowableArray(-(-maxiter // params_every), dtype=params_dtype)
+        self._values = GrowableArray(maxiter)
 
     def callback(
               self,
@@ -56,6 +226,65 @@ class SPSAHistory:
               step_size,
               accepted
               ):
-        # Save a copy of the parameters and the energy value
-        self.params.append(np.copy(params))
-        self.values.append(fval)
\ No newline at end of file
+        # The parameters are copied into the buffer
+        if len(self._values) % self.params_every == 0:
+            self._params.append(params)
+        self._values.append(fval)
+
+    @property
+    def params(self):
+        return self._params.view()
+
+    @property
+    def values(self):
+        return self._values.view()
+
+    @property
+    def params_iterations(self):
+
+        """
+        Returns the iterations of the stored parameters
+        """
+
+        return np.arange(len(self._params)) * self.params_every
+
+    def restore(self, params, values):
+
+        """
+        Replaces the history, e.g. with the one saved in a checkpoint
+        """
+
+        self._params.clear()
+        self._values.clear()
+        self._params.extend(params)
+        self._values.extend(values)
+
+class ConvergenceChecker:
+
+    """
+    Termination checker of SPSA stopping the optimization once the accepted energy improved by less
+    than tol over the last window iterations. SPSA only calls the termination checker after accepted
+    steps, so the iterations (accepted or not) are counted by its callback, which must be passed to
+    the optimizer instead of the user callback (it calls the user callback itself).
+        Args:
+            - tol: float, minimum improvement of the energy (Hartree) over window iterations
+            - window: int, number of iterations
+            - callback: function, user callback of the optimizer, see get_optimizer
+    """
+
+    def __init__(self, tol, window=10, callback=None):
+        self.tol = tol
+        self.window = window
+        self.user_callback = callback
+        self.best_values = []   # best accepted energy after each iteration
+
+    def callback(self, n_evals, params, fval, step_size, accepted):
+        best = self.best_values[-1] if self.best_values else np.inf
+        self.best_values.append(min(best, fval) if accepted else best)
+        if self.user_callback is not None:
+            self.user_callback(n_evals, params, fval, step_size, accepted)
+
+    def __call__(self, n_evals, params, fval, step_size, accepted):
+        if len(self.best_values) <= self.window:
+            return False
+        return self.best_values[-self.window - 1] - self.best_values[-1] < self.tol
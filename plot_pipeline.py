@@ -0,0 +1,185 @@
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+
+# Figures regenerated from saved results only: each figure is described by a FigureSpec, whose inputs
+# (arguments, results files, runs of a ResultStore, and the code of _plots.py) are hashed, and the figure is
+# rendered again only if the hash differs from the one recorded when it was last rendered.
+# Example:
+#     specs = [FigureSpec('make_pes_plots_per_param', 'LiH_PES', dict(
+#         distances=[1.0, 1.595, 2.0], params=[0, 1], param_name='Depolarizing error scaling', fci_energies=fci_energies,
+#         energies_per_type_per_param=[[ResultsFileEntry('out/results/LiH_UCCSD.txt', (0, 100, error)),
+#                                       ResultsFileEntry('out/results/LiH_HEA.txt', (0, 100, error))] for error in [0, 1]]))]
+#     make_figures(specs, store_dir='out/store/LiH')
+
+
+class FigureSpec(NamedTuple):
+
+    """
+    One figure of _plots.py: the name of the plotting function, the filename of the figure (figs/{filename}.pdf)
+    and the other keyword arguments of the function. In the energies of make_convergence_plots_per_param, run ids
+    (str) are read from the ResultStore given to make_figures; in those of make_pes_plots_per_param, ResultsFileEntry
+    items are read from the results .txt files written by run_vqe_simulation.
+    """
+
+    function: str
+    filename: str
+    kwargs: dict
+
+
+class ResultsFileEntry(NamedTuple):
+
+    """
+    The results of one (n_shots, n_iters, dep_error) in a results .txt file of run_vqe_simulation
+    """
+
+    path: str
+    key: tuple
+
+
+def read_results_file(path):
+
+    """
+    Reads a results .txt file written by run_vqe_simulation
+        Args:
+            - path: str, path of the file, e.g. 'out/results/LiH_UCCSD_results.txt'
+        Returns:
+            - results: dict, with keys (n_shots, n_iters, dep_error) and values dicts with keys 'bond_lengths', 'depths',
+            'n_evals' and 'final_energies', as the dict returned by run_vqe_simulation (without the energies per iteration)
+    """
+
+    results = {}
+    with open(path) as f:
+        header = f.readline().split()
+        for line in f:
+            row = dict(zip(header, line.split()))
+            key = (int(row['n_shots']), int(row['n_iters']), float(row['dep_error']))
+            entry = results.setdefault(key, {'bond_lengths': [], 'depths': [], 'n_evals': [], 'final_energies': []})
+            entry['bond_lengths'].append(float(row['bond_length']))
+            entry['depths'].append(int(row['depth']))
+            entry['n_evals'].append(int(row['n_evals']) if 'n_evals' in row else None)
+            entry['final_energies'].append(float(row['energy']))
+    return results
+
+
+def make_figures(specs, store_dir=None, n_workers=None, cache_path='figs/.figure_hashes.json', force=False):
+
+    """
+    Renders the figures whose inputs changed since they were last rendered, in parallel processes with the
+    non-interactive Agg backend of matplotlib. No simulation is run: the inputs are read from the saved results.
+        Args:
+            - specs: list, of FigureSpec instances
+            - store_dir: str, folder of the ResultStore of the run ids in the specs
+            - n_workers: int, number of processes rendering the figures; None for one per figure, up to the number of cores
+            - cache_path: str, JSON file recording the input hash of each rendered figure
+            - force: bool, whether to render all the figures
+        Returns:
+            - rendered: list, of the filenames of the figures rendered
+    """
+
+    hashes = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            hashes = json.load(f)
+
+    code_hash = _file_hash(os.path.join(os.path.dirname(os.path.abspath(__file__)), '_plots.py'))
+    outdated = []
+    for spec in specs:
+        digest = figure_hash(spec, store_dir, code_hash)
+        if force or hashes.get(spec.filename) != digest or not os.path.exists(f'figs/{spec.filename}.pdf'):
+            outdated.append((spec, digest))
+    if not outdated:
+        return []
+
+    os.makedirs('figs', exist_ok=True)
+    n_workers = n_workers or min(len(outdated), os.cpu_count() or 1)
+    if n_workers == 1:
+        _init_worker()
+        for spec, _ in outdated:
+            render_figure(spec, store_dir)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker) as executor:
+            for future in [executor.submit(render_figure, spec, store_dir) for spec, _ in outdated]:
+                future.result()
+
+    for spec, digest in outdated:
+        hashes[spec.filename] = digest
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+    tmp_path = cache_path + f'.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(hashes, f, indent=2)
+    os.replace(tmp_path, cache_path)
+    return [spec.filename for spec, _ in outdated]
+
+
+def figure_hash(spec, store_dir=None, code_hash=''):
+
+    """
+    Returns the hash of the inputs of a figure: its arguments, the content of the results files and of the chunks
+    of the runs it reads (hashed without being loaded), and code_hash
+    """
+
+    from results_store import ResultStore
+
+    store = ResultStore(store_dir) if store_dir else None
+
+    def encode(value):
+        if isinstance(value, ResultsFileEntry):
+            return {'results_file': _file_hash(value.path), 'key': list(value.key)}
+        if isinstance(value, str) and store is not None and store.chunk_paths(value):
+            return {'run': value, 'chunks': [_file_hash(path) for path in store.chunk_paths(value)]}
+        if isinstance(value, (list, tuple)):
+            return [encode(item) for item in value]
+        if isinstance(value, dict):
+            return {str(key): encode(item) for key, item in value.items()}
+        if hasattr(value, 'tolist'):
+            return value.tolist()
+        return value
+
+    content = json.dumps([spec.function, spec.filename, encode(spec.kwargs), code_hash], sort_keys=True, default=repr)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def render_figure(spec, store_dir=None):
+
+    """
+    Reads the inputs of a figure and renders it with the function of _plots.py
+    """
+
+    import _plots
+    from results_store import ResultStore
+
+    kwargs = dict(spec.kwargs, filename=spec.filename)
+    if spec.function == 'make_convergence_plots_per_param' and store_dir is not None:
+        kwargs['store'] = ResultStore(store_dir)
+    if spec.function == 'make_pes_plots_per_param':
+        files = {}
+
+        def resolve(entry):
+            if not isinstance(entry, ResultsFileEntry):
+                return entry
+            if entry.path not in files:
+                files[entry.path] = read_results_file(entry.path)
+            return files[entry.path][tuple(entry.key)]
+
+        kwargs['energies_per_type_per_param'] = [[resolve(entry) for entry in entries]
+                                                 for entries in kwargs['energies_per_type_per_param']]
+    getattr(_plots, spec.function)(**kwargs)
+
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,166 @@
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+
+
+# Instrumentation of the stages of the VQE pipeline. Disabled by default, in which case timed() returns
+# a shared no-op context manager, so the instrumented code only pays a function call and a test.
+enabled = False
+_stats = {}     # name -> [count, total seconds, max seconds]
+_spans = []     # (name, start, duration, pid, thread id) for the Chrome trace
+_origin = time.perf_counter()
+_null_context = contextlib.nullcontext()
+
+
+def enable(reset_data=True):
+
+    """
+    Starts recording the timed() spans
+        Args:
+            - reset_data: bool, whether to discard what was recorded before
+    """
+
+    global enabled
+    if reset_data:
+        reset()
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    _stats.clear()
+    _spans.clear()
+
+
+class _Span:
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter() - self.start
+        stats = _stats.get(self.name)
+        if stats is None:
+            _stats[self.name] = [1, duration, duration]
+        else:
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+        _spans.append((self.name, self.start, duration, os.getpid(), threading.get_ident()))
+
+
+def timed(name):
+
+    """
+    Returns a context manager recording the wall time of its block under name, e.g.
+        with timed('estimator_run'):
+            job = estimator.run(pubs)
+        Args:
+            - name: str, name of the stage
+        Returns:
+            - context manager, a no-op one if the instrumentation is disabled
+    """
+
+    if not enabled:
+        return _null_context
+    return _Span(name)
+
+
+def summary():
+
+    """
+    Returns the recorded stages with their number of calls, total, mean and max wall times (seconds),
+    sorted by decreasing total time. The time spent by the optimizers outside the estimator calls and the
+    writes of the results and checkpoints is reported as 'optimizer_overhead' when both are recorded.
+        Returns:
+            - summary: dict, name -> dict with keys 'count', 'total', 'mean', 'max'
+    """
+
+    result = {
+        name: {'count': count, 'total': total, 'mean': total / count, 'max': longest}
+        for name, (count, total, longest) in _stats.items()
+    }
+    if 'optimizer' in result and 'estimator_run' in result:
+        overhead = result['optimizer']['total'] - sum(result[name]['total'] for name in ('estimator_run', 'result_io', 'checkpoint_io')
+                                                      if name in result)
+        result['optimizer_overhead'] = {'count': result['optimizer']['count'], 'total': overhead,
+                                        'mean': overhead / result['optimizer']['count'], 'max': None}
+    return dict(sorted(result.items(), key=lambda item: -item[1]['total']))
+
+
+def write_summary(path, metadata=None):
+
+    """
+    Writes the summary of the recorded stages as a JSON file
+        Args:
+            - path: str, path of the .json file
+            - metadata: dict, added to the file, e.g. the grid point
+    """
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'metadata': metadata or {}, 'stages': summary()}, f, indent=2)
+
+
+def write_chrome_trace(path):
+
+    """
+    Writes the recorded spans in the Chrome trace event format, to be opened in chrome://tracing or Perfetto
+        Args:
+            - path: str, path of the .json file
+    """
+
+    events = [
+        {'name': name, 'ph': 'X', 'ts': (start - _origin) * 1e6, 'dur': duration * 1e6, 'pid': pid, 'tid': tid}
+        for name, start, duration, pid, tid in _spans
+    ]
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+@contextlib.contextmanager
+def profile_block(path, profiler='cprofile'):
+
+    """
+    Context manager profiling its block with cProfile (written as a .prof file, e.g. for snakeviz) or
+    pyinstrument (written as an .html report; pyinstrument must be installed)
+        Args:
+            - path: str, path of the output file, without extension
+            - profiler: str, 'cprofile' or 'pyinstrument'
+    """
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if profiler == 'cprofile':
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(path + '.prof')
+    elif profiler == 'pyinstrument':
+        from pyinstrument import Profiler
+        profile = Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            with open(path + '.html', 'w') as f:
+                f.write(profile.output_html())
+    else:
+        raise ValueError("Profiler not supported; must be 'cprofile' or 'pyinstrument'")
@@ -0,0 +1,239 @@
+import os
+import time
+from urllib.parse import quote, unquote
+import numpy as np
+from profiling import timed
+
+
+class ResultSink:
+
+    """
+    Base class of the destinations of the energy evaluations of a VQE run. Records are buffered
+    and written every flush_every records, on flush() and on close(); sinks are context managers,
+    so that the buffered records are written and the files closed even if the optimizer raises.
+        Args:
+            - flush_every: int, number of buffered records triggering a write
+    """
+
+    def __init__(self, flush_every=1024):
+        self.flush_every = flush_every
+        self._buffer = []
+        self.closed = False
+
+    def write(self, run_id, eval_index, energy, params):
+
+        """
+        Adds an energy evaluation to the sink
+            Args:
+                - run_id: str, identifier of the VQE run, e.g. the filename of the grid point
+                - eval_index: int, index of the evaluation in the run
+                - energy: float, energy of the evaluation
+                - params: np.ndarray, of shape (N_params,), parameters of the ansatz
+        """
+
+        self._buffer.append((run_id, eval_index, float(energy), np.asarray(params, dtype=float), time.time()))
+        if len(self._buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            with timed('result_io'):
+                self._write_records(self._buffer)
+            self._buffer = []
+
+    def _write_records(self, records):
+        raise NotImplementedError
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TextSink(ResultSink):
+
+    """
+    Writes the energies in the fixed-width .out format of the project
+        Args:
+            - path: str, path of the .out file (its folder is created if needed)
+            - flush_every: int, number of buffered records triggering a write
+            - header: list, of lines written as comments ("# ...") after the title, e.g. the simulation plan of the run
+    """
+
+    def __init__(self, path, flush_every=1024, header=None):
+        super().__init__(flush_every)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(path, 'w')
+        self._file.write(f"VQE Simulation (EstimatorV2)\n")
+        self._file.write(''.join(f"# {line}\n" for line in header or []))
+        self._file.write(f"{'Iter':>10} {'Energy (Hartree)':>20}\n")
+
+    def _write_records(self, records):
+        self._file.write(''.join(f"{eval_index:>10} {energy:>20.6f}\n" for _, eval_index, energy, _, _ in records))
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self._file.close()
+
+
+class NpzSink(ResultSink):
+
+    """
+    Appends the evaluations of a run to a ResultStore folder, as columnar .npz chunks of up to
+    flush_every records (columns 'eval_index', 'energy', 'params', 'timestamp'). Each chunk is
+    written atomically and never modified, so several processes can write different runs to the
+    same store, and readers only ever see complete chunks. The previous chunks of the run, if any, are
+    deleted, as a new .out file would replace the previous one.
+        Args:
+            - store_dir: str, folder of the ResultStore
+            - run_id: str, identifier of the run
+            - flush_every: int, number of records per chunk
+    """
+
+    def __init__(self, store_dir, run_id, flush_every=4096):
+        super().__init__(flush_every)
+        self.store_dir = store_dir
+        self.run_id = run_id
+        for path in ResultStore(store_dir).chunk_paths(run_id):
+            os.remove(path)
+        self._n_chunks = 0
+        os.makedirs(store_dir, exist_ok=True)
+
+    def write(self, run_id, eval_index, energy, params):
+        if run_id != self.run_id:
+            raise ValueError(f"NpzSink of run {self.run_id!r} cannot store run {run_id!r}")
+        super().write(run_id, eval_index, energy, params)
+
+    def _write_records(self, records):
+        _, eval_index, energy, params, timestamp = zip(*records)
+        path = os.path.join(self.store_dir, f'{_encode_run_id(self.run_id)}.{self._n_chunks:06d}.npz')
+        tmp_path = path + f'.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                eval_index=np.array(eval_index, dtype=np.int64),
+                energy=np.array(energy),
+                params=np.array(params),
+                timestamp=np.array(timestamp)
+            )
+        os.replace(tmp_path, path)
+        self._n_chunks += 1
+
+
+class MultiSink(ResultSink):
+
+    """
+    Forwards the records to several sinks, e.g. a TextSink and an NpzSink
+        Args:
+            - sinks: list, of ResultSink instances
+    """
+
+    def __init__(self, sinks):
+        super().__init__()
+        self.sinks = list(sinks)
+
+    def write(self, run_id, eval_index, energy, params):
+        for sink in self.sinks:
+            sink.write(run_id, eval_index, energy, params)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            for sink in self.sinks:
+                sink.close()
+
+
+class ResultStore:
+
+    """
+    Reader of the folder written by NpzSink. Nothing is loaded until a column of a run is requested,
+    and only the requested columns are read from the chunks.
+        Args:
+            - store_dir: str, folder of the store
+    """
+
+    columns = ('eval_index', 'energy', 'params', 'timestamp')
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def runs(self):
+
+        """
+        Returns the identifiers of the runs in the store, sorted
+        """
+
+        if not os.path.isdir(self.store_dir):
+            return []
+        return sorted({_decode_run_id(name.split('.')[0]) for name in os.listdir(self.store_dir) if name.endswith('.npz')})
+
+    def chunk_paths(self, run_id):
+
+        """
+        Returns the paths of the chunks of a run, in the order they were written
+        """
+
+        if not os.path.isdir(self.store_dir):
+            return []
+        prefix = _encode_run_id(run_id) + '.'
+        names = sorted(name for name in os.listdir(self.store_dir) if name.startswith(prefix) and name.endswith('.npz'))
+        return [os.path.join(self.store_dir, name) for name in names]
+
+    def iter_chunks(self, run_id, columns=('energy',)):
+
+        """
+        Yields the chunks of a run one at a time
+            Args:
+                - run_id: str, identifier of the run
+                - columns: tuple, of str, columns to read (see ResultStore.columns)
+            Yields:
+                - chunk: dict, with the requested columns as np.ndarray
+        """
+
+        for path in self.chunk_paths(run_id):
+            with np.load(path) as data:
+                yield {column: data[column] for column in columns}
+
+    def load(self, run_id, columns=('energy',)):
+
+        """
+        Returns the requested columns of a run, concatenated over its chunks
+            Args:
+                - run_id: str, identifier of the run
+                - columns: tuple, of str, columns to read (see ResultStore.columns)
+            Returns:
+                - data: dict, with the requested columns as np.ndarray
+        """
+
+        chunks = list(self.iter_chunks(run_id, columns))
+        if not chunks:
+            raise KeyError(f"No results for run {run_id!r} in {self.store_dir}")
+        return {column: np.concatenate([chunk[column] for chunk in chunks]) for column in columns}
+
+    def energies(self, run_id):
+
+        """
+        Returns the energies of a run, in the order of the evaluations
+        """
+
+        return self.load(run_id, ('energy',))['energy']
+
+
+def _encode_run_id(run_id):
+    # Run ids are paths like 'noisy/UCCSD/.../shots0_iters100_scale1_bl1.595', the dots and slashes are escaped
+    return quote(run_id, safe='').replace('.', '%2E')
+
+
+def _decode_run_id(name):
+    return unquote(name)
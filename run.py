@@ -1,9 +1,8 @@
-from vqe import get_vqe_results_v2
-from state_and_hamiltonian import get_state_and_hamiltonian
-from optimizer import get_optimizer
-from estimator import get_estimator
-from utils import get_circuit_depth
-from optimizer import SPSAHistory
+import os
+import profiling
+from checkpoint import SweepManifest, OptimizerCheckpoint, task_checkpoint_path
+from sweep import make_sweep_tasks, run_sweep
+from utils import make_geometry, export_circuit_drawing, wait_for_circuit_drawings
 
 def run_vqe_simulation(
         atomic_symbol,
@@ -16,80 +15,206 @@ def run_vqe_simulation(
         n_elec,
         optimizer_name='spsa',
         regularization=1e-8,
-        filename='results.txt'
+        filename='results.txt',
+        max_evals_grouped=1,
+        n_workers=1,
+        threads_per_worker=None,
+        seed=0,
+        draw_circuits=False,
+        estimator_name='noisy',
+        results_store=None,
+        checkpoint_dir=None,
+        checkpoint_every=10,
+        pes_scan=False,
+        extrapolate=False,
+        convergence_tol=None,
+        convergence_window=10,
+        topology='heavy_hex',
+        simulation_method='plan',
+        memory_budget=None,
+        symmetry_reduction=None,
+        n_starts=1,
+        coalesce=False,
+        coalesce_batch_size=64,
+        coalesce_latency=0.005,
+        profile_dir=None,
+        profiler=None
     ):
 
     """
     Runs a VQE simulation for a given state type (UCCSD or EfficientSU2) at different bond lengths,
     numbers of shots, numbers of iterations, and depolarizing error scalings. Saves the results in a .txt file
-    in the out/results/ folder and returns a dictionary with the results.
+    in the out/results/ folder and returns a dictionary with the results. The energies of every evaluation are written
+    to a .out file per grid point in the out/ folder, or, if results_store is given, to a single columnar ResultStore.
+    Each (n_shots, n_iters, dep_error, bond_length) grid point is an independent task with its own seed
+    (see sweep.py), so the results are the same whether the tasks run serially or in parallel.
         Args:
             - atomic_symbol: str, either 'H2' or 'LiH'
-            - state_type: str, either 'UCCSD' or 'EfficientSU2'
+            - state_type: str, 'UCCSD', 'EfficientSU2' or 'ADAPT' (adaptive ansatz, see adapt.py, whose VQE starts from the
+            parameters of its construction)
             - bond_lengths: list, of len N_dist, contains the bond lengths
             - n_shots_list: list, of len N_shots, contains the numbers of shots
             - n_iters_list: list, of len N_iters, contains the numbers of optimization iterations
             - depolarizing_errors: list, of len N_errors, contains the scalings of the depolarizing error probabilities
             - active_orbitals: int, number of active orbitals (2 or 4)
             - n_elec: int, number of electrons (2 or 4)
-            - optimizer_name: str, name of the optimizer to be used (only 'spsa' implemented)
+            - optimizer_name: str, name of the optimizer to be used: 'spsa', or the gradient-based 'lbfgsb', 'adam' or
+            'gradient_descent' (parameter-shift gradients, see get_optimizer in optimizer.py)
             - regularization: float, regularization coefficient for the optimizer
             - filename: str, name of the .txt file to be saved in the out/results/ folder
+            - max_evals_grouped: int, max number of parameter sets sent to the estimator in a single job
+            (1 means one job per energy evaluation)
+            - n_workers: int, number of worker processes running the grid points in parallel; with n_workers > 1,
+            the calling script must be protected by if __name__ == '__main__'
+            - threads_per_worker: int, max number of simulator threads per worker; None to share the cores
+            evenly between the workers
+            - seed: int, seed of the sweep, from which the seed of each grid point is derived
+            - draw_circuits: bool, whether to draw the transpiled ansatz in the circuits/ folder (in the background)
+            - estimator_name: str, 'noisy' (Aer), 'native' (NumPy) or 'noiseless' (exact statevector), see
+            get_estimator in estimator.py; with 'noisy', the grid points with a dep_error of 0 use 'noiseless'
+            - results_store: str, folder of the ResultStore receiving the evaluations (run ids are the SweepTask.out_filename
+            of the grid points), e.g. 'out/store/LiH_UCCSD'; None to write one .out file per grid point
+            - checkpoint_dir: str, folder of the checkpoints, e.g. 'out/checkpoints'; the completed grid points are recorded
+            in its manifest.jsonl and skipped when the simulation is run again, the others resume from the checkpoint of
+            their optimizer, saved every checkpoint_every iterations. None to disable checkpointing.
+            - checkpoint_every: int, number of optimizer iterations between two checkpoints
+            - pes_scan: bool, whether to run the bond lengths of each (n_shots, n_iters, dep_error) as a potential energy
+            surface scan, in increasing order, each geometry starting from the optimal parameters of the previous one
+            (see run_pes_series in sweep.py); the scans run in parallel with n_workers > 1
+            - extrapolate: bool, whether the scan extrapolates the initial parameters from the two previous geometries
+            - convergence_tol: float, stops each optimization when the energy improved by less than convergence_tol
+            over the last convergence_window iterations (n_iters is then a maximum); None to run all the n_iters iterations
+            - convergence_window: int, number of iterations over which the convergence is checked
+            - topology: str, qubit connectivity of the simulated device: 'heavy_hex', 'ring', 'linear' or 'all_to_all'
+            (see make_coupling_map in estimator.py)
+            - simulation_method: str, Aer simulation method, e.g. 'automatic', 'statevector', 'density_matrix', or 'plan' to
+            select, for the noisy estimator, the fastest method fitting in memory_budget from its estimated memory and time
+            (see simulation_plan.py); the decision and the estimates are printed and written to the .out files
+            - memory_budget: float, memory in bytes available to the simulation of each grid point; None for a share of 80%
+            of the available memory per worker. A grid point that cannot fit raises a MemoryError before running.
+            - symmetry_reduction: str, None for the Jordan-Wigner mapping, 'parity' for the parity mapping with the two-qubit
+            reduction, or 'tapered' to also taper off the qubits of the Z2 symmetries of the Hamiltonian (see
+            get_state_and_hamiltonian in state_and_hamiltonian.py); the simulated device has the reduced number of qubits
+            - n_starts: int, number of SPSA initial points per grid point; with n_starts > 1 the starts run together and the
+            worst ones are dropped by successive halving (see multistart.py), the result being the best start
+            - coalesce: bool, whether to run the grid points of each worker together, their estimator calls being
+            coalesced into one job per tick, the PUBs of the same circuit being merged (see coalesce.py); with exact
+            estimators the results are the same as without
+            - coalesce_batch_size: int, number of parameter sets from which the waiting estimator calls are dispatched
+            - coalesce_latency: float, time in seconds after which the waiting estimator calls are dispatched
+            - profile_dir: str, folder receiving the wall time and number of calls of each stage of the pipeline (PySCF,
+            active space, mapping, transpilation, estimator calls, optimizer, circuit metrics, file I/O), as a JSON
+            summary and a Chrome trace per grid point, and setup.json for the Hamiltonians computed before the sweep
+            (see profiling.py); None to disable the instrumentation
+            - profiler: str, 'cprofile' or 'pyinstrument' to also profile each grid point in profile_dir; None to only
+            time the stages
         Returns:
             - results: dict, with keys (n_shots, n_iters, dep_error) and values dicts with keys
-            'bond_lengths', 'energies_per_iter', 'depths' containing the corresponding lists of
+            'bond_lengths', 'energies_per_iter', 'depths', 'final_energies' containing the corresponding lists of
             results for each combination of parameters
     """
 
+    if coalesce and profile_dir is not None:
+        raise ValueError("profile_dir is not supported with coalesce: the stages of the coalesced grid points overlap")
+
+    # The chemistry and simulation modules are only loaded when a simulation is run
+    from state_and_hamiltonian import get_active_space_data, get_state_and_hamiltonian, get_record_mapper
+
     results = {}
 
-    default_p1 = 0.001  # Default single-qubit depolarizing error probability
-    default_p2 = 0.02   # Default two-qubit depolarizing error probability
+    if threads_per_worker is None:
+        threads_per_worker = 0 if n_workers == 1 else max(1, (os.cpu_count() or 1) // n_workers)
+
+    # The Hamiltonian only depends on the geometry and active space, so it is computed once per bond length
+    # here and then read from the cache by every grid point (see state_and_hamiltonian.hamiltonian_cache)
+    if profile_dir is not None:
+        profiling.enable()
+    mapper = get_record_mapper(symmetry_reduction, n_elec)
+    for bond_length in bond_lengths:
+        get_active_space_data(geometry=make_geometry(atomic_symbol, bond_length), basis_set='sto-3g', active_orb=active_orbitals, n_elec=n_elec, mapper=mapper)
+    if profile_dir is not None:
+        profiling.disable()
+        profiling.write_summary(os.path.join(profile_dir, 'setup.json'), metadata={'atomic_symbol': atomic_symbol, 'bond_lengths': list(bond_lengths)})
+
+    tasks = make_sweep_tasks(
+        atomic_symbol, state_type, bond_lengths, n_shots_list, n_iters_list, depolarizing_errors,
+        active_orbitals, n_elec, optimizer_name=optimizer_name, regularization=regularization,
+        max_evals_grouped=max_evals_grouped, seed=seed, max_parallel_threads=threads_per_worker,
+        estimator_name=estimator_name, results_store=results_store,
+        checkpoint_dir=checkpoint_dir, checkpoint_every=checkpoint_every,
+        convergence_tol=convergence_tol, convergence_window=convergence_window,
+        topology=topology, simulation_method=simulation_method, memory_budget=memory_budget,
+        symmetry_reduction=symmetry_reduction, n_starts=n_starts,
+        profile_dir=profile_dir, profiler=profiler
+    )
+    if draw_circuits:
+        state, _ = get_state_and_hamiltonian(state_type=state_type, geometry=make_geometry(atomic_symbol, bond_lengths[0]), basis_set='sto-3g', active_orb=active_orbitals, n_elec=n_elec, symmetry_reduction=symmetry_reduction)
+        export_circuit_drawing(state, f'{atomic_symbol}_{state_type}_n_elec={n_elec}_no={active_orbitals}')
+
+    for task in tasks:
+        results.setdefault(task.key, {'bond_lengths': [], 'energies_per_iter': [], 'depths': [], 'final_energies': []})
 
     with open('out/results/' + filename, 'w') as file:
-        file.write(f"{'n_shots':<10} {'n_iters':<10} {'dep_error':<12} {'depth':<10}\n")  # Write header with spacing
-
-        for n_shots in n_shots_list:
-            for n_iters in n_iters_list:
-                for dep_error in depolarizing_errors:
-                    p1_scaled = dep_error * default_p1
-                    p2_scaled = dep_error * default_p2
-                    key = (n_shots, n_iters, dep_error)
-                    results[key] = {'bond_lengths': [], 'energies_per_iter': [], 'depths': []}
-                    history_tracker = SPSAHistory()
-                    callback = history_tracker.callback
-
-                    optimizer = get_optimizer(optimizer_name, max_iter=n_iters, regularization=regularization, callback=callback)
-                    estimator = get_estimator(nqubits=2*active_orbitals, estimator_name='noisy', n_shots=n_shots, p_err_1q=p1_scaled, p_err_2q=p2_scaled)
-
-                    for bond_length in bond_lengths:
-                        if atomic_symbol == 'H2':
-                            geometry = f'H 0 0 0; H 0 0 {bond_length}'
-                        elif atomic_symbol == 'LiH':
-                            geometry = f'Li 0 0 0; H 0 0 {bond_length}'
-                        else:
-                            raise ValueError("Atomic symbol not supported; must be either 'H2' or 'LiH'")
-                        
-                        state, hamiltonian = get_state_and_hamiltonian(state_type=state_type, geometry=geometry, basis_set='sto-3g', active_orb=active_orbitals, n_elec=n_elec)
-
-                        _, energies = get_vqe_results_v2(
-                            state=state,
-                            hamiltonian=hamiltonian,
-                            optimizer=optimizer,
-                            estimator=estimator,
-                            filename=f'noisy/{state_type}/n_elec={n_elec}/no={active_orbitals}/shots{n_shots}_iters{n_iters}_scale{dep_error}'
-                        )
-
-                        depth = get_circuit_depth(state, 'ibm')
-                        n_varparams = state.num_parameters
-
-                        print(f"{state_type} Completed: shots={n_shots}, iters={n_iters}, dep_error={dep_error}, bond_length={bond_length}, depth={depth}, n_varparams={n_varparams}")
-
-                        results[key]['bond_lengths'].append(bond_length)
-                        results[key]['energies_per_iter'].append(energies)
-                        results[key]['depths'].append(depth)
-
-                        # Write energy_fav and depth to the file with spacing
-                        file.write(f"{n_shots:<10} {n_iters:<10} {dep_error:<12.6f} {depth:<10}\n")
-
-    return results
\ No newline at end of file
+        file.write(results_header)
+
+        coalescing = dict(coalesce=coalesce, max_batch_size=coalesce_batch_size, max_latency=coalesce_latency)
+        for task, result in _run_or_resume_sweep(tasks, n_workers, checkpoint_dir, pes_scan, extrapolate, coalescing):
+            print(f"{state_type} Completed: shots={task.n_shots}, iters={task.n_iters}, dep_error={task.dep_error}, bond_length={task.bond_length}, depth={result['depth']}, n_varparams={result['n_varparams']}")
+            record_result(results, file, task, result)
+
+    if draw_circuits:
+        wait_for_circuit_drawings()
+
+    return results
+
+# Header of the results .txt files, with spacing
+results_header = f"{'n_shots':<10} {'n_iters':<10} {'dep_error':<12} {'bond_length':<12} {'depth':<10} {'n_evals':<10} {'energy':<20}\n"
+
+def record_result(results, file, task, result):
+
+    """
+    Adds the result of a grid point to the results dict of run_vqe_simulation and writes its row to the results file
+        Args:
+            - results: dict, with keys (n_shots, n_iters, dep_error), see run_vqe_simulation
+            - file: file object of the results .txt file, whose header is results_header
+            - task: sweep.SweepTask instance
+            - result: dict, returned by sweep.run_sweep_task
+    """
+
+    entry = results.setdefault(task.key, {'bond_lengths': [], 'energies_per_iter': [], 'depths': [], 'final_energies': []})
+    entry['bond_lengths'].append(task.bond_length)
+    entry['energies_per_iter'].append(result['energies'])
+    entry['depths'].append(result['depth'])
+    entry['final_energies'].append(result['final_energy'])
+
+    # Write the grid point, depth, number of evaluations and last energy to the file with spacing
+    energies = result['energies']
+    file.write(f"{task.n_shots:<10} {task.n_iters:<10} {task.dep_error:<12.6f} {task.bond_length:<12.6f} {result['depth']:<10} {len(energies):<10} {float(energies[-1]):<20.10f}\n")
+
+def _run_or_resume_sweep(tasks, n_workers, checkpoint_dir, pes_scan=False, extrapolate=False, coalescing=None):
+
+    """
+    Yields the (task, result) of the tasks in order, like run_sweep, taking the results of the grid points
+    completed by a previous run from the manifest of checkpoint_dir and recording the new ones in it
+    """
+
+    coalescing = coalescing or {}
+
+    if checkpoint_dir is None:
+        yield from run_sweep(tasks, n_workers=n_workers, pes_scan=pes_scan, extrapolate=extrapolate, **coalescing)
+        return
+
+    manifest = SweepManifest(os.path.join(checkpoint_dir, 'manifest.jsonl'))
+    recorded = manifest.load()
+    completed = {task.index: manifest.get(recorded, task) for task in tasks if manifest.get(recorded, task) is not None}
+    running = run_sweep(tasks, n_workers=n_workers, pes_scan=pes_scan, extrapolate=extrapolate, completed=completed,
+                        **coalescing)
+    for task in tasks:
+        result = completed.get(task.index)
+        if result is None:
+            _, result = next(running)
+            manifest.record(task, result)
+            OptimizerCheckpoint(task_checkpoint_path(checkpoint_dir, task)).clear()
+        else:
+            print(f"{task.state_type} Skipped (completed in a previous run): shots={task.n_shots}, iters={task.n_iters}, dep_error={task.dep_error}, bond_length={task.bond_length}")
+        yield task, result
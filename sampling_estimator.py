@@ -0,0 +1,208 @@
+import numpy as np
+from qiskit.primitives import BaseEstimatorV2, StatevectorSampler
+from qiskit.primitives.containers import DataBin, PrimitiveResult, PubResult
+from qiskit.primitives.containers.estimator_pub import EstimatorPub
+from qiskit.primitives.primitive_job import PrimitiveJob
+from qiskit.quantum_info import SparsePauliOp
+from qiskit_aer.primitives import SamplerV2 as AerSamplerV2
+
+
+class SamplingEstimator(BaseEstimatorV2):
+
+    """
+    EstimatorV2 estimating expectation values from measurement samples, with a finite budget of shots
+    per energy evaluation, instead of adding Gaussian noise to the exact value.
+    The observable is partitioned into groups of qubit-wise commuting Pauli terms, each measured with
+    one circuit (the ansatz followed by the single-qubit rotations to the common eigenbasis, written with
+    rz and sx so that they stay in the ISA). The shots are shared between the groups in proportion to
+    the standard deviation of each group, which minimizes the variance of the energy for the total
+    budget; the standard deviations are estimated from the previous evaluations of the same observable,
+    and bounded by the sum of the absolute coefficients of the group before the first one.
+    The circuits of all the groups and all the parameter sets of a call are sent as a single sampler job.
+        Args:
+            - shots: int, total number of shots per energy evaluation (per parameter set)
+            - backend: qiskit_aer.AerSimulator, noisy backend sampled by an Aer SamplerV2; None for the exact
+            StatevectorSampler
+            - coupling_map: list, of [i, j] edges of the target the circuits are transpiled to; None for all-to-all
+            - basis_gates: list, of str, basis gates of the target; None to run the circuits untranspiled (only
+            without backend)
+            - seed: int, seed of the samplers
+    """
+
+    def __init__(self, shots, backend=None, coupling_map=None, basis_gates=None, seed=None):
+        if shots <= 0:
+            raise ValueError("The SamplingEstimator needs a positive number of shots")
+        self.shots = shots
+        self.backend = backend
+        self.coupling_map = coupling_map
+        self.basis_gates = basis_gates
+        self._rng = np.random.default_rng(seed)
+        self._groups = {}           # observable items -> (constant, list of (masks, coeffs, rotations))
+        self._group_stds = {}       # observable items -> np.ndarray, estimated std of each group per shot
+        self._circuits = {}         # (id(circuit), observable items) -> (circuit, measurement circuits)
+
+    def run(self, pubs, *, precision=None):
+
+        """
+        Estimates the expectation values of the pubs. A precision, if given, sets the number of shots
+        per evaluation to 1 / precision**2 (as get_estimator does the other way around).
+        """
+
+        shots = self.shots if precision is None else int(np.ceil(1 / precision ** 2))
+        coerced_pubs = [EstimatorPub.coerce(pub, precision) for pub in pubs]
+
+        job = PrimitiveJob(self._run, coerced_pubs, shots)
+        job._submit()
+        return job
+
+    def _sampler(self):
+        # A new seed per job, so that the shot noise of successive evaluations is independent. The statevector
+        # sampler gets a generator rather than the integer, which it would reuse for every circuit of the job
+        # (identical samples for the parameter sets of a batch and for the measurement groups)
+        seed = int(self._rng.integers(2**31))
+        if self.backend is None:
+            return StatevectorSampler(seed=np.random.default_rng(seed))
+        return AerSamplerV2.from_backend(self.backend, seed=seed)
+
+    def _run(self, pubs, shots):
+
+        # Lists the measurement circuits of all the pubs, then samples them in a single job
+        plans = []
+        sampler_pubs = []
+        for pub in pubs:
+            batch = int(np.prod(pub.parameter_values.shape, dtype=int))
+            values = pub.parameter_values.as_array(pub.circuit.parameters).reshape(batch, pub.circuit.num_parameters)
+            param_indices = np.arange(batch).reshape(pub.parameter_values.shape)
+            bc_indices, bc_obs = np.broadcast_arrays(param_indices, pub.observables)
+
+            obs_indices = {}
+            for index in np.ndindex(*bc_indices.shape):
+                obs_indices.setdefault(tuple(sorted(bc_obs[index].items())), []).append(index)
+
+            pub_plan = []
+            for items, indices in obs_indices.items():
+                constant, groups = self._get_groups(items)
+                circuits = self._get_measurement_circuits(pub.circuit, items, groups)
+                group_shots = self._allocate_shots(items, groups, shots)
+                first = len(sampler_pubs)
+                for circuit, n_shots in zip(circuits, group_shots):
+                    sampler_pubs.append((circuit, values, int(n_shots)))
+                pub_plan.append((items, indices, constant, groups, first))
+            plans.append((pub, bc_indices, pub_plan))
+
+        sampler_results = self._sampler().run(sampler_pubs).result() if sampler_pubs else []
+
+        results = []
+        for pub, bc_indices, pub_plan in plans:
+            evs = np.zeros(bc_indices.shape, dtype=np.float64)
+            stds = np.zeros(bc_indices.shape, dtype=np.float64)
+            for items, indices, constant, groups, first in pub_plan:
+                means, variances = self._estimate(groups, sampler_results[first:first + len(groups)], items)
+                for index in indices:
+                    evs[index] = constant + means[bc_indices[index]]
+                    stds[index] = np.sqrt(variances[bc_indices[index]])
+            data = DataBin(evs=evs, stds=stds, shape=evs.shape)
+            results.append(PubResult(data, metadata={'shots': shots, 'n_groups': [len(plan[3]) for plan in pub_plan],
+                                                      'circuit_metadata': pub.circuit.metadata}))
+        return PrimitiveResult(results, metadata={'version': 2})
+
+    def _get_groups(self, items):
+
+        """
+        Returns the constant (identity) part of the observable and its qubit-wise commuting groups, as
+        (masks, coeffs, rotations): masks[j, q] tells whether term j acts on qubit q, coeffs[j] is its
+        real coefficient, and rotations[q] the Pauli measured on qubit q ('X', 'Y', 'Z' or 'I')
+        """
+
+        if items in self._groups:
+            return self._groups[items]
+
+        observable = SparsePauliOp.from_list(list(items)).simplify()
+        is_identity = ~(observable.paulis.z | observable.paulis.x).any(axis=1)
+        constant = float(np.real(observable.coeffs[is_identity].sum()))
+
+        groups = []
+        if not is_identity.all():
+            for group in observable[~is_identity].group_commuting(qubit_wise=True):
+                z, x = group.paulis.z, group.paulis.x
+                masks = z | x
+                rotations = ['I'] * group.num_qubits
+                for q in range(group.num_qubits):
+                    for term in range(len(group)):
+                        if masks[term, q]:
+                            rotations[q] = 'Y' if (z[term, q] and x[term, q]) else ('X' if x[term, q] else 'Z')
+                            break
+                # The phase of the Pauli labels (e.g. -Y) is folded in the coefficients
+                phases = (-1j) ** group.paulis.phase
+                groups.append((masks, np.real(group.coeffs * phases), rotations))
+
+        self._groups[items] = (constant, groups)
+        return self._groups[items]
+
+    def _get_measurement_circuits(self, circuit, items, groups):
+        key = (id(circuit), items)
+        if key in self._circuits:
+            return self._circuits[key][1]
+
+        circuits = []
+        for _, _, rotations in groups:
+            measured = circuit.copy()
+            for q, pauli in enumerate(rotations):
+                if pauli == 'X':    # H, up to a global phase
+                    measured.rz(np.pi / 2, q)
+                    measured.sx(q)
+                    measured.rz(np.pi / 2, q)
+                elif pauli == 'Y':  # H Sdg, up to a global phase
+                    measured.sx(q)
+                    measured.rz(np.pi / 2, q)
+            measured.measure_all()
+            circuits.append(measured)
+
+        self._circuits[key] = (circuit, circuits)   # keeps the circuit alive, so that its id is not reused
+        return circuits
+
+    def _allocate_shots(self, items, groups, shots):
+
+        """
+        Shares the shots between the groups in proportion to their standard deviations, with at least
+        one shot per group
+        """
+
+        if items in self._group_stds:
+            weights = self._group_stds[items]
+        else:
+            weights = np.array([np.abs(coeffs).sum() for _, coeffs, _ in groups])
+        # Small floor, so that a group whose samples happened to be constant keeps being measured
+        weights = np.maximum(weights, 1e-3 * weights.max() + 1e-12)
+
+        n_groups = len(groups)
+        spare = max(shots - n_groups, 0)
+        exact = spare * weights / weights.sum()
+        group_shots = 1 + np.floor(exact).astype(int)
+        remainder = spare - (group_shots - 1).sum()
+        group_shots[np.argsort(exact - np.floor(exact))[::-1][:remainder]] += 1
+        return group_shots
+
+    def _estimate(self, groups, sampler_results, items):
+
+        """
+        Returns the sum over the groups of the sample means, and its variance, for each parameter set,
+        and updates the estimated standard deviations of the groups
+        """
+
+        means = 0.0
+        variances = 0.0
+        stds = []
+        for (masks, coeffs, _), result in zip(groups, sampler_results):
+            bit_array = result.data.meas
+            # (batch, shots, num_bits) outcomes, bit q being the outcome of qubit q
+            bits = np.unpackbits(bit_array.array, axis=-1)[..., ::-1][..., :bit_array.num_bits]
+            bits = bits.reshape(-1, bit_array.num_shots, bit_array.num_bits)
+            parities = (bits.astype(np.int64) @ masks.T.astype(np.int64)) % 2
+            samples = (1 - 2 * parities) @ coeffs      # (batch, shots) values of the group observable
+            means = means + samples.mean(axis=1)
+            variance = samples.var(axis=1, ddof=1) if bit_array.num_shots > 1 else np.abs(coeffs).sum() ** 2
+            variances = variances + variance / bit_array.num_shots
+            stds.append(np.sqrt(np.mean(variance)))
+        self._group_stds[items] = np.array(stds)
+        return means, variances
@@ -0,0 +1,169 @@
+import os
+from typing import NamedTuple
+import numpy as np
+
+
+# Rough cost model of the Aer simulation methods, measured with Aer 0.17 on one core (EfficientSU2 circuits of
+# 6 to 12 qubits): a fixed cost per job, and a cost per gate and per amplitude (or per element of the density
+# matrix, or per tensor element cubed for the matrix product states)
+_seconds_per_job = 0.01
+_seconds_per_update = 4e-9
+_seconds_per_mps_update = 5e-8
+_bytes_per_amplitude = 16   # complex128
+
+# Fraction of the available memory given to the simulations when no memory budget is set
+default_memory_fraction = 0.8
+
+
+class MethodEstimate(NamedTuple):
+
+    """
+    Estimated cost of one Aer simulation method for an energy evaluation: memory of the simulated state, and time
+    of one evaluation (one job). Methods that cannot give the requested expectation values (e.g. statevector with
+    noise and no shots) are not applicable.
+    """
+
+    method: str
+    memory_bytes: float
+    seconds_per_evaluation: float
+    exact: bool
+    applicable: bool
+    note: str
+
+
+class SimulationPlan(NamedTuple):
+
+    """
+    Simulation method selected by plan_simulation, with the estimates of all the methods
+    """
+
+    method: str
+    trajectories: int
+    memory_budget: float
+    n_evaluations: int
+    estimates: list
+
+    @property
+    def selected(self):
+        return next(estimate for estimate in self.estimates if estimate.method == self.method)
+
+    def log_lines(self):
+
+        """
+        Returns the decision and the estimates as lines of text, e.g. for the header of a .out file
+        """
+
+        selected = self.selected
+        return [f"Simulation method: {self.method}"
+                + (f" ({self.trajectories} noise trajectories per evaluation)" if self.trajectories else "")
+                + f", memory {_format_bytes(selected.memory_bytes)} of a budget of {_format_bytes(self.memory_budget)},"
+                f" about {selected.seconds_per_evaluation * self.n_evaluations:.0f} s for {self.n_evaluations} evaluations"
+                ] + self.estimate_lines()
+
+    def estimate_lines(self):
+        lines = []
+        for estimate in self.estimates:
+            status = ('selected' if estimate.method == self.method
+                      else 'over budget' if estimate.applicable and estimate.memory_bytes > self.memory_budget
+                      else '' if estimate.applicable else 'not applicable')
+            lines.append(f"  {estimate.method:<22} {_format_bytes(estimate.memory_bytes):>10} "
+                         f"{estimate.seconds_per_evaluation:>10.3g} s/evaluation  {status:<14} {estimate.note}")
+        return lines
+
+
+def available_memory():
+
+    """
+    Returns the memory available to new processes, in bytes (MemAvailable of /proc/meminfo, or the physical memory
+    on systems without it)
+    """
+
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def estimate_methods(nqubits, n_gates, n_2q_gates, noisy, n_shots=0):
+
+    """
+    Returns the estimated memory and time of an energy evaluation with each Aer simulation method. Without noise,
+    statevector and matrix_product_state are exact. With noise, density_matrix is exact (4^n memory), while
+    statevector and matrix_product_state average the expectation values over n_shots noise trajectories, so they
+    only apply when the energies are estimated from n_shots shots anyway.
+    The bond dimension of the matrix product state is bounded by 2^(n/2) and by 2 to the number of two-qubit gates
+    per cut between neighboring qubits.
+        Args:
+            - nqubits: int, number of qubits
+            - n_gates: int, number of gates of the transpiled circuit
+            - n_2q_gates: int, number of two-qubit gates of the transpiled circuit
+            - noisy: bool, whether the simulation has a noise model
+            - n_shots: int, number of shots of an energy evaluation; 0 for exact expectation values
+        Returns:
+            - estimates: list, of MethodEstimate instances
+    """
+
+    trajectories = n_shots if noisy else 1
+    trajectory_note = (f"average of {n_shots} noise trajectories" if noisy and n_shots
+                       else "needs shots with noise" if noisy else "exact")
+    bond_dimension = 2.0 ** min(nqubits // 2, int(np.ceil(n_2q_gates / max(nqubits - 1, 1))))
+
+    def seconds(updates):
+        return _seconds_per_job + updates
+
+    return [
+        MethodEstimate(
+            'statevector', _bytes_per_amplitude * 2.0 ** nqubits,
+            seconds(_seconds_per_update * n_gates * 2.0 ** nqubits * max(trajectories, 1)),
+            exact=not noisy, applicable=not noisy or n_shots > 0, note=trajectory_note),
+        MethodEstimate(
+            'density_matrix', _bytes_per_amplitude * 4.0 ** nqubits,
+            seconds(_seconds_per_update * n_gates * 4.0 ** nqubits),
+            exact=True, applicable=True, note='exact'),
+        MethodEstimate(
+            'matrix_product_state', _bytes_per_amplitude * 2 * nqubits * bond_dimension ** 2,
+            seconds(_seconds_per_mps_update * n_gates * bond_dimension ** 3 * max(trajectories, 1)),
+            exact=not noisy, applicable=not noisy or n_shots > 0,
+            note=f"{trajectory_note}, bond dimension up to {bond_dimension:.0f}"),
+    ]
+
+
+def plan_simulation(nqubits, n_gates, n_2q_gates, noisy, n_shots=0, memory_budget=None, n_evaluations=1):
+
+    """
+    Returns the fastest Aer simulation method whose state fits in the memory budget (see estimate_methods).
+    An exact method is preferred to trajectories of the same estimated time.
+        Args:
+            - nqubits, n_gates, n_2q_gates, noisy, n_shots: see estimate_methods
+            - memory_budget: float, memory in bytes available to the simulation; None for default_memory_fraction of
+            the available memory
+            - n_evaluations: int, number of energy evaluations of the run, for the estimate of its total time
+        Returns:
+            - plan: SimulationPlan instance
+        Raises:
+            - MemoryError: if no applicable method fits in the budget, with the estimates in the message, instead of
+            the simulator being killed when it runs out of memory
+    """
+
+    if memory_budget is None:
+        memory_budget = default_memory_fraction * available_memory()
+    estimates = estimate_methods(nqubits, n_gates, n_2q_gates, noisy, n_shots)
+    candidates = [estimate for estimate in estimates if estimate.applicable and estimate.memory_bytes <= memory_budget]
+    plan = SimulationPlan(None, 0, memory_budget, n_evaluations, estimates)
+    if not candidates:
+        raise MemoryError("No simulation method fits in the memory budget"
+                          + ("" if n_shots or not noisy else " (with noise and no shots, only density_matrix applies)")
+                          + ":\n" + "\n".join(plan.estimate_lines()))
+    best = min(candidates, key=lambda estimate: (estimate.seconds_per_evaluation, not estimate.exact))
+    return plan._replace(method=best.method, trajectories=0 if best.exact else n_shots)
+
+
+def _format_bytes(n_bytes):
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if n_bytes < 1024 or unit == 'TB':
+            return f"{n_bytes:.1f} {unit}" if unit != 'B' else f"{n_bytes:.0f} B"
+        n_bytes /= 1024
@@ -1,15 +1,152 @@
 from utils import make_geometry
+from cache import HamiltonianCache
+from profiling import timed
+import numpy as np
 from qiskit.circuit.library import EfficientSU2
-from qiskit_nature.second_q.drivers import PySCFDriver
-from qiskit_nature.second_q.mappers import JordanWignerMapper
+from qiskit_nature.second_q.mappers import JordanWignerMapper, ParityMapper, TaperedQubitMapper
 from qiskit_nature.second_q.circuit.library.ansatzes.uccsd import UCCSD
 from qiskit_nature.second_q.circuit.library import HartreeFock
-from qiskit_nature.second_q.transformers import ActiveSpaceTransformer
-from qiskit.quantum_info import SparsePauliOp
-from qiskit_algorithms import NumPyMinimumEigensolver
-from qiskit_nature.second_q.algorithms import GroundStateEigensolver
+from qiskit_nature.second_q.circuit.library.initial_states.hartree_fock import hartree_fock_bitstring
+from qiskit.quantum_info import SparsePauliOp, Statevector
+from qiskit.quantum_info.analysis import Z2Symmetries
+from scipy.sparse.linalg import eigsh
 
 
+# Cache of the reduced problems shared by all the functions of this module
+hamiltonian_cache = HamiltonianCache()
+
+
+def _get_reduced_problem(
+            geometry,
+            basis_set,
+            active_orb,
+            n_elec,
+            charge=0,
+            spin=0
+            ):
+
+    """
+    Runs PySCF on the molecule and returns the problem reduced to the active space
+    """
+
+    # PySCF is only needed when the reduced problem is not in the Hamiltonian cache
+    from qiskit_nature.second_q.drivers import PySCFDriver
+    from qiskit_nature.second_q.transformers import ActiveSpaceTransformer
+
+    driver = PySCFDriver(
+        atom=geometry,
+        basis=basis_set,
+        charge=charge,
+        spin=spin,
+    )
+    transformer = ActiveSpaceTransformer(
+        num_electrons=n_elec,            # Keep n_elec valence electrons
+        num_spatial_orbitals=active_orb      # Keep active_orb orbitals (e.g. 3 --> HOMO, LUMO, LUMO+1)
+    )
+
+    with timed('pyscf_driver'):
+        problem = driver.run()
+    with timed('active_space_transform'):
+        return transformer.transform(problem)
+
+def _make_record(reduced_problem, mapper, fci_energy=np.nan):
+
+    """
+    Returns the cache record (see HamiltonianCache.put) of a reduced problem
+    """
+
+    with timed('pauli_mapping'):
+        hamiltonian_op = mapper.map(reduced_problem.hamiltonian.second_q_op())
+    num_particles = tuple(int(n) for n in reduced_problem.num_particles)
+
+    return {
+        'hamiltonian': hamiltonian_op,
+        'nuclear_repulsion': reduced_problem.hamiltonian.nuclear_repulsion_energy,
+        'core_energy': reduced_problem.hamiltonian.constants['ActiveSpaceTransformer'],
+        'num_spatial_orbitals': reduced_problem.num_spatial_orbitals,
+        'num_particles': num_particles,
+        'hf_occupation': np.array(hartree_fock_bitstring(reduced_problem.num_spatial_orbitals, num_particles)),
+        'fci_energy': fci_energy,
+    }
+
+def get_active_space_data(
+            geometry : str = 'H 0 0 0; H 0 0 0.7410102132613643;',
+            basis_set : str = 'sto-3g',
+            active_orb : int = 2,
+            n_elec : int = 2,
+            mapper = JordanWignerMapper(),
+            charge : int = 0,
+            spin : int = 0,
+            ):
+
+    """
+    Returns the qubit Hamiltonian and the properties of the system in the active space, from the
+    Hamiltonian cache if available, otherwise by running PySCF, the ActiveSpaceTransformer and the mapper.
+        Args:
+            - geometry : str, geometry string of the molecule, e.g. 'Li 0 0 0; H 0 0 1.595'
+            - basis_set : str, any from the pyscf basis set databank, e.g. 'sto-3g'
+            - active_orb : int, number of active orbitals in active space
+            - n_elec : int, number of electrons used in the simulation, the rest is frozen
+            - mapper : qiskit_nature.second_q.mappers, fermion-to-qubit mapper, e.g. JordanWignerMapper() or ParityMapper()
+            - charge : int, charge of the molecule
+            - spin : int, spin of the molecule (2S)
+        Returns:
+            - record : dict, see HamiltonianCache.put
+    """
+
+    key = hamiltonian_cache.make_key(geometry, basis_set, charge, spin, active_orb, n_elec, mapper)
+    record = hamiltonian_cache.get(key)
+    if record is None:
+        reduced_problem = _get_reduced_problem(geometry, basis_set, active_orb, n_elec, charge, spin)
+        record = _make_record(reduced_problem, mapper)
+        hamiltonian_cache.put(key, record)
+    return record
+
+def get_record_mapper(symmetry_reduction=None, n_elec=2, spin=0, mapper=JordanWignerMapper()):
+
+    """
+    Returns the mapper of the qubit Hamiltonian stored in the Hamiltonian cache for a symmetry reduction (see
+    get_state_and_hamiltonian), before the tapering of the Z2 symmetries
+        Args:
+            - symmetry_reduction : str, None, 'parity' or 'tapered'
+            - n_elec : int, number of active electrons
+            - spin : int, spin of the molecule (2S)
+            - mapper : qiskit_nature.second_q.mappers, mapper used without symmetry reduction
+        Returns:
+            - mapper : qiskit_nature.second_q.mappers, the ParityMapper with the two-qubit reduction, or the given mapper
+    """
+
+    if symmetry_reduction is None:
+        return mapper
+    if symmetry_reduction in ('parity', 'tapered'):
+        return ParityMapper(num_particles=((n_elec + spin) // 2, (n_elec - spin) // 2))
+    raise ValueError("Symmetry reduction not supported; must be None, 'parity' or 'tapered'")
+
+def get_tapered_mapper(record, mapper):
+
+    """
+    Returns the mapper tapering off the qubits of the Z2 symmetries of the qubit Hamiltonian of a record, in the
+    symmetry sector of the Hartree-Fock state (as ElectronicStructureProblem.get_tapered_mapper, from the record
+    alone, so that the PySCF problem need not be built again when the record is in the Hamiltonian cache)
+        Args:
+            - record : dict, see HamiltonianCache.put, obtained with mapper
+            - mapper : qiskit_nature.second_q.mappers, fermion-to-qubit mapper of the record, e.g. ParityMapper(num_particles)
+        Returns:
+            - tapered_mapper : qiskit_nature.second_q.mappers.TaperedQubitMapper, also mapping (and tapering) the
+            excitations of the ansatze; operators not commuting with the symmetries are dropped by it
+    """
+
+    z2symmetries = Z2Symmetries.find_z2_symmetries(record['hamiltonian'])
+    if z2symmetries.is_empty():
+        return TaperedQubitMapper(mapper)
+    hf_state = HartreeFock(record['num_spatial_orbitals'], record['num_particles'], mapper)
+    index = int(np.argmax(np.abs(Statevector(hf_state).data)))
+    hf_bits = np.array([(index >> q) & 1 for q in range(record['hamiltonian'].num_qubits)], dtype=bool)
+    # The eigenvalue of the Hartree-Fock basis state for each symmetry (products of Z)
+    tapering_values = [int((-1) ** np.count_nonzero(symmetry.z & hf_bits)) for symmetry in z2symmetries.symmetries]
+    return TaperedQubitMapper(mapper, Z2Symmetries(z2symmetries.symmetries, z2symmetries.sq_paulis,
+                                                   z2symmetries.sq_list, tapering_values=tapering_values))
+
 def get_state_and_hamiltonian(
             state_type: str = 'UCCSD',
             geometry : str = 'H 0 0 0; H 0 0 0.7410102132613643;',
@@ -17,112 +154,173 @@ def get_state_and_hamiltonian(
             active_orb : int = 2,
             n_elec : int = 2,
             mapper = JordanWignerMapper(),
+            charge : int = 0,
+            spin : int = 0,
+            adapt_pool : str = 'fermionic',
+            adapt_threshold : float = 1e-3,
+            symmetry_reduction : str = None,
             ):
-    
+
     """
-    Returns the quantum circuit preparing the state (UCCSD or EfficientSU2) and the Hamiltonian of the system in the active space.
-        Args: 
-            - state_type : str, 'UCCSD' or 'EfficientSU2'
-            - mol : 'H2' or 'LiH'
+    Returns the quantum circuit preparing the state (UCCSD, EfficientSU2 or ADAPT) and the Hamiltonian of the system in the active space.
+        Args:
+            - state_type : str, 'UCCSD', 'EfficientSU2' or 'ADAPT' (ansatz grown from the Hartree-Fock state one excitation at a
+            time, see adapt.py; its metadata holds the parameters optimized during its construction)
+            - geometry : str, geometry string of the molecule, e.g. 'Li 0 0 0; H 0 0 1.595'
             - basis_set : str, any from the pyscf basis set databank, e.g. 'sto-3g'
             - active_orb : int, number of active orbitals in active space
-            - n_elec : int, number of electrons used in the simulation, the rest is frozen     
+            - n_elec : int, number of electrons used in the simulation, the rest is frozen
             - mapper : qiskit_nature.second_q.mappers, fermion-to-qubit mapper, e.g. JordanWignerMapper() or ParityMapper()
+            - charge : int, charge of the molecule (neutral molecule by default)
+            - spin : int, spin of the molecule (2S, singlet state by default)
+            - adapt_pool : str, 'fermionic' or 'qubit' excitation pool of the ADAPT ansatz
+            - adapt_threshold : float, largest energy gradient of the pool below which the ADAPT ansatz stops growing
+            - symmetry_reduction : str, None for the given mapper, 'parity' for the ParityMapper with the two-qubit reduction
+            (2 qubits less), or 'tapered' for the parity mapping with the qubits of the other Z2 symmetries of the Hamiltonian
+            tapered off (see get_tapered_mapper), e.g. 4 qubits instead of 8 for LiH with 4 active orbitals. The Hamiltonian
+            and the ansatz are reduced consistently, in the sector of the Hartree-Fock state, and the qubit count of the
+            state follows (hamiltonian_full.num_qubits)
         Returns:
-            - state : qiskit.circuit.QuantumCircuit, the quantum circuit preparing the state (UCCSD or EfficientSU2)
+            - state : qiskit.circuit.QuantumCircuit, the quantum circuit preparing the state
             - hamiltonian_full : qiskit.quantum_info.SparsePauliOp, the Hamiltonian of the system in the active space,
             including the nuclear repulsion energy and core electrons energies as a constant offset
     """
 
-    driver = PySCFDriver(
-        atom=geometry,
-        basis=basis_set,
-        charge=0,   # neutral molecule assumed
-        spin=0,     # singlet state assumed
-    )
-    transformer = ActiveSpaceTransformer(
-        num_electrons=n_elec,            # Keep n_elec valence electrons
-        num_spatial_orbitals=active_orb      # Keep active_orb orbitals (e.g. 3 --> HOMO, LUMO, LUMO+1)
-    )
+    mapper = get_record_mapper(symmetry_reduction, n_elec, spin, mapper)
+    record = get_active_space_data(geometry, basis_set, active_orb, n_elec, mapper, charge, spin)
+    hamiltonian_op = record['hamiltonian']
+    if symmetry_reduction == 'tapered':
+        mapper = get_tapered_mapper(record, mapper)
+        if not mapper.z2symmetries.is_empty():
+            hamiltonian_op = mapper.z2symmetries.taper(hamiltonian_op)
 
-    problem = driver.run()
-    reduced_problem = transformer.transform(problem)
     hf_state = HartreeFock(
-            num_spatial_orbitals=reduced_problem.num_spatial_orbitals,
-            num_particles=reduced_problem.num_particles,
+            num_spatial_orbitals=record['num_spatial_orbitals'],
+            num_particles=record['num_particles'],
             qubit_mapper=mapper
         )
     if state_type == 'UCCSD':
         state = UCCSD(
-            num_spatial_orbitals=reduced_problem.num_spatial_orbitals,
-            num_particles=reduced_problem.num_particles,
+            num_spatial_orbitals=record['num_spatial_orbitals'],
+            num_particles=record['num_particles'],
             qubit_mapper=mapper,
             initial_state=hf_state
             )
     elif state_type == 'EfficientSU2':
-        state = EfficientSU2(num_qubits=reduced_problem.num_spin_orbitals,
+        state = EfficientSU2(num_qubits=hamiltonian_op.num_qubits,
                              initial_state=hf_state)
-    else:
-        raise ValueError("The ansatz type is unsupported. Must be 'UCCSD' or 'EfficientSU2'.")
-        
-        
-    hamiltonian_op = mapper.map(reduced_problem.hamiltonian.second_q_op())
+    elif state_type != 'ADAPT':
+        raise ValueError("The ansatz type is unsupported. Must be 'UCCSD', 'EfficientSU2' or 'ADAPT'.")
+
 
     # Add nuclear repulsion energy and core electrons energies
     # QITE minimizes the electronic part, but to match the values found in the literature, we add these constants.
-    nuclear_repulsion = reduced_problem.hamiltonian.nuclear_repulsion_energy
-    core_energy = reduced_problem.hamiltonian.constants['ActiveSpaceTransformer']
+    nuclear_repulsion = record['nuclear_repulsion']
+    core_energy = record['core_energy']
 
     hamiltonian_full = hamiltonian_op + SparsePauliOp(["I" * hamiltonian_op.num_qubits], coeffs=[nuclear_repulsion+core_energy])
 
+    if state_type == 'ADAPT':
+        from adapt import get_adapt_ansatz
+        state = get_adapt_ansatz(hf_state, hamiltonian_full, record['num_spatial_orbitals'], record['num_particles'], mapper,
+                                 pool=adapt_pool, gradient_threshold=adapt_threshold)
+
     return state, hamiltonian_full
 
+def _sector_indices(num_spatial_orbitals, num_particles):
+
+    """
+    Returns the indices of the Jordan-Wigner basis states with num_particles = (n_alpha, n_beta) electrons,
+    the alpha spin orbitals being the first num_spatial_orbitals qubits (qiskit_nature block ordering)
+    """
+
+    states = np.arange(2 ** (2 * num_spatial_orbitals))
+    alpha = states & ((1 << num_spatial_orbitals) - 1)
+    beta = states >> num_spatial_orbitals
+    popcount = lambda values: np.array([bin(value).count('1') for value in range(1 << num_spatial_orbitals)])[values]
+    return states[(popcount(alpha) == num_particles[0]) & (popcount(beta) == num_particles[1])]
+
+def sector_ground_energy(record):
+
+    """
+    Returns the lowest eigenvalue of the Jordan-Wigner qubit Hamiltonian of a record in its sector of
+    (n_alpha, n_beta) electrons, i.e. the electronic FCI energy in the active space. The Hamiltonian is
+    built as a scipy sparse matrix and restricted to the sector before being diagonalized with ARPACK
+    (Lanczos), or densely when the sector is small.
+        Args:
+            - record: dict, see HamiltonianCache.put, obtained with a JordanWignerMapper
+        Returns:
+            - energy: float, electronic ground-state energy in the sector
+    """
+
+    indices = _sector_indices(record['num_spatial_orbitals'], record['num_particles'])
+    matrix = record['hamiltonian'].to_matrix(sparse=True)[indices][:, indices]
+    if len(indices) <= 64:
+        return float(np.linalg.eigvalsh(matrix.toarray())[0])
+    # The Hamiltonian is real in the molecular orbital basis
+    matrix = matrix.real if np.abs(matrix.imag).max() < 1e-12 else matrix
+    return float(eigsh(matrix, k=1, which='SA', return_eigenvectors=False)[0])
+
 def get_fci_energy(
             atomic_symbol : str = 'LiH',
             basis_set : str = 'sto-3g',
             active_orb : int = 2,
             n_elec : int = 2,
             mapper = JordanWignerMapper(),
+            bond_length : float = None,
+            geometry : str = None,
             ):
-    
+
     """
     Returns the exact ground state energy (FCI) of the system in the active space, to be used as a reference for the VQE results.
-        Args: 
+    The FCI energy does not depend on the mapper: it is the lowest eigenvalue of the Jordan-Wigner Hamiltonian in the sector of
+    the number of alpha and beta electrons (see sector_ground_energy), stored in the Hamiltonian cache together with the reduced
+    problem of its geometry, basis set and active space.
+        Args:
             atomic_symbol : str, 'H2' or 'LiH',
             basis_set : str, any from the pyscf basis set databank, e.g. 'sto-3g'
             active_orb : int, number of active orbitals in active space
-            n_elec : int, number of electrons used in the simulation, the rest is frozen    
-            mapper : qiskit_nature.second_q.mappers, fermion-to-qubit mapper, e.g. JordanWignerMapper() or ParityMapper()
+            n_elec : int, number of electrons used in the simulation, the rest is frozen
+            mapper : qiskit_nature.second_q.mappers, fermion-to-qubit mapper of the VQE, not used
+            bond_length : float, bond length in Angstrom; None for the equilibrium geometry
+            geometry : str, geometry string of the molecule, overriding atomic_symbol and bond_length
         Returns:
             fci_energy : float, the exact ground state energy (FCI) of the system in the active space
     """
 
-    geometry = make_geometry(atomic_symbol)
-    driver = PySCFDriver(
-        atom=geometry,
-        basis=basis_set,
-        charge=0,   # neutral molecule assumed
-        spin=0,     # singlet state assumed
-    )
-    transformer = ActiveSpaceTransformer(
-        num_electrons=n_elec,            # Keep n_elec valence electrons
-        num_spatial_orbitals=active_orb      # Keep active_orb orbitals (e.g. 3 --> HOMO, LUMO, LUMO+1)
-    )
-
-    problem = driver.run()
-    reduced_problem = transformer.transform(problem)
+    if geometry is None:
+        geometry = make_geometry(atomic_symbol, bond_length)
+    jw_mapper = JordanWignerMapper()
+    key = hamiltonian_cache.make_key(geometry, basis_set, 0, 0, active_orb, n_elec, jw_mapper)
+    record = get_active_space_data(geometry, basis_set, active_orb, n_elec, jw_mapper)
+    if not np.isnan(record['fci_energy']):
+        return record['fci_energy']
 
-    # Setup the exact classical solver
-    numpy_solver = NumPyMinimumEigensolver()
+    # Add nuclear repulsion energy and core electrons energies, as in get_state_and_hamiltonian
+    fci_energy = sector_ground_energy(record) + record['nuclear_repulsion'] + record['core_energy']
+    hamiltonian_cache.put(key, dict(record, fci_energy=fci_energy))
 
-    # Use the GroundStateEigensolver wrapper to handle the chemistry logic
-    # Note: Use the same mapper you used for VQE to ensure consistency
-    exact_calc = GroundStateEigensolver(mapper, numpy_solver)
+    return fci_energy
 
-    # Solve the problem (using your transformed problem from your code)
-    exact_result = exact_calc.solve(reduced_problem)
+def get_fci_energies(
+            atomic_symbol : str = 'LiH',
+            bond_lengths : list = (1.595,),
+            basis_set : str = 'sto-3g',
+            active_orb : int = 2,
+            n_elec : int = 2,
+            ):
 
-    # Extract the total energy (Electronic + Nuclear Repulsion)
-    fci_energy = exact_result.total_energies[0]
+    """
+    Returns the FCI energies of a molecule at several bond lengths, e.g. the reference of a potential energy surface
+        Args:
+            atomic_symbol : str, 'H2' or 'LiH'
+            bond_lengths : list, of N_dist floats, bond lengths in Angstrom
+            basis_set, active_orb, n_elec : see get_fci_energy
+        Returns:
+            fci_energies : np.ndarray, of N_dist floats
+    """
 
-    return fci_energy
\ No newline at end of file
+    return np.array([
+        get_fci_energy(atomic_symbol, basis_set, active_orb, n_elec, bond_length=bond_length)
+        for bond_length in bond_lengths
+    ])
@@ -0,0 +1,486 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import NamedTuple
+import numpy as np
+from results_store import NpzSink, TextSink
+from checkpoint import OptimizerCheckpoint, task_checkpoint_path
+from utils import get_circuit_metrics, make_geometry
+import profiling
+
+
+default_p1 = 0.001  # Default single-qubit depolarizing error probability
+default_p2 = 0.02   # Default two-qubit depolarizing error probability
+
+# Number of worker processes of the sweep sharing the memory of the machine, set in each worker (see _init_worker)
+_n_worker_processes = 1
+
+
+class SweepTask(NamedTuple):
+
+    """
+    One grid point of a VQE sweep, run independently of the others
+    """
+
+    index: int
+    atomic_symbol: str
+    state_type: str
+    bond_length: float
+    n_shots: int
+    n_iters: int
+    dep_error: float
+    active_orbitals: int
+    n_elec: int
+    optimizer_name: str = 'spsa'
+    regularization: float = 1e-8
+    max_evals_grouped: int = 1
+    seed: int = 0
+    max_parallel_threads: int = 0
+    estimator_name: str = 'noisy'
+    results_store: str = None
+    checkpoint_dir: str = None
+    checkpoint_every: int = 10
+    convergence_tol: float = None
+    convergence_window: int = 10
+    warm_start_magnitude: float = 0.1
+    topology: str = 'heavy_hex'
+    simulation_method: str = 'plan'
+    memory_budget: float = None
+    symmetry_reduction: str = None
+    n_starts: int = 1
+    profile_dir: str = None
+    profiler: str = None
+
+    @property
+    def key(self):
+        return (self.n_shots, self.n_iters, self.dep_error)
+
+    @property
+    def out_filename(self):
+        reduction = f'_{self.symmetry_reduction}' if self.symmetry_reduction else ''
+        return (f'noisy/{self.state_type}/n_elec={self.n_elec}/no={self.active_orbitals}/'
+                f'shots{self.n_shots}_iters{self.n_iters}_scale{self.dep_error}_bl{self.bond_length}{reduction}')
+
+
+def make_sweep_tasks(
+        atomic_symbol,
+        state_type,
+        bond_lengths,
+        n_shots_list,
+        n_iters_list,
+        depolarizing_errors,
+        active_orbitals,
+        n_elec,
+        optimizer_name='spsa',
+        regularization=1e-8,
+        max_evals_grouped=1,
+        seed=0,
+        max_parallel_threads=0,
+        estimator_name='noisy',
+        results_store=None,
+        checkpoint_dir=None,
+        checkpoint_every=10,
+        convergence_tol=None,
+        convergence_window=10,
+        warm_start_magnitude=0.1,
+        topology='heavy_hex',
+        simulation_method='plan',
+        memory_budget=None,
+        symmetry_reduction=None,
+        n_starts=1,
+        profile_dir=None,
+        profiler=None
+    ):
+
+    """
+    Returns the list of grid points of a sweep, in the order of the nested loops
+    n_shots > n_iters > dep_error > bond_length. Each task gets its own seed, derived from the
+    sweep seed and the position of the task in the grid, so that results do not depend on the
+    order or the process in which the tasks are run.
+        Args:
+            - see run_vqe_simulation in run.py
+            - seed: int, seed of the sweep
+            - max_parallel_threads: int, max number of threads of the Aer simulator of each task
+            - estimator_name: str, estimator of the tasks, see get_estimator in estimator.py
+            - results_store: str, folder of the ResultStore receiving the evaluations of the tasks (see results_store.py);
+            None to write them to .out files
+            - checkpoint_dir: str, folder of the optimizer checkpoints of the tasks (see checkpoint.py); None to disable them
+            - checkpoint_every: int, number of optimizer iterations between two checkpoints
+            - convergence_tol, convergence_window: early stopping of the optimizer, see get_optimizer in optimizer.py
+            - warm_start_magnitude: float, size of the first optimizer step of the tasks started from the parameters of
+            a neighboring geometry (see run_pes_series)
+            - topology: str, qubit connectivity of the simulated device, see make_coupling_map in estimator.py
+            - simulation_method: str, Aer simulation method, e.g. 'automatic', 'statevector', 'density_matrix', or 'plan'
+            to select it from the estimated memory and time of each method (see simulation_plan.py)
+            - memory_budget: float, memory in bytes available to the simulation of each task, for simulation_method='plan';
+            None for a share of the available memory, measured when the task runs (see plan_task_simulation)
+            - symmetry_reduction: str, None, 'parity' or 'tapered', see get_state_and_hamiltonian in state_and_hamiltonian.py
+            - n_starts: int, number of initial points of each task, pruned by successive halving (see multistart.py)
+            - profile_dir: str, folder of the timings of the stages of each task (see run_sweep_task); None to disable them
+            - profiler: str, 'cprofile' or 'pyinstrument' to also profile each task; None to only time the stages
+        Returns:
+            - tasks: list, of SweepTask instances
+    """
+
+    grid = [
+        (n_shots, n_iters, dep_error, bond_length)
+        for n_shots in n_shots_list
+        for n_iters in n_iters_list
+        for dep_error in depolarizing_errors
+        for bond_length in bond_lengths
+    ]
+    task_seeds = np.random.SeedSequence(seed).generate_state(len(grid))
+
+    return [
+        SweepTask(
+            index=index,
+            atomic_symbol=atomic_symbol,
+            state_type=state_type,
+            bond_length=bond_length,
+            n_shots=n_shots,
+            n_iters=n_iters,
+            dep_error=dep_error,
+            active_orbitals=active_orbitals,
+            n_elec=n_elec,
+            optimizer_name=optimizer_name,
+            regularization=regularization,
+            max_evals_grouped=max_evals_grouped,
+            seed=int(task_seeds[index]),
+            max_parallel_threads=max_parallel_threads,
+            estimator_name=estimator_name,
+            results_store=results_store,
+            checkpoint_dir=checkpoint_dir,
+            checkpoint_every=checkpoint_every,
+            convergence_tol=convergence_tol,
+            convergence_window=convergence_window,
+            warm_start_magnitude=warm_start_magnitude,
+            topology=topology,
+            simulation_method=simulation_method,
+            memory_budget=memory_budget,
+            symmetry_reduction=symmetry_reduction,
+            n_starts=n_starts,
+            profile_dir=profile_dir,
+            profiler=profiler
+        )
+        for index, (n_shots, n_iters, dep_error, bond_length) in enumerate(grid)
+    ]
+
+
+def run_sweep_task(task, x0=None):
+
+    """
+    Runs the VQE simulation of a single grid point. With task.profile_dir, the wall time and number of calls
+    of the stages of the run (see profiling.py) are written to {profile_dir}/{task.out_filename}.json, with
+    their timeline in the .trace.json file next to it (Chrome trace format), and the profile of the run
+    (.prof or .html) if task.profiler is given.
+        Args:
+            - task: SweepTask instance
+            - x0: np.ndarray, initial parameters, e.g. the optimal parameters of a neighboring geometry; the
+            first optimizer step is then reduced to task.warm_start_magnitude. None for random initial parameters.
+        Returns:
+            - result: dict, with keys 'index', 'energies', 'final_energy', 'x' (optimal parameters), 'n_iters_run',
+            'depth', 'n_2q_gates', 'n_varparams', 'simulation_method' (the Aer method, see plan_task_simulation), and
+            'multistart' with task.n_starts > 1 (the best start, the final energy of each start, the iteration at which
+            it was pruned and their statistics)
+    """
+
+    if task.profile_dir is None:
+        return _run_sweep_task(task, x0)
+
+    path = os.path.join(task.profile_dir, task.out_filename)
+    profiling.enable()
+    try:
+        if task.profiler is None:
+            with profiling.timed('grid_point'):
+                result = _run_sweep_task(task, x0)
+        else:
+            with profiling.profile_block(path, task.profiler), profiling.timed('grid_point'):
+                result = _run_sweep_task(task, x0)
+    finally:
+        profiling.disable()
+    profiling.write_summary(path + '.json', metadata={'task': task._asdict(), 'warm_start': x0 is not None})
+    profiling.write_chrome_trace(path + '.trace.json')
+    return result
+
+
+def _run_sweep_task(task, x0):
+    import qiskit_algorithms
+    from vqe import get_vqe_results_v2
+    from state_and_hamiltonian import get_state_and_hamiltonian
+    from optimizer import get_optimizer, SPSAHistory
+    from estimator import get_estimator
+    from coalesce import coalesced
+    # Seeds the SPSA perturbations of this task
+    qiskit_algorithms.utils.algorithm_globals.random_seed = task.seed
+
+    geometry = make_geometry(task.atomic_symbol, task.bond_length)
+    state, hamiltonian = get_state_and_hamiltonian(state_type=task.state_type, geometry=geometry, basis_set='sto-3g', active_orb=task.active_orbitals, n_elec=task.n_elec,
+                                                   symmetry_reduction=task.symmetry_reduction)
+    if x0 is None and 'adapt_params' in (state.metadata or {}):
+        # The ADAPT ansatz starts from the parameters optimized (without noise) during its construction
+        x0 = np.array(state.metadata['adapt_params'])
+
+    # Without depolarizing errors the noisy simulator only adds cost, the exact statevector gives the same energies
+    estimator_name = task.estimator_name
+    if estimator_name == 'noisy' and task.dep_error == 0:
+        estimator_name = 'noiseless'
+
+    # The simulated device has as many qubits as the (possibly symmetry-reduced) Hamiltonian
+    estimator_settings = dict(nqubits=hamiltonian.num_qubits, estimator_name=estimator_name, n_shots=task.n_shots,
+                              p_err_1q=task.dep_error * default_p1, p_err_2q=task.dep_error * default_p2,
+                              max_parallel_threads=task.max_parallel_threads, topology=task.topology)
+    plan = plan_task_simulation(task, state, hamiltonian, estimator_name)
+    if plan is None:
+        simulation_method = 'automatic' if task.simulation_method == 'plan' else task.simulation_method
+        plan_lines = []
+    else:
+        simulation_method = plan.method
+        plan_lines = plan.log_lines()
+        estimator_settings.update(trajectories=plan.trajectories,
+                                  max_memory_mb=int(plan.memory_budget / 2 ** 20))
+        print('\n'.join(f"{task.out_filename}: {line}" for line in plan_lines), flush=True)
+    estimator_settings['method'] = simulation_method
+    # Within coalesced runs (see run_sweep), the tasks with the same estimator settings share their estimator jobs
+    estimator = coalesced(get_estimator(**estimator_settings), key=tuple(sorted(estimator_settings.items())))
+    if task.results_store:
+        sink = NpzSink(task.results_store, run_id=task.out_filename)
+    else:
+        sink = TextSink(f'out/{task.out_filename}.out', header=plan_lines)
+
+    if task.n_starts > 1:
+        return dict(_run_multistart_task(task, x0, state, hamiltonian, estimator, sink),
+                    simulation_method=simulation_method)
+
+    history_tracker = SPSAHistory(maxiter=task.n_iters)
+    optimizer = get_optimizer(task.optimizer_name, max_iter=task.n_iters, regularization=task.regularization,
+                              callback=history_tracker.callback, max_evals_grouped=task.max_evals_grouped,
+                              target_magnitude=None if x0 is None else task.warm_start_magnitude,
+                              convergence_tol=task.convergence_tol, convergence_window=task.convergence_window)
+
+    _, energies, opt_result = get_vqe_results_v2(
+        state=state,
+        hamiltonian=hamiltonian,
+        optimizer=optimizer,
+        estimator=estimator,
+        filename=task.out_filename,
+        seed=task.seed,
+        sink=sink,
+        checkpoint=OptimizerCheckpoint(task_checkpoint_path(task.checkpoint_dir, task), every=task.checkpoint_every,
+                                       history=history_tracker) if task.checkpoint_dir else None,
+        x0=x0,
+        return_result=True
+    )
+
+    metrics = get_circuit_metrics(state, 'ibm')
+
+    return {
+        'index': task.index,
+        'energies': np.array(energies),    # compact copy, without the spare capacity of the buffer
+        'final_energy': float(energies[-1]),   # energy at the optimal parameters, evaluated last by the optimizer
+        'x': [float(x) for x in opt_result.x],
+        'n_iters_run': int(opt_result.nit),
+        'depth': metrics['depth'],
+        'n_2q_gates': metrics['n_2q_gates'],
+        'n_varparams': metrics['n_params'],
+        'simulation_method': simulation_method
+    }
+
+
+def plan_task_simulation(task, state, hamiltonian, estimator_name):
+
+    """
+    Returns the Aer simulation method of a grid point with simulation_method='plan', selected from the estimated
+    memory and time of each method for its transpiled circuit and noise (see plan_simulation in simulation_plan.py).
+    Only the "noisy" estimator is planned: the other ones do not run Aer, or sample their shots with Aer's own choice.
+    Without task.memory_budget, the budget is default_memory_fraction of the memory available when the task runs,
+    shared between the worker processes of run_sweep. It is not stored in the task, whose fields identify its results
+    (see checkpoint.task_key) and must not change with the free memory.
+        Args:
+            - task: SweepTask instance
+            - state: qiskit.circuit.QuantumCircuit, ansatz of the grid point
+            - hamiltonian: qiskit.quantum_info.SparsePauliOp, its Hamiltonian
+            - estimator_name: str, estimator of the grid point, after the noiseless one replaced "noisy" without errors
+        Returns:
+            - plan: simulation_plan.SimulationPlan instance, or None if the method is not planned
+        Raises:
+            - MemoryError: if no method fits in task.memory_budget
+    """
+
+    from simulation_plan import plan_simulation, available_memory, default_memory_fraction
+
+    if task.simulation_method != 'plan' or estimator_name != 'noisy':
+        return None
+    memory_budget = task.memory_budget
+    if memory_budget is None:
+        memory_budget = default_memory_fraction * available_memory() / _n_worker_processes
+    metrics = get_circuit_metrics(state, 'ibm')
+    # SPSA evaluates the energy about 3 times per iteration (2 for the gradient, 1 with blocking), after 50
+    # calibration evaluations
+    return plan_simulation(hamiltonian.num_qubits, metrics['transpiled'].size(), metrics['n_2q_gates'],
+                           noisy=True, n_shots=task.n_shots, memory_budget=memory_budget,
+                           n_evaluations=(3 * task.n_iters + 50) * task.n_starts)
+
+
+def _run_multistart_task(task, x0, state, hamiltonian, estimator, sink):
+    # The starts are not checkpointed; a completed task is still recorded in the manifest of the sweep
+    from multistart import get_multistart_vqe_results
+
+    if task.optimizer_name != 'spsa':
+        raise ValueError("Multi-start runs are only supported for SPSA")
+    results = get_multistart_vqe_results(
+        state, hamiltonian, estimator, n_starts=task.n_starts, maxiter=task.n_iters, filename=task.out_filename,
+        seed=task.seed, sink=sink, x0=x0, target_magnitude=None if x0 is None else task.warm_start_magnitude
+    )
+    metrics = get_circuit_metrics(state, 'ibm')
+
+    return {
+        'index': task.index,
+        'energies': np.array(results['energies']),
+        'final_energy': results['final_energy'],
+        'x': [float(x) for x in results['x']],
+        'n_iters_run': results['n_iters_run'],
+        'depth': metrics['depth'],
+        'n_2q_gates': metrics['n_2q_gates'],
+        'n_varparams': metrics['n_params'],
+        'multistart': {
+            'best_start': results['best_start'],
+            'final_energies': [start['final_energy'] for start in results['starts']],
+            'pruned_at': [start['pruned_at'] for start in results['starts']],
+            'statistics': results['statistics'],
+        }
+    }
+
+
+def prewarm():
+
+    """
+    Imports the modules run by the tasks (Qiskit, Aer, Qiskit Nature, PySCF), which this module only loads
+    when the first task runs. Worker processes call it once at startup, before running their grid points.
+    """
+
+    import pyscf
+    import qiskit_nature.second_q.drivers
+    import qiskit_nature.second_q.transformers
+    import qiskit_nature.second_q.circuit.library
+    import vqe
+    import multistart
+    import adapt
+    import coalesce
+    import state_and_hamiltonian
+    import optimizer
+    import estimator
+
+
+def _init_worker(n_threads, n_workers=1):
+    # Limits the threads of the numerical libraries of each worker, and its share of the memory
+    global _n_worker_processes
+    _n_worker_processes = n_workers
+    for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[var] = str(n_threads)
+    prewarm()
+
+
+def run_pes_series(tasks, extrapolate=False, completed=None):
+
+    """
+    Runs the tasks of a potential energy surface scan (same settings, different bond lengths) in the
+    order of the bond lengths, each one starting from the optimal parameters of the previous geometry,
+    or, with extrapolate, from their linear extrapolation from the two previous geometries.
+        Args:
+            - tasks: list, of SweepTask instances differing only by their bond length
+            - extrapolate: bool, whether to extrapolate the initial parameters from the two previous geometries
+            - completed: dict, of results of tasks completed earlier (by task index), not run again but used
+            to warm start the next geometries
+        Returns:
+            - results: list, of (task, result) of the tasks run, in the order of the tasks
+    """
+
+    completed = completed or {}
+    results = {}
+    previous = []   # (bond_length, optimal parameters) of the finished geometries, in scan order
+    for task in sorted(tasks, key=lambda task: task.bond_length):
+        x0 = None
+        if previous:
+            bond_length, x = previous[-1]
+            x0 = np.array(x)
+            if extrapolate and len(previous) > 1:
+                bond_length_2, x_2 = previous[-2]
+                x0 = x0 + (x0 - np.array(x_2)) * (task.bond_length - bond_length) / (bond_length - bond_length_2)
+        result = completed.get(task.index)
+        if result is None:
+            result = run_sweep_task(task, x0=x0)
+            results[task.index] = result
+        previous.append((task.bond_length, result['x']))
+    return [(task, results[task.index]) for task in tasks if task.index in results]
+
+
+def run_sweep(tasks, n_workers=1, pes_scan=False, extrapolate=False, completed=None, coalesce=False,
+              max_batch_size=64, max_latency=0.005):
+
+    """
+    Runs the tasks of a sweep and yields their results in the order of the tasks.
+    With n_workers > 1 the tasks are run in a pool of processes started with 'spawn' (so the script
+    calling it must be protected by if __name__ == '__main__'); results are still yielded in order,
+    as soon as all the previous ones are available.
+    With pes_scan, the tasks differing only by their bond length are run as one potential energy surface
+    scan (see run_pes_series); the scans are then the units of work run in parallel.
+    With coalesce, the units of each process run together, as coroutines whose estimator calls are sent to the
+    estimator as one job per tick (see coalesce.py); each process gets a contiguous share of the units.
+        Args:
+            - tasks: list, of SweepTask instances
+            - n_workers: int, number of worker processes; 1 runs the tasks in the current process
+            - pes_scan: bool, whether to warm start each geometry from the previous one
+            - extrapolate: bool, whether to extrapolate the initial parameters of the scans (see run_pes_series)
+            - completed: dict, of results of tasks completed earlier (by task index), which are not run nor yielded
+            - coalesce: bool, whether to coalesce the estimator calls of the units of each process
+            - max_batch_size, max_latency: dispatch settings of the coalesced estimator calls, see EvaluationCoalescer
+        Yields:
+            - (task, result): tuple, of the SweepTask and the dict returned by run_sweep_task
+    """
+
+    completed = completed or {}
+    if pes_scan:
+        series = {}
+        for task in tasks:
+            series.setdefault(task._replace(index=0, bond_length=0, seed=0), []).append(task)
+        units = [(run_pes_series, (series_tasks, extrapolate, {t.index: completed[t.index] for t in series_tasks if t.index in completed}))
+                 for series_tasks in series.values()
+                 if any(t.index not in completed for t in series_tasks)]
+    else:
+        units = [(_run_single_task, (task,)) for task in tasks if task.index not in completed]
+    if not units:
+        return
+    if coalesce:
+        n_chunks = min(n_workers, len(units))
+        bounds = np.linspace(0, len(units), n_chunks + 1).astype(int)
+        units = [(_run_coalesced_units, (units[start:stop], max_batch_size, max_latency))
+                 for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    if n_workers == 1:
+        for function, args in units:
+            yield from function(*args)
+        return
+
+    n_threads = max(max(task.max_parallel_threads for task in tasks), 1)
+    with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(n_threads, n_workers)
+            ) as executor:
+        futures = [executor.submit(function, *args) for function, args in units]
+        for future in futures:
+            yield from future.result()
+
+
+def _run_single_task(task):
+    return [(task, run_sweep_task(task))]
+
+
+def _run_coalesced_units(units, max_batch_size, max_latency):
+    from coalesce import EvaluationCoalescer
+
+    coalescer = EvaluationCoalescer(max_batch_size=max_batch_size, max_latency=max_latency)
+    results = coalescer.run([partial(function, *args) for function, args in units])
+    return [item for unit_results in results for item in unit_results]
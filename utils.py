@@ -1,63 +1,173 @@
-from qiskit.quantum_info import SparsePauliOp
-import numpy as np
-from qiskit import transpile
-from qiskit.providers.fake_provider import GenericBackendV2
-
-
-
-
-geometries = {
-        'LiH' : 'Li 0 0 0; H 0 0 1.595',    # equilibrium geometry of LiH molecule
-        'H2' : 'H 0 0 0; H 0 0 0.741;', # equilibrium geometry of H2 molecule
-    }
-
-def make_geometry(atomic_symbol):
-
-    """
-    Returns the geometry string for a given molecule, to be used in the PySCFDriver
-        Args:
-            - atomic_symbol: str, either 'H2' or 'LiH'
-        Returns:
-            - geometry: str, geometry string for the molecule
-    """
-    geometry = geometries[atomic_symbol]
-    return geometry
-
-def get_circuit_depth(
-        state,
-        hardware='ibm',
-        filename='default_filename.pdf'
-        ):
-
-    """
-    Returns the depth of the circuit corresponding to the given state, after transpiling it to
-    the basis gates of the specified hardware and saves the transpiled circuit in a .pdf file in
-    the circuits/ folder
-        Args:
-            - state: qiskit.circuit.QuantumCircuit, the quantum circuit whose depth we want to compute
-            - hardware: str, name of the hardware to which we want to transpile the circuit; only 'ibm' supported
-
-        Returns:
-            - depth: int, depth of the transpiled circuit
-    """
-
-    if hardware == 'ibm':
-        basis_gates = ['id', 'rz', 'sx', 'x', 'cx']
-    else:
-        raise ValueError("Hardware not supported; must be 'ibm'")
-
-    backend = GenericBackendV2(num_qubits=state.num_qubits, basis_gates=basis_gates)
-
-    frozen_circuit = state.decompose() 
-
-    # Sometimes one decompose isn't enough for UCCSD (it has layers)
-    # We repeat until we see standard gates
-    while 'PauliEvolutionGate' in [inst.operation.name for inst in frozen_circuit.data]:
-        frozen_circuit = frozen_circuit.decompose()
-        # Get circuit depth on an example hardware (with gates CZ, ID, RZ, X, SX)
-    transpiled_ansatz = transpile(frozen_circuit, basis_gates=basis_gates, backend=backend, optimization_level=2, seed_transpiler=0)
-    transpiled_ansatz.draw(output='mpl', filename=f'circuits/{filename}.pdf')
-
-    return transpiled_ansatz.depth()
-
-  
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from profiling import timed
+
+
+
+
+geometries = {
+        'LiH' : 'Li 0 0 0; H 0 0 1.595',    # equilibrium geometry of LiH molecule
+        'H2' : 'H 0 0 0; H 0 0 0.741;', # equilibrium geometry of H2 molecule
+    }
+
+geometry_templates = {
+        'LiH' : 'Li 0 0 0; H 0 0 {bond_length}',
+        'H2' : 'H 0 0 0; H 0 0 {bond_length}',
+    }
+
+def make_geometry(atomic_symbol, bond_length=None):
+
+    """
+    Returns the geometry string for a given molecule, to be used in the PySCFDriver
+        Args:
+            - atomic_symbol: str, either 'H2' or 'LiH'
+            - bond_length: float, bond length in Angstrom; None for the equilibrium geometry
+        Returns:
+            - geometry: str, geometry string for the molecule
+    """
+    if atomic_symbol not in geometries:
+        raise ValueError("Atomic symbol not supported; must be either 'H2' or 'LiH'")
+    if bond_length is None:
+        return geometries[atomic_symbol]
+    geometry = geometry_templates[atomic_symbol].format(bond_length=bond_length)
+    return geometry
+
+_circuit_metrics = {}    # memo of get_circuit_metrics, keyed by (circuit fingerprint, hardware)
+_drawing_executor = None
+_drawing_jobs = []
+
+def get_circuit_metrics(
+        state,
+        hardware='ibm'
+        ):
+
+    """
+    Returns the metrics of the circuit corresponding to the given state, after transpiling it to
+    the basis gates of the specified hardware. The metrics are computed once per distinct circuit
+    structure (see cache.circuit_fingerprint) and memoized, so all the bond lengths and noise levels
+    of a sweep share them.
+        Args:
+            - state: qiskit.circuit.QuantumCircuit, the quantum circuit whose metrics we want to compute
+            - hardware: str, name of the hardware to which we want to transpile the circuit; only 'ibm' supported
+        Returns:
+            - metrics: dict, with keys 'depth' (depth of the transpiled circuit), 'n_2q_gates' (number of
+            two-qubit gates of the transpiled circuit), 'n_params' (number of variational parameters) and
+            'transpiled' (the transpiled circuit, must not be modified)
+    """
+
+    # Imported here, so that the helpers of this module (e.g. make_geometry) do not load Qiskit
+    from qiskit import transpile
+    from qiskit.providers.fake_provider import GenericBackendV2
+    from cache import circuit_fingerprint
+
+    if hardware == 'ibm':
+        basis_gates = ['id', 'rz', 'sx', 'x', 'cx']
+    else:
+        raise ValueError("Hardware not supported; must be 'ibm'")
+
+    key = (circuit_fingerprint(state), hardware)
+    if key in _circuit_metrics:
+        return dict(_circuit_metrics[key])
+
+    # Seeded, its random error rates steering the layout, so that the depth does not depend on the process. A
+    # 1-qubit backend (e.g. H2 after symmetry tapering) cannot have the two-qubit gate
+    backend_gates = basis_gates if state.num_qubits > 1 else [gate for gate in basis_gates if gate != 'cx']
+    backend = GenericBackendV2(num_qubits=state.num_qubits, basis_gates=backend_gates, seed=0)
+
+    frozen_circuit = state.decompose() 
+
+    # Sometimes one decompose isn't enough for UCCSD (it has layers)
+    # We repeat until we see standard gates
+    while 'PauliEvolutionGate' in [inst.operation.name for inst in frozen_circuit.data]:
+        frozen_circuit = frozen_circuit.decompose()
+        # Get circuit depth on an example hardware (with gates CZ, ID, RZ, X, SX)
+    with timed('circuit_metrics'):
+        transpiled_ansatz = transpile(frozen_circuit, basis_gates=basis_gates, backend=backend, optimization_level=2, seed_transpiler=0)
+
+    _circuit_metrics[key] = {
+        'depth': transpiled_ansatz.depth(),
+        'n_2q_gates': sum(1 for inst in transpiled_ansatz.data if inst.operation.num_qubits == 2),
+        'n_params': state.num_parameters,
+        'transpiled': transpiled_ansatz,
+    }
+    return dict(_circuit_metrics[key])
+
+def get_circuit_depth(
+        state,
+        hardware='ibm',
+        filename=None
+        ):
+
+    """
+    Returns the depth of the circuit corresponding to the given state, after transpiling it to
+    the basis gates of the specified hardware (see get_circuit_metrics). If a filename is given, the
+    transpiled circuit is also drawn in a .pdf file in the circuits/ folder, in the background
+    (see export_circuit_drawing)
+        Args:
+            - state: qiskit.circuit.QuantumCircuit, the quantum circuit whose depth we want to compute
+            - hardware: str, name of the hardware to which we want to transpile the circuit; only 'ibm' supported
+            - filename: str, name of the .pdf file (without extension); None to skip the drawing
+
+        Returns:
+            - depth: int, depth of the transpiled circuit
+    """
+
+    metrics = get_circuit_metrics(state, hardware)
+    if filename is not None:
+        export_circuit_drawing(state, filename, hardware)
+
+    return metrics['depth']
+
+def _draw_circuit(circuit, path):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    figure = circuit.draw(output='mpl', filename=path)
+    plt.close(figure)
+
+def export_circuit_drawing(
+        state,
+        filename,
+        hardware='ibm'
+        ):
+
+    """
+    Draws the transpiled circuit of the given state in a .pdf file in the circuits/ folder. The drawing
+    is done by a background process, so it does not block the VQE runs; use wait_for_circuit_drawings
+    to wait until all the files are written.
+        Args:
+            - state: qiskit.circuit.QuantumCircuit, the quantum circuit to draw
+            - filename: str, name of the .pdf file (without extension)
+            - hardware: str, name of the hardware to which the circuit is transpiled; only 'ibm' supported
+        Returns:
+            - future: concurrent.futures.Future, completed when the file is written
+    """
+
+    global _drawing_executor
+
+    transpiled_ansatz = get_circuit_metrics(state, hardware)['transpiled']
+    if _drawing_executor is None:
+        _drawing_executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+    future = _drawing_executor.submit(_draw_circuit, transpiled_ansatz, f'circuits/{filename}.pdf')
+    _drawing_jobs.append(future)
+    return future
+
+def wait_for_circuit_drawings():
+
+    """
+    Waits until all the drawings requested with export_circuit_drawing are written, and raises the
+    first error that occurred while drawing, if any
+    """
+
+    global _drawing_executor
+
+    done, _ = wait(_drawing_jobs)
+    _drawing_jobs.clear()
+    if _drawing_executor is not None:
+        _drawing_executor.shutdown()
+        _drawing_executor = None
+    for future in done:
+        future.result()
@@ -1,67 +1,146 @@
 import numpy as np
-from qiskit import transpile
+from cache import TranspileCache
+from results_store import TextSink
+from gradients import ParameterShiftGradient
+from optimizer import GrowableArray
+from estimator import get_transpile_target
+from profiling import timed
 from qiskit_aer.primitives import EstimatorV2
-from qiskit_algorithms.optimizers import SPSA
+from qiskit_algorithms.optimizers import SPSA, OptimizerSupportLevel
+
+
+# Transpiled ansatz circuits, shared by all the VQE runs of the process
+# (set transpile_cache.cache_dir to also keep them on disk across processes)
+transpile_cache = TranspileCache()
+
+def get_isa_circuit_and_observable(state, hamiltonian, estimator):
+
+    """
+    Returns the ansatz transpiled for the target of the estimator (from transpile_cache) and the Hamiltonian with
+    the layout of the transpiled circuit applied; both unchanged for estimators running the ansatz as it is
+    """
+
+    coupling_map, target_basis = get_transpile_target(estimator)
+    if target_basis is None:
+        # The estimator runs the ansatz as it is (exact statevector), no ISA circuit needed
+        return state, hamiltonian
+    with timed('transpile'):
+        isa_ansatz = transpile_cache.get_isa_circuit(state, coupling_map=coupling_map, basis_gates=target_basis, optimization_level=3, seed_transpiler=0)
+    # The transpiler may permute the qubits (initial layout and routing), so the observable must follow
+    return isa_ansatz, hamiltonian.apply_layout(isa_ansatz.layout)
 
 def get_vqe_results_v2(
         state,              
         hamiltonian,        
         optimizer=SPSA(maxiter=100), 
         estimator=EstimatorV2(),
-        filename='default_filename'
+        filename='default_filename',
+        seed=None,
+        sink=None,
+        checkpoint=None,
+        x0=None,
+        return_result=False
     ):
 
     """
     Returns the lists of iteration numbers and corresponding energy values obtained during the VQE optimization process
-    using EstimatorV2. The results are also saved in a .out file in the out/ folder.
+    using EstimatorV2. The results are also saved in a .out file in the out/ folder, or sent to the given sink.
         Args:
             - state: qiskit.circuit.QuantumCircuit, the ansatz circuit for the VQE simulation
             - hamiltonian: qiskit.SparsePauliOp, the Hamiltonian of the system for which we want to find the ground state
             energy
             - optimizer: qiskit_algorithms.optimizers.optimizer instance, the optimizer to be used in the VQE simulation
-            (default is SPSA with maxiter=100)
-            - estimator: qiskit_aer.primitives.EstimatorV2 instance, the estimator to be used in the VQE simulation
+            (default is SPSA with maxiter=100); optimizers supporting gradients get the parameter-shift gradient
+            (see gradients.py) and their history_callback attribute, if any, is called after each evaluation
+            - estimator: qiskit_aer.primitives.EstimatorV2, qiskit.primitives.StatevectorEstimator or
+            native_estimator.NumpyEstimator instance, the estimator to be used in the VQE simulation
             - filename: str, name of the .out file to be saved in the out/ folder (without extension)
+            - seed: int, seed of the random initial parameters; None to use the global numpy random state
+            - sink: results_store.ResultSink instance receiving the evaluations, with filename as run id; None to write
+            them to out/{filename}.out. The sink is closed at the end of the run, also if the optimizer raises.
+            - checkpoint: checkpoint.OptimizerCheckpoint instance, to save the state of the SPSA optimizer periodically
+            and resume from it; the evaluations of the interrupted run are restored and written to the sink again
+            - x0: np.ndarray, initial parameters (e.g. the optimal parameters of a neighboring geometry); None for random
+            initial parameters drawn with seed
+            - return_result: bool, whether to also return the result of the optimizer
         Returns:
-            - iters: list, of N_iters numbers, contains the iteration numbers during the optimization process
-            - energies: list, of N_iters numbers, contains the energy values corresponding to each iteration during the
-            optimization process
+            - iters: np.ndarray, of N_iters numbers, contains the iteration numbers during the optimization process
+            - energies: np.ndarray, of N_iters numbers, contains the energy values corresponding to each iteration during the
+            optimization process (read-only)
+            - result: qiskit_algorithms.optimizers.OptimizerResult, with the optimal parameters result.x, only if return_result
     """
     
-    coupling_map = estimator._backend.coupling_map
-    target_basis = estimator._backend._basis_gates()
-    isa_ansatz = transpile(state, coupling_map=coupling_map, basis_gates=target_basis, optimization_level=3, seed_transpiler=0)
-    isa_hamiltonian = hamiltonian
+    isa_ansatz, isa_hamiltonian = get_isa_circuit_and_observable(state, hamiltonian, estimator)
 
-    iters = []
-    energies = []
+    # Growable float64 arrays rather than lists of 0-d arrays (see GrowableArray)
+    capacity = 3 * getattr(optimizer, 'maxiter', None) + 64 if getattr(optimizer, 'maxiter', None) else 1024
+    energies = GrowableArray(capacity)
+    evaluated_params = GrowableArray(capacity, row_shape=(isa_ansatz.num_parameters,))
     
-    fout = open(f'out/{filename}.out', 'w')
-    fout.write(f"VQE Simulation (EstimatorV2)\n")
-    fout.write(f"{'Iter':>10} {'Energy (Hartree)':>20}\n")
+    if sink is None:
+        sink = TextSink(f'out/{filename}.out')
     
-    def cost_func(params):
-        pub = (isa_ansatz, isa_hamiltonian, params)
-        job = estimator.run([pub])
-        result = job.result()[0] 
-        current_energy = result.data.evs
-        
+    def log_energy(current_energy, params):
         iter_count = len(energies)
-        iters.append(iter_count)
         energies.append(current_energy)
+        evaluated_params.append(params)
         
-        fout.write(f"{iter_count:>10} {current_energy:>20.6f}\n")
-        return current_energy
+        sink.write(filename, iter_count, current_energy, params)
+
+    def cost_func(params):
+        # params is either a single parameter set or, for optimizers grouping their evaluations
+        # (max_evals_grouped > 1), a 2D array of parameter sets sent to the estimator as a single PUB
+        pub = (isa_ansatz, isa_hamiltonian, params)
+        with timed('estimator_run'):
+            job = estimator.run([pub])
+            result = job.result()[0]
+        current_energy = result.data.evs
+
+        if np.ndim(params) == 1:
+            log_energy(current_energy, params)
+            return current_energy
+
+        for energy, point in zip(current_energy, params):
+            log_energy(energy, point)
+        return list(current_energy)
 
     # --- Run Optimizer ---
     num_params = isa_ansatz.num_parameters
-    x0 = np.random.uniform(-np.pi, np.pi, num_params)
-    result = optimizer.minimize(fun=cost_func, x0=x0) 
+    if x0 is not None:
+        x0 = np.asarray(x0, dtype=float)
+    elif seed is None:
+        x0 = np.random.uniform(-np.pi, np.pi, num_params)
+    else:
+        x0 = np.random.default_rng(seed).uniform(-np.pi, np.pi, num_params)
+    # SPSA reports the gradient as 'ignored', which is_gradient_supported also counts as supported
+    use_gradient = optimizer.gradient_support_level == OptimizerSupportLevel.supported
+    if use_gradient:
+        history_callback = getattr(optimizer, 'history_callback', None)
+
+        def on_evaluation(energy, params, gradient):
+            log_energy(energy, params)
+            if history_callback is not None:
+                history_callback(len(energies), params, energy, np.linalg.norm(gradient), True)
+
+        gradient = ParameterShiftGradient(estimator, isa_ansatz, isa_hamiltonian, callback=on_evaluation)
+
+    with sink, timed('optimizer'):
+        if use_gradient:
+            if checkpoint is not None:
+                raise ValueError("Checkpoints are only supported for SPSA")
+            result = optimizer.minimize(fun=gradient.value, x0=x0, jac=gradient.gradient)
+        elif checkpoint is None:
+            result = optimizer.minimize(fun=cost_func, x0=x0) 
+        else:
+            result = checkpoint.minimize(optimizer, cost_func, x0, energies, evaluated_params, log_energy)
     
     pub_final = (isa_ansatz, isa_hamiltonian, result.x)
-    job_final = estimator.run([pub_final])
-    _ = job_final.result()[0]
+    with timed('final_evaluation'):
+        job_final = estimator.run([pub_final])
+        _ = job_final.result()[0]
 
-    fout.close()
+    iters = np.arange(len(energies))
+    if return_result:
+        return iters, energies.view(), result
     
-    return iters, energies
\ No newline at end of file
+    return iters, energies.view()
\ No newline at end of file
@@ -0,0 +1,351 @@
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from typing import NamedTuple
+from sweep import SweepTask
+from checkpoint import task_key
+
+
+# Distributed sweeps: a coordinator submits the grid points of a sweep to a SQLite queue on a shared folder,
+# workers started on any node claim them one at a time under a lease, which they renew while the grid point
+# runs, and write each result to its own shard file; a reducer finally assembles the results of the sweep as
+# run_vqe_simulation does. A grid point whose worker died is given to another worker when its lease expires.
+# SQLite needs a file system with working POSIX locks (local disks, most parallel file systems; not all NFS).
+# Example, with 4 workers on one machine:
+#     python cli.py submit sweeps/queue.db LiH UCCSD --bond-lengths 1.0 1.595 2.0 --dep-errors 0 1
+#     for i in 1 2 3 4; do python cli.py worker sweeps/queue.db & done; wait
+#     python cli.py reduce sweeps/queue.db LiH_UCCSD_results
+
+
+class Lease(NamedTuple):
+
+    """
+    A grid point claimed by a worker, until lease_expires (time.time() seconds)
+    """
+
+    task_id: int
+    sweep: str
+    digest: str
+    task: SweepTask
+    worker: str
+    lease_expires: float
+
+
+class WorkQueue:
+
+    """
+    Queue of the grid points of sweeps, stored in a SQLite database shared by the coordinator, the workers and the
+    reducer. Every change is a single transaction, so concurrent processes, on one or several nodes, never claim
+    the same grid point at once. The states of a grid point are 'pending', 'running' (leased by a worker), 'done'
+    and 'failed' (after max_attempts claims).
+        Args:
+            - path: str, path of the database file, created if needed
+            - max_attempts: int, number of claims of a grid point, counting the expired leases, before it is failed
+    """
+
+    def __init__(self, path, max_attempts=3):
+        self.path = path
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._transaction() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id INTEGER PRIMARY KEY,
+                    sweep TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    digest TEXT NOT NULL,
+                    task TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    UNIQUE (sweep, digest)
+                )""")
+            db.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, id)")
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock at once, so that a claim reads and updates the queue atomically
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    def submit(self, sweep, tasks):
+
+        """
+        Adds the grid points of a sweep to the queue; those already submitted (same sweep and task_key) are kept
+        as they are, so that submitting the same sweep again adds nothing. The seed of a grid point depends on its
+        position in the grid (see make_sweep_tasks), so extending the grid gives new grid points.
+        A grid point whose position in the sweep is already taken by another one (e.g. the same grid with another
+        simulation method) is rejected, since the results of both would be mixed in the results file of the sweep.
+            Args:
+                - sweep: str, name of the sweep
+                - tasks: list, of sweep.SweepTask instances, in the order of the results
+            Returns:
+                - n_added: int, number of grid points added
+            Raises:
+                - ValueError: if grid points of the sweep were submitted with other settings; nothing is added then
+        """
+
+        with self._transaction() as db:
+            submitted = dict(db.execute("SELECT position, digest FROM tasks WHERE sweep = ?", (sweep,)).fetchall())
+            conflicts = [task for task in tasks if submitted.get(task.index, task_digest(task)) != task_digest(task)]
+            if conflicts:
+                raise ValueError(f"{len(conflicts)} grid points of '{sweep}' were already submitted with other settings "
+                                 f"(e.g. {conflicts[0].out_filename}); submit this grid as another sweep")
+            before = db.total_changes
+            db.executemany(
+                "INSERT OR IGNORE INTO tasks (sweep, position, digest, task) VALUES (?, ?, ?, ?)",
+                [(sweep, task.index, task_digest(task), json.dumps(task._asdict())) for task in tasks]
+            )
+            return db.total_changes - before
+
+    def claim(self, worker, lease_seconds=600):
+
+        """
+        Claims the first pending grid point, after requeuing the grid points whose lease expired
+            Args:
+                - worker: str, name of the worker
+                - lease_seconds: float, duration of the lease, to be renewed by the worker while it runs the grid point
+            Returns:
+                - lease: Lease instance, None if no grid point is pending
+        """
+
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL,"
+                " error = COALESCE(error, 'lease expired') WHERE status = 'running' AND lease_expires < ?",
+                (self.max_attempts, now)
+            )
+            row = db.execute("SELECT id, sweep, digest, task FROM tasks WHERE status = 'pending' ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            task_id, sweep, digest, task = row
+            db.execute("UPDATE tasks SET status = 'running', worker = ?, lease_expires = ?, attempts = attempts + 1"
+                       " WHERE id = ?", (worker, now + lease_seconds, task_id))
+        return Lease(task_id, sweep, digest, SweepTask(**json.loads(task)), worker, now + lease_seconds)
+
+    def renew(self, lease, lease_seconds=600):
+
+        """
+        Extends a lease
+            Returns:
+                - renewed: bool, False if the lease was lost (expired and requeued or claimed by another worker)
+        """
+
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE tasks SET lease_expires = ? WHERE id = ? AND status = 'running' AND worker = ?",
+                                (time.time() + lease_seconds, lease.task_id, lease.worker))
+            return cursor.rowcount == 1
+
+    def complete(self, lease):
+
+        """
+        Marks a leased grid point as done (also if its lease was lost meanwhile, its result shard being written)
+        """
+
+        with self._transaction() as db:
+            db.execute("UPDATE tasks SET status = 'done', worker = ?, lease_expires = NULL, error = NULL WHERE id = ?",
+                       (lease.worker, lease.task_id))
+
+    def fail(self, lease, error):
+
+        """
+        Gives back a leased grid point whose run raised: it is pending again, or failed after max_attempts claims
+        """
+
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL,"
+                " lease_expires = NULL, error = ? WHERE id = ? AND status = 'running' AND worker = ?",
+                (self.max_attempts, error, lease.task_id, lease.worker)
+            )
+
+    def counts(self, sweep=None):
+
+        """
+        Returns the number of grid points per status, of a sweep or of all the sweeps
+            Returns:
+                - counts: dict, with keys 'pending', 'running', 'done' and 'failed'
+        """
+
+        with self._transaction() as db:
+            query = "SELECT status, COUNT(*) FROM tasks" + (" WHERE sweep = ?" if sweep else "") + " GROUP BY status"
+            rows = db.execute(query, (sweep,) if sweep else ()).fetchall()
+        return dict({'pending': 0, 'running': 0, 'done': 0, 'failed': 0}, **dict(rows))
+
+    def sweeps(self):
+        with self._transaction() as db:
+            return [row[0] for row in db.execute("SELECT DISTINCT sweep FROM tasks ORDER BY sweep")]
+
+    def tasks(self, sweep):
+
+        """
+        Returns the grid points of a sweep, in the order in which they were submitted
+            Returns:
+                - tasks: list, of (digest, status, error, SweepTask)
+        """
+
+        with self._transaction() as db:
+            rows = db.execute("SELECT digest, status, error, task FROM tasks WHERE sweep = ? ORDER BY position, id",
+                              (sweep,)).fetchall()
+        return [(digest, status, error, SweepTask(**json.loads(task))) for digest, status, error, task in rows]
+
+
+def task_digest(task):
+
+    """
+    Returns the digest of the fields identifying a grid point (see checkpoint.task_key), naming its result shard
+    """
+
+    return hashlib.sha256(json.dumps(task_key(task), sort_keys=True).encode()).hexdigest()[:16]
+
+
+def shard_path(shard_dir, sweep, digest):
+    return os.path.join(shard_dir, sweep, f'{digest}.json')
+
+
+def default_shard_dir(queue_path):
+    return os.path.join(os.path.dirname(os.path.abspath(queue_path)), 'shards')
+
+
+def run_worker(queue_path, shard_dir=None, worker=None, lease_seconds=600, poll_interval=10, max_tasks=None):
+
+    """
+    Runs the grid points of the queue until none is pending or running. While a grid point runs, its lease is
+    renewed every lease_seconds / 3 seconds by a background thread; its result is then written to
+    {shard_dir}/{sweep}/{digest}.json (see write_shard). When the other grid points are all leased, the worker
+    waits for them, so that it takes over those whose worker died.
+        Args:
+            - queue_path: str, path of the WorkQueue database
+            - shard_dir: str, folder of the result shards; None for shards/ next to the database
+            - worker: str, name of the worker; None for {hostname}-{pid}
+            - lease_seconds: float, duration of the leases
+            - poll_interval: float, time in seconds between two claims when all the grid points are leased
+            - max_tasks: int, number of grid points after which the worker stops; None for no limit
+        Returns:
+            - n_done: int, number of grid points run by the worker
+    """
+
+    from sweep import prewarm, run_sweep_task
+
+    queue = WorkQueue(queue_path)
+    shard_dir = shard_dir or default_shard_dir(queue_path)
+    worker = worker or f'{socket.gethostname()}-{os.getpid()}'
+    prewarm()
+
+    n_done = 0
+    while max_tasks is None or n_done < max_tasks:
+        lease = queue.claim(worker, lease_seconds)
+        if lease is None:
+            counts = queue.counts()
+            if counts['running'] == 0:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        print(f"{worker} running {lease.sweep}/{lease.task.out_filename}")
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_renew_lease, args=(queue, lease, lease_seconds, stop), daemon=True)
+        heartbeat.start()
+        try:
+            result = run_sweep_task(lease.task)
+            write_shard(shard_path(shard_dir, lease.sweep, lease.digest), lease.task, result)
+        except Exception:
+            queue.fail(lease, traceback.format_exc())
+            print(f"{worker} failed {lease.sweep}/{lease.task.out_filename}")
+            continue
+        finally:
+            stop.set()
+            heartbeat.join()
+        queue.complete(lease)
+        n_done += 1
+    return n_done
+
+
+def _renew_lease(queue, lease, lease_seconds, stop):
+    while not stop.wait(lease_seconds / 3):
+        if not queue.renew(lease, lease_seconds):
+            # Lost, e.g. after a long suspension: the grid point may run twice, with the same result shard
+            print(f"{lease.worker} lost the lease of {lease.sweep}/{lease.task.out_filename}")
+            return
+
+
+def write_shard(path, task, result):
+
+    """
+    Writes the result of a grid point to its shard, atomically, so that a reducer never reads a partial shard
+        Args:
+            - path: str, path of the .json shard
+            - task: sweep.SweepTask instance
+            - result: dict, returned by sweep.run_sweep_task
+    """
+
+    result = dict(result, energies=[float(energy) for energy in result['energies']])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + f'.{socket.gethostname()}-{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'task': task._asdict(), 'result': result}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def reduce_sweep(queue_path, sweep, shard_dir=None, filename=None, allow_partial=False):
+
+    """
+    Assembles the results of a sweep from its shards, as returned by run_vqe_simulation, and writes its results
+    file to out/results/
+        Args:
+            - queue_path: str, path of the WorkQueue database
+            - sweep: str, name of the sweep
+            - shard_dir: str, folder of the result shards; None for shards/ next to the database
+            - filename: str, name of the results .txt file in out/results/; None for {sweep}.txt
+            - allow_partial: bool, whether to assemble the grid points done so far; otherwise a RuntimeError is raised
+            if some are not done
+        Returns:
+            - results: dict, with keys (n_shots, n_iters, dep_error), see run_vqe_simulation
+    """
+
+    from run import record_result, results_header
+
+    queue = WorkQueue(queue_path)
+    shard_dir = shard_dir or default_shard_dir(queue_path)
+    entries = queue.tasks(sweep)
+    if not entries:
+        raise ValueError(f"No grid point submitted for the sweep '{sweep}'")
+    missing = [(task, status, error) for digest, status, error, task in entries
+               if not os.path.exists(shard_path(shard_dir, sweep, digest))]
+    if missing and not allow_partial:
+        failed = [task.out_filename for task, status, _ in missing if status == 'failed']
+        raise RuntimeError(f"{len(missing)} of the {len(entries)} grid points of '{sweep}' are not done"
+                           + (f", failed: {failed}" if failed else ""))
+
+    results = {}
+    os.makedirs('out/results', exist_ok=True)
+    with open(os.path.join('out/results', filename or f'{sweep}.txt'), 'w') as file:
+        file.write(results_header)
+        for digest, _, _, task in entries:
+            path = shard_path(shard_dir, sweep, digest)
+            if not os.path.exists(path):
+                continue
+            with open(path) as f:
+                result = json.load(f)['result']
+            record_result(results, file, task, result)
+    return results